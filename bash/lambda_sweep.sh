@@ -0,0 +1,3 @@
+#! /bin/bash
+git pull
+python sweep.py --grid "lambda_a+lambda_b=1,5,10,20,100" --n_workers 5 --threads_per_run 4 --n_epochs 20 --src_lang en --tgt_lang it --src_emb data/pretrained/en.vec --tgt_emb data/pretrained/it.vec --refinement True
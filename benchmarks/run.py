@@ -0,0 +1,295 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# python benchmarks/run.py --n_words 50000 --emb_dim 300 --output bench.json --baseline benchmarks/baseline.json
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+from collections import OrderedDict
+from copy import deepcopy
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from src.utils import bool_flag, load_external_embeddings, get_nn_avg_dist, FAISS_AVAILABLE, EMB_DTYPES
+from src.models import build_model
+from src.trainer import Trainer
+from src.dico_builder import get_candidates, build_dictionary
+from src.hogwild import share_trainer, hogwild_epoch
+from src.evaluation import Evaluator
+from benchmarks.synthetic import generate
+
+
+parser = argparse.ArgumentParser(description='Benchmark the mapping pipeline on synthetic embeddings')
+parser.add_argument("--cuda", type=bool_flag, default=False, help="Run on GPU")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+parser.add_argument("--work_dir", type=str, default="", help="Where to generate the synthetic data (temporary directory by default)")
+# data
+parser.add_argument("--n_words", type=int, default=20000, help="Vocabulary size of each language")
+parser.add_argument("--emb_dim", type=int, default=300, help="Embedding dimension")
+parser.add_argument("--noise", type=float, default=0.1, help="Gaussian noise added to the rotated target embeddings")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+parser.add_argument("--n_europarl", type=int, default=0, help="Synthetic parallel sentences for sent_translation (0 to skip, needs >= 200000)")
+# benchmarks
+parser.add_argument("--only", type=str, default="", help="Only run the benchmarks matching this regex")
+parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each benchmark")
+parser.add_argument("--n_steps", type=int, default=100, help="Discriminator / mapping steps per timed run")
+parser.add_argument("--knn", type=int, default=10, help="Neighborhood of get_nn_avg_dist / CSLS")
+parser.add_argument("--dico_methods", type=str, default="nn,invsm_beta_30,csls_knn_10", help="get_candidates methods to time")
+parser.add_argument("--dico_max_rank", type=int, default=15000, help="Maximum dictionary words rank (0 to disable)")
+parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+parser.add_argument("--dis_hid_dim", type=int, default=2048, help="Discriminator hidden layer dimensions")
+parser.add_argument("--hogwild_workers", type=str, default="", help="Comma separated worker counts of the Hogwild adversarial training scaling benchmark (e.g. 1,2,4,8)")
+# reporting
+parser.add_argument("--output", type=str, default="", help="Write the results to this JSON file")
+parser.add_argument("--baseline", type=str, default="", help="Compare with the results stored in this JSON file")
+parser.add_argument("--save_baseline", type=str, default="", help="Store the results as a new baseline")
+parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown reported as a regression")
+
+
+def synchronize(params):
+    if params.cuda:
+        torch.cuda.synchronize()
+
+
+def timeit(name, fn, params, results, setup=None, n_items=None):
+    """
+    Time `fn` over `params.repeat` runs (after a warm-up run),
+    and store the statistics in `results[name]`.
+    """
+    if params.only and re.search(params.only, name) is None:
+        return
+    timings = []
+    for i in range(params.repeat + 1):
+        if setup is not None:
+            setup()
+        synchronize(params)
+        tic = time.time()
+        fn()
+        synchronize(params)
+        if i > 0:
+            timings.append(time.time() - tic)
+    res = OrderedDict([
+        ('median', float(np.median(timings))),
+        ('min', float(np.min(timings))),
+        ('max', float(np.max(timings))),
+        ('runs', len(timings)),
+    ])
+    if n_items is not None:
+        res['items'] = n_items
+        res['items_per_s'] = n_items / res['median']
+    results[name] = res
+    print('%-40s %10.4fs (min %.4fs, max %.4fs)' % (name, res['median'], res['min'], res['max']))
+
+
+def machine_info(params):
+    info = OrderedDict([
+        ('platform', platform.platform()),
+        ('processor', platform.processor()),
+        ('python', platform.python_version()),
+        ('cpu_count', os.cpu_count() if hasattr(os, 'cpu_count') else None),
+        ('torch', torch.__version__),
+        ('torch_threads', torch.get_num_threads()),
+        ('numpy', np.__version__),
+        ('faiss', FAISS_AVAILABLE),
+    ])
+    if params.cuda:
+        info['cuda_device'] = torch.cuda.get_device_name(0)
+    return info
+
+
+def build_params(params, src_emb, tgt_emb):
+    """
+    Training parameters of `unsupervised.py`, on the synthetic data.
+    """
+    _params = argparse.Namespace(
+        cuda=params.cuda, exp_path='', src_lang='en', tgt_lang='it', src_emb=src_emb, tgt_emb=tgt_emb,
+        emb_dim=params.emb_dim, max_vocab=params.n_words, normalize_embeddings='', emb_dtype=params.emb_dtype, map_id_init=True, map_beta=0.001,
+        dis_layers=2, dis_hid_dim=params.dis_hid_dim, dis_dropout=0., dis_input_dropout=0.1, dis_steps=5,
+        dis_lambda=1, dis_most_frequent=min(75000, params.n_words), dis_smooth=0.1, dis_clip_weights=0,
+        batch_size=params.batch_size, map_optimizer='sgd,lr=0.1', dis_optimizer='sgd,lr=0.1',
+        dico_method='csls_knn_%i' % params.knn, dico_build='S2T&T2S', dico_threshold=0,
+        dico_max_rank=min(params.dico_max_rank, params.n_words), dico_min_size=0, dico_max_size=0,
+    )
+    return _params
+
+
+def run(params):
+    results = OrderedDict()
+    _params = build_params(params, os.path.abspath('en.vec'), os.path.abspath('it.vec'))
+
+    # embeddings loading
+    timeit('load_external_embeddings', lambda: load_external_embeddings(_params, source=True), params, results,
+           n_items=params.n_words)
+
+    # model / trainer / evaluator
+    src_emb, tgt_emb, mapping, discriminator = build_model(_params, True)
+    trainer = Trainer(src_emb, tgt_emb, mapping, discriminator, _params)
+    evaluator = Evaluator(trainer)
+    W0 = mapping.weight.data.clone()
+
+    def reset_mapping():
+        mapping.weight.data.copy_(W0)
+
+    # adversarial training steps
+    stats = {'DIS_COSTS': []}
+
+    def dis_steps():
+        for _ in range(params.n_steps):
+            trainer.dis_step(stats)
+
+    def mapping_steps():
+        for _ in range(params.n_steps):
+            trainer.mapping_step(stats)
+
+    timeit('dis_step', dis_steps, params, results, n_items=2 * params.n_steps * params.batch_size)
+    timeit('mapping_step', mapping_steps, params, results, setup=reset_mapping,
+           n_items=2 * params.n_steps * params.batch_size)
+    reset_mapping()
+
+    # Hogwild adversarial training: samples/s vs number of worker processes
+    if params.hogwild_workers:
+        share_trainer(trainer)
+
+        def adversarial_step(trainer, stats):
+            for _ in range(_params.dis_steps):
+                trainer.dis_step(stats)
+            return trainer.mapping_step(stats)
+
+        for n_workers in [int(n) for n in params.hogwild_workers.split(',')]:
+            timeit('hogwild.%i_workers' % n_workers,
+                   lambda: hogwild_epoch(trainer, adversarial_step, params.n_steps, n_workers, lambda *args: None),
+                   params, results, setup=reset_mapping, n_items=2 * params.n_steps * params.batch_size)
+            if 'hogwild.%i_workers' % n_workers in results:
+                print('%-40s %10i samples/s' % ('', results['hogwild.%i_workers' % n_workers]['items_per_s']))
+        reset_mapping()
+
+    # Procrustes on the ground-truth training dictionary, so that the next
+    # benchmarks run on well aligned embeddings (as at the end of training)
+    trainer.load_training_dico('default')
+
+    def reset_procrustes():
+        reset_mapping()
+        trainer.procrustes_state = None
+
+    timeit('procrustes', trainer.procrustes, params, results, setup=reset_procrustes)
+    reset_procrustes()
+    trainer.procrustes()
+
+    # nearest neighbors / candidates on the normalized mapped embeddings
+    emb1 = src_emb.mapped(mapping)
+    emb2 = trainer.normalized_tgt_emb()
+    timeit('get_nn_avg_dist', lambda: get_nn_avg_dist(emb2, emb1, params.knn), params, results,
+           n_items=params.n_words)
+    for method in params.dico_methods.split(','):
+        _p = deepcopy(_params)
+        _p.dico_method = method
+        timeit('get_candidates.%s' % method, lambda: get_candidates(emb1, emb2, _p), params, results)
+    s2t_candidates = get_candidates(emb1, emb2, _params)
+    t2s_candidates = get_candidates(emb2, emb1, _params)
+    timeit('build_dictionary', lambda: build_dictionary(emb1, emb2, _params, s2t_candidates, t2s_candidates),
+           params, results)
+
+    # evaluation
+    to_log = OrderedDict()
+    for name in ['monolingual_wordsim', 'crosslingual_wordsim', 'word_translation', 'dist_mean_cosine', 'eval_dis']:
+        timeit('Evaluator.%s' % name, lambda: getattr(evaluator, name)(to_log), params, results)
+    if params.n_europarl > 0:
+        timeit('Evaluator.sent_translation', lambda: evaluator.sent_translation(to_log), params, results)
+
+    # accuracy of the recovered rotation, a sanity check of the timed code
+    accuracy = OrderedDict((k, float(v)) for k, v in to_log.items()
+                           if k.startswith('precision_at_') or k.startswith('mean_cosine'))
+
+    # memory of the embedding tables (and of the normalized copies built for the dictionaries)
+    memory = OrderedDict((name, sum(x.numel() * x.element_size() for x in tensors) / 2. ** 20) for name, tensors in [
+        ('embeddings_mb', [src_emb.weight, tgt_emb.weight]),
+        ('normalized_mb', [emb1, emb2]),
+    ])
+    return results, accuracy, memory
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare median timings with a baseline. Return the list of regressions.
+    """
+    regressions = []
+    pattern = '%-40s %12s %12s %8s'
+    print(pattern % ('Benchmark', 'Baseline', 'Current', 'Ratio'))
+    for name in sorted(set(results) | set(baseline)):
+        if name not in results or name not in baseline:
+            print(pattern % (name, '%.4fs' % baseline[name]['median'] if name in baseline else '-',
+                             '%.4fs' % results[name]['median'] if name in results else '-', ''))
+            continue
+        ratio = results[name]['median'] / max(baseline[name]['median'], 1e-9)
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(pattern % (name, '%.4fs' % baseline[name]['median'], '%.4fs' % results[name]['median'],
+                         '%.2f' % ratio) + flag)
+    return regressions
+
+
+def main():
+    params = parser.parse_args()
+    assert not params.cuda or torch.cuda.is_available()
+    assert params.repeat > 0 and params.n_steps > 0
+    assert params.n_words >= 10000, "dist_mean_cosine needs at least 10000 words"
+    assert params.emb_dtype in EMB_DTYPES
+
+    # generate the synthetic data, and run from there (evaluation files use relative paths)
+    cwd = os.getcwd()
+    work_dir = params.work_dir or tempfile.mkdtemp(prefix='bench_')
+    print('Generating %i x %i synthetic embeddings in %s ...' % (params.n_words, params.emb_dim, work_dir))
+    generate(work_dir, n_words=params.n_words, emb_dim=params.emb_dim, noise=params.noise,
+             n_europarl=params.n_europarl, seed=params.seed)
+    os.chdir(work_dir)
+    torch.manual_seed(params.seed)
+    try:
+        results, accuracy, memory = run(params)
+    finally:
+        os.chdir(cwd)
+        if not params.work_dir:
+            shutil.rmtree(work_dir)
+
+    report = OrderedDict([
+        ('machine', machine_info(params)),
+        ('config', OrderedDict((k, v) for k, v in sorted(vars(params).items())
+                               if k not in ['output', 'baseline', 'save_baseline', 'work_dir'])),
+        ('results', results),
+        ('accuracy', accuracy),
+        ('memory', memory),
+    ])
+    print(json.dumps(accuracy))
+    print(json.dumps(memory))
+    for path in [params.output, params.save_baseline]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+            print('Results written to %s' % path)
+
+    # regressions against the baseline
+    if params.baseline:
+        baseline = json.load(open(params.baseline))
+        if baseline['config'] != report['config']:
+            print('Warning: the baseline was run with a different configuration: %s' % json.dumps(baseline['config']))
+        regressions = compare(results, baseline['results'], params.tolerance)
+        if regressions:
+            print('%i regression(s) above %i%%: %s' % (len(regressions), 100 * params.tolerance, ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import os
+import numpy as np
+
+
+def random_rotation(dim, rng):
+    """
+    Random orthogonal matrix (QR decomposition of a gaussian matrix).
+    """
+    q, r = np.linalg.qr(rng.randn(dim, dim))
+    return q * np.sign(np.diag(r))[None, :]
+
+
+def write_vec(path, words, vectors):
+    """
+    Write embeddings in the fastText .vec text format.
+    """
+    with open(path, 'w') as f:
+        f.write('%i %i\n' % vectors.shape)
+        for word, vect in zip(words, vectors):
+            f.write('%s %s\n' % (word, ' '.join('%.5f' % x for x in vect)))
+
+
+def write_pairs(path, words1, words2, ids):
+    with open(path, 'w') as f:
+        for i in ids:
+            f.write('%s %s\n' % (words1[i], words2[i]))
+
+
+def write_wordsim(path, words1, vectors1, words2, vectors2, n_pairs, rng):
+    """
+    Write a word similarity file whose gold scores are noisy cosines.
+    """
+    ids1 = rng.randint(len(words1), size=n_pairs)
+    ids2 = rng.randint(len(words2), size=n_pairs)
+    u = vectors1[ids1] / np.linalg.norm(vectors1[ids1], axis=1, keepdims=True)
+    v = vectors2[ids2] / np.linalg.norm(vectors2[ids2], axis=1, keepdims=True)
+    scores = (u * v).sum(1) + 0.1 * rng.randn(n_pairs)
+    with open(path, 'w') as f:
+        for i, j, s in zip(ids1, ids2, scores):
+            f.write('%s\t%s\t%.4f\n' % (words1[i], words2[j], s))
+
+
+def write_europarl(path1, path2, words1, words2, n_sentences, rng, length=10):
+    """
+    Write parallel sentences: the same word ids in both languages.
+    """
+    with open(path1, 'w') as f1, open(path2, 'w') as f2:
+        for _ in range(n_sentences):
+            # zipf-like sampling, frequent words first
+            ids = np.minimum(rng.zipf(1.3, size=length) - 1, len(words1) - 1)
+            f1.write(' '.join(words1[i] for i in ids) + '\n')
+            f2.write(' '.join(words2[i] for i in ids) + '\n')
+
+
+def generate(path, src_lang='en', tgt_lang='it', n_words=20000, emb_dim=300,
+             noise=0.1, n_europarl=0, seed=0):
+    """
+    Generate a synthetic pair of embeddings where the target space is a known
+    rotation of the source space (plus gaussian noise), with the evaluation
+    files expected by `src.evaluation` laid out under `path`/data.
+    Word i of the source language translates to word i of the target language.
+    Returns the paths of the source / target embeddings and the rotation.
+    """
+    assert n_words >= 6500, "the evaluation dictionaries need at least 6500 words"
+    rng = np.random.RandomState(seed)
+    src_words = ['%s%i' % (src_lang, i) for i in range(n_words)]
+    tgt_words = ['%s%i' % (tgt_lang, i) for i in range(n_words)]
+    src_vectors = rng.randn(n_words, emb_dim).astype(np.float32)
+    rotation = random_rotation(emb_dim, rng).astype(np.float32)
+    tgt_vectors = src_vectors.dot(rotation) + noise * rng.randn(n_words, emb_dim).astype(np.float32)
+
+    # embeddings
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    src_emb = os.path.join(path, '%s.vec' % src_lang)
+    tgt_emb = os.path.join(path, '%s.vec' % tgt_lang)
+    write_vec(src_emb, src_words, src_vectors)
+    write_vec(tgt_emb, tgt_words, tgt_vectors)
+
+    # bilingual dictionaries (train / test splits of MUSE)
+    dico_path = os.path.join(path, 'data', 'crosslingual', 'dictionaries')
+    if not os.path.isdir(dico_path):
+        os.makedirs(dico_path)
+    for (lg1, w1, lg2, w2) in [(src_lang, src_words, tgt_lang, tgt_words),
+                               (tgt_lang, tgt_words, src_lang, src_words)]:
+        write_pairs(os.path.join(dico_path, '%s-%s.0-5000.txt' % (lg1, lg2)), w1, w2, range(5000))
+        write_pairs(os.path.join(dico_path, '%s-%s.5000-6500.txt' % (lg1, lg2)), w1, w2, range(5000, 6500))
+
+    # monolingual / cross-lingual word similarity
+    for lg, words, vectors in [(src_lang, src_words, src_vectors), (tgt_lang, tgt_words, tgt_vectors)]:
+        ws_path = os.path.join(path, 'data', 'monolingual', lg)
+        if not os.path.isdir(ws_path):
+            os.makedirs(ws_path)
+        write_wordsim(os.path.join(ws_path, '%s_SYNTHETIC.txt' % lg.upper()),
+                      words, vectors, words, vectors, 1000, rng)
+    # gold cross-lingual scores are computed in the source space
+    aligned = sorted([(src_lang, src_words, src_vectors), (tgt_lang, tgt_words, tgt_vectors.dot(rotation.T))])
+    (lg1, w1, v1), (lg2, w2, v2) = aligned
+    ws_path = os.path.join(path, 'data', 'crosslingual', 'wordsim', '%s-%s' % (lg1, lg2))
+    if not os.path.isdir(ws_path):
+        os.makedirs(ws_path)
+    write_wordsim(os.path.join(ws_path, '%s-%s_SEMEVAL17.txt' % (lg1.upper(), lg2.upper())),
+                  w1, v1, w2, v2, 1000, rng)
+
+    # parallel sentences (the sentence translation evaluation needs at least 200000)
+    if n_europarl > 0:
+        europarl_path = os.path.join(path, 'data', 'crosslingual', 'europarl')
+        if not os.path.isdir(europarl_path):
+            os.makedirs(europarl_path)
+        prefix = os.path.join(europarl_path, 'europarl-v7.%s-%s.' % (src_lang, tgt_lang))
+        write_europarl(prefix + src_lang, prefix + tgt_lang, src_words, tgt_words, n_europarl, rng)
+
+    return src_emb, tgt_emb, rotation
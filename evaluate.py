@@ -11,7 +11,7 @@ import os
 import argparse
 from collections import OrderedDict
 
-from src.utils import bool_flag, initialize_exp
+from src.utils import bool_flag, initialize_exp, EMB_DTYPES
 from src.models import build_model
 from src.trainer import Trainer
 from src.evaluation import Evaluator
@@ -30,6 +30,8 @@ parser.add_argument("--tgt_emb", type=str, default="", help="Reload target embed
 parser.add_argument("--max_vocab", type=int, default=200000, help="Maximum vocabulary size")
 parser.add_argument("--emb_dim", type=int, default=300, help="Embedding dimension")
 parser.add_argument("--normalize_embeddings", type=str, default="", help="Normalize embeddings before training")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+parser.add_argument("--restrict_vocab", type=bool_flag, default=False, help="Only load the most frequent words used for training, and the words of the training / evaluation dictionaries (evaluations then search among these words)")
 
 
 # parse parameters
@@ -39,6 +41,7 @@ params = parser.parse_args()
 assert params.src_lang, "source language undefined"
 assert os.path.isfile(params.src_emb)
 assert not params.tgt_lang or os.path.isfile(params.tgt_emb)
+assert params.emb_dtype in EMB_DTYPES
 
 # build logger / model / trainer / evaluator
 logger = initialize_exp(params)
@@ -18,32 +18,50 @@ class FastVector:
     ```
     """
 
-    def __init__(self, vector_file='', transform=None):
-        """Read in word vectors in fasttext format"""
-        self.word2id = {}
+    def __init__(self, vector_file='', transform=None, dtype=np.float32, max_words=0):
+        """
+        Read in word vectors in fasttext format
 
-        # Captures word order, for export() and translate methods
-        self.id2word = []
+        Vectors are stored as `dtype` (float32 by default, which halves the
+        memory of a full fastText dump compared to float64), and only the
+        first `max_words` vectors are read when `max_words > 0`.
+        """
+        self.word2id = {}
 
         print('reading word vectors from %s' % vector_file)
         with open(vector_file, 'r') as f:
             (self.n_words, self.n_dim) = \
                 (int(x) for x in f.readline().rstrip('\n').split(' '))
-            self.embed = np.zeros((self.n_words, self.n_dim))
-            for i, line in enumerate(f):
-                elems = line.rstrip('\n').split(' ')
-                self.word2id[elems[0]] = i
-                self.embed[i] = elems[1:self.n_dim+1]
-                self.id2word.append(elems[0])
-        
+            if max_words > 0:
+                self.n_words = min(self.n_words, max_words)
+            self.embed = np.empty((self.n_words, self.n_dim), dtype=dtype)
+            words = StringTable.builder(self.n_words)
+            n_read = 0
+            for line in f:
+                if n_read == self.n_words:
+                    break
+                word, vect = line.rstrip('\n').split(' ', 1)
+                self.word2id[word] = n_read
+                self.embed[n_read] = np.fromstring(vect, sep=' ', dtype=dtype)[:self.n_dim]
+                words.append(word)
+                n_read += 1
+
+        # the header may announce more words than the file actually contains
+        if n_read < self.n_words:
+            self.n_words = n_read
+            self.embed = self.embed[:n_read]
+
+        # Captures word order, for export() and translate methods
+        self.id2word = words.build()
+
         # Used in translate_inverted_softmax()
         self.softmax_denominators = None
-        
+
         if transform is not None:
             print('Applying transformation to embedding')
             self.apply_transform(transform)
 
-    def apply_transform(self, transform):
+    def apply_transform(self, transform, block_size=65536):
         """
         Apply the given transformation to the vector space
 
@@ -53,9 +71,20 @@ class FastVector:
         Transform can either be a string with a filename to a
         text file containing a ndarray (compat. with np.loadtxt)
         or a numpy ndarray.
+
+        Square transforms are applied in place, `block_size` rows at a time,
+        so the peak memory overhead is a single block instead of a second
+        copy of the whole matrix.
         """
         transmat = np.loadtxt(transform) if isinstance(transform, str) else transform
-        self.embed = np.matmul(self.embed, transmat)
+        transmat = np.asarray(transmat, dtype=self.embed.dtype)
+        if transmat.shape != (self.n_dim, self.n_dim):
+            self.embed = np.matmul(self.embed, transmat)
+            self.n_dim = self.embed.shape[1]
+            return
+        for i in range(0, self.n_words, block_size):
+            block = self.embed[i:i + block_size]
+            block[...] = np.matmul(block, transmat)
 
     def export(self, outpath):
         """
@@ -144,3 +173,61 @@ class FastVector:
 
     def __getitem__(self, key):
         return self.embed[self.word2id[key]]
+
+
+class StringTable(object):
+    """
+    Compact, read-only list of strings.
+
+    All strings are stored UTF-8 encoded in a single contiguous byte buffer,
+    with an offsets array delimiting them, instead of one Python object per
+    word. Supports `len`, indexing and iteration like a list.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def builder(cls, size_hint=0):
+        return _StringTableBuilder(size_hint)
+
+    @classmethod
+    def from_list(cls, strings):
+        builder = cls.builder(len(strings))
+        for s in strings:
+            builder.append(s)
+        return builder.build()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('string table index out of range')
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class _StringTableBuilder(object):
+
+    def __init__(self, size_hint):
+        self.blob = bytearray()
+        self.offsets = np.zeros(size_hint + 1, dtype=np.int64)
+        self.size = 0
+
+    def append(self, s):
+        if self.size + 1 == len(self.offsets):
+            self.offsets = np.concatenate([self.offsets, np.zeros(len(self.offsets), dtype=np.int64)])
+        self.blob.extend(s if isinstance(s, bytes) else s.encode('utf-8'))
+        self.size += 1
+        self.offsets[self.size] = len(self.blob)
+
+    def build(self):
+        blob = np.frombuffer(bytes(self.blob), dtype=np.uint8)
+        return StringTable(blob, self.offsets[:self.size + 1].copy())
@@ -0,0 +1,196 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# python lexicon.py --src_emb data/wiki.en.vec --tgt_emb data/wiki.es.vec --exp_path dumped/30cxvylr8w --max_vocab 0 --n_workers 8
+# zcat dumped/30cxvylr8w/lexicon/s2t.00000.tsv.gz | head
+
+import io
+import os
+import json
+import time
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+import torch
+
+from src.utils import bool_flag
+from src.logger import create_logger
+from src.serving import DIRECTIONS, load_embedding_cache, find_mappings
+from src.retrieval import parse_method
+from src.lexicon import FORMATS, shards, shard_path, prepare_matrix, init_worker, run_job
+
+
+# main
+parser = argparse.ArgumentParser(description='Bilingual lexicon induction')
+parser.add_argument("--verbose", type=int, default=1, help="Verbose level (2:debug, 1:info, 0:warning)")
+parser.add_argument("--exp_path", type=str, default="", help="Experiment directory with the best mappings")
+parser.add_argument("--output", type=str, default="", help="Output directory (default: exp_path/lexicon)")
+# data
+parser.add_argument("--src_emb", type=str, default="", help="Source embeddings")
+parser.add_argument("--tgt_emb", type=str, default="", help="Target embeddings")
+parser.add_argument("--max_vocab", type=int, default=0, help="Maximum vocabulary size (0 to disable)")
+parser.add_argument("--cache_dir", type=str, default="./data/cache", help="Where to store the binary embeddings")
+# lexicon
+parser.add_argument("--directions", type=str, default="s2t,t2s", help="Directions to translate (s2t,t2s)")
+parser.add_argument("--method", type=str, default="csls_knn_10", help="Retrieval method (nn/csls_knn_10)")
+parser.add_argument("--k", type=int, default=10, help="Translations per word")
+parser.add_argument("--format", type=str, default="tsv", help="Shard format (tsv: gzipped word/translation/score lines, npz: target IDs and scores)")
+parser.add_argument("--shard_size", type=int, default=100000, help="Source words per shard")
+parser.add_argument("--keep_work", type=bool_flag, default=False, help="Keep the normalized embeddings and radii once done")
+# performance
+parser.add_argument("--n_workers", type=int, default=1, help="Worker processes")
+parser.add_argument("--bs", type=int, default=1024, help="Queries scored at a time")
+parser.add_argument("--key_bs", type=int, default=65536, help="Keys scored at a time")
+
+
+# parse parameters
+params = parser.parse_args()
+
+# check parameters
+assert os.path.isfile(params.src_emb)
+assert os.path.isfile(params.tgt_emb)
+assert os.path.isdir(params.exp_path)
+assert params.format in FORMATS
+assert all(d in DIRECTIONS for d in params.directions.split(','))
+assert params.k > 0 and params.shard_size > 0 and params.n_workers > 0
+knn = parse_method(params.method)
+
+# output / logger
+params.output = params.output or os.path.join(params.exp_path, 'lexicon')
+work_dir = os.path.join(params.output, 'work')
+if not os.path.isdir(work_dir):
+    os.makedirs(work_dir)
+logger = create_logger(os.path.join(params.output, 'lexicon.log'), vb=params.verbose)
+logger.info('\n'.join('%s: %s' % (k, str(v)) for k, v in sorted(dict(vars(params)).items())))
+
+# mappings
+mappings = find_mappings(params.exp_path)
+directions = [d for d in params.directions.split(',') if d in mappings]
+assert len(directions) > 0, 'no mapping found in %s' % params.exp_path
+for d in params.directions.split(','):
+    if d not in mappings:
+        logger.warning('No %s mapping in %s' % (d, params.exp_path))
+
+# a resumed run has to produce the same lexicon
+manifest = {
+    'src_emb': os.path.abspath(params.src_emb),
+    'tgt_emb': os.path.abspath(params.tgt_emb),
+    'max_vocab': params.max_vocab,
+    'method': params.method,
+    'k': params.k,
+    'format': params.format,
+    'shard_size': params.shard_size,
+    'mappings': dict((d, [mappings[d][0], os.path.getmtime(mappings[d][0]), mappings[d][1]]) for d in directions),
+}
+manifest_path = os.path.join(params.output, 'lexicon.json')
+if os.path.isfile(manifest_path):
+    previous = json.load(open(manifest_path))
+    assert all(previous.get(k) == manifest[k] for k in manifest if k != 'mappings') and \
+        all(previous['mappings'].get(d) == v for d, v in manifest['mappings'].items()), \
+        'parameters / mappings differ from the run stored in %s: remove it to start over' % params.output
+    manifest['mappings'].update(previous['mappings'])
+with open(manifest_path, 'w') as f:
+    json.dump(manifest, f, indent=2)
+
+# normalized embeddings / mapped queries, memory-mapped by the workers
+tic = time.time()
+vocab = {}
+for name, path in [('src', params.src_emb), ('tgt', params.tgt_emb)]:
+    words, emb = load_embedding_cache(path, params.max_vocab, params.cache_dir)
+    vocab[name] = len(words)
+    vocab_path = os.path.join(work_dir, '%s.vocab' % name)
+    if not os.path.isfile(vocab_path):
+        with io.open(vocab_path + '.tmp', 'w', encoding='utf-8') as f:
+            for word in words:
+                f.write(word + u'\n')
+        os.rename(vocab_path + '.tmp', vocab_path)
+    prepare_matrix(os.path.join(work_dir, '%s.npy' % name), emb)
+config = {
+    'output': params.output,
+    'work_dir': work_dir,
+    'format': params.format,
+    'k': params.k,
+    'knn': knn,
+    'bs': params.bs,
+    'key_bs': params.key_bs,
+    'directions': {},
+}
+for d in directions:
+    src, tgt = ('src', 'tgt') if d == 's2t' else ('tgt', 'src')
+    path, transpose = mappings[d]
+    W = torch.from_numpy(torch.load(path)).float()
+    W = W.transpose(0, 1).contiguous() if transpose else W
+    queries = os.path.join(work_dir, 'queries.%s.npy' % d)
+    prepare_matrix(queries, np.load(os.path.join(work_dir, '%s.npy' % src), mmap_mode='r'), W)
+    config['directions'][d] = {
+        'queries': queries,
+        'keys': os.path.join(work_dir, '%s.npy' % tgt),
+        'key_radii': os.path.join(work_dir, 'key_radii.%s.npy' % d),
+        'src_vocab': os.path.join(work_dir, '%s.vocab' % src),
+        'tgt_vocab': os.path.join(work_dir, '%s.vocab' % tgt),
+        'n_queries': vocab[src],
+        'n_keys': vocab[tgt],
+    }
+logger.info('Prepared the embeddings in %.2fs' % (time.time() - tic))
+
+
+def run_jobs(jobs):
+    """
+    Run jobs in the worker processes (or in this one), yielding their results.
+    """
+    n_threads = max(1, torch.get_num_threads() // params.n_workers)
+    if params.n_workers == 1:
+        init_worker(config, n_threads)
+        for job in jobs:
+            yield run_job(job)
+        return
+    pool = multiprocessing.Pool(params.n_workers, init_worker, (config, n_threads))
+    try:
+        for result in pool.imap_unordered(run_job, jobs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# CSLS radii of the keys, computed by shards (then merged)
+if knn > 0:
+    jobs = [('key_radii', (d, i, start, end)) for d in directions
+            if not os.path.isfile(config['directions'][d]['key_radii'])
+            for i, start, end in shards(config['directions'][d]['n_keys'], params.shard_size)]
+    tic = time.time()
+    paths = {}
+    for _, (d, i, _, _), path in run_jobs(jobs):
+        paths.setdefault(d, {})[i] = path
+    for d, shard_paths in paths.items():
+        radii = np.concatenate([np.load(shard_paths[i]) for i in sorted(shard_paths)])
+        with open(config['directions'][d]['key_radii'] + '.tmp', 'wb') as f:
+            np.save(f, radii)
+        os.rename(config['directions'][d]['key_radii'] + '.tmp', config['directions'][d]['key_radii'])
+        for path in shard_paths.values():
+            os.remove(path)
+    if jobs:
+        logger.info('Computed the CSLS radii of %i keys in %.2fs'
+                    % (sum(end - start for _, (_, _, start, end) in jobs), time.time() - tic))
+
+# translations, one shard at a time
+jobs = [('translate', (d, i, start, end)) for d in directions
+        for i, start, end in shards(config['directions'][d]['n_queries'], params.shard_size)]
+done = [job for job in jobs if os.path.isfile(shard_path(params.output, job[1][0], job[1][1], params.format))]
+if done:
+    logger.info('Resuming: %i / %i shards already done' % (len(done), len(jobs)))
+tic = time.time()
+n_words = 0
+for i, (_, (d, shard_id, _, _), (path, n)) in enumerate(run_jobs([job for job in jobs if job not in done])):
+    n_words += n
+    logger.info('%i / %i - Wrote %s (%.1f words/s)' % (len(done) + i + 1, len(jobs), path,
+                                                        n_words / max(time.time() - tic, 1e-6)))
+
+if not params.keep_work:
+    shutil.rmtree(work_dir)
+logger.info('Done: %s lexicons in %s' % (', '.join(directions), params.output))
@@ -0,0 +1,400 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# python multilingual.py --pivot_lang en --pivot_emb data/wiki.en.vec --spoke_langs es,fr,de,it --spoke_embs data/wiki.es.vec,data/wiki.fr.vec,data/wiki.de.vec,data/wiki.it.vec --n_workers 2 --refinement True
+
+import os
+import time
+import json
+import argparse
+from collections import OrderedDict
+from copy import deepcopy
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from src.utils import bool_flag, initialize_exp, get_exp_path, load_external_embeddings, normalize_embeddings, cast_embeddings, EMB_DTYPES
+from src.autotune import initialize_autotuner
+from src.logger import create_logger
+from src.models import build_model, build_model_cycle
+from src.trainer import Trainer
+from src.trainer_Cycle import Trainer_Cycle
+from src.procrustes import refinement_converged
+from src.evaluation import Evaluator, Evaluator_Cycle
+from src.evaluation.wordsim import get_wordsim_scores
+
+VALIDATION_METRIC = 'mean_cosine-csls_knn_10-S2T-10000'
+RESULTS_FILE = 'results.json'
+
+
+# main
+parser = argparse.ArgumentParser(description='Hub-and-spoke multilingual training')
+parser.add_argument("--seed", type=int, default=-1, help="Initialization seed")
+parser.add_argument("--verbose", type=int, default=2, help="Verbose level (2:debug, 1:info, 0:warning)")
+parser.add_argument("--exp_path", type=str, default="", help="Where to store experiment logs and models")
+parser.add_argument("--cuda", type=bool_flag, default=True, help="Run on GPU")
+parser.add_argument("--export", type=bool_flag, default=False, help="Export embeddings after training")
+parser.add_argument("--export_format", type=str, default="txt", help="Export format (txt: text files of the vectors, store: mapped stores referencing the embedding files)")
+# languages
+parser.add_argument("--pivot_lang", type=str, default='en', help="Pivot language (the target of every spoke)")
+parser.add_argument("--pivot_emb", type=str, default="", help="Pivot embeddings")
+parser.add_argument("--spoke_langs", type=str, default="", help="Spoke languages (comma separated)")
+parser.add_argument("--spoke_embs", type=str, default="", help="Spoke embeddings (comma separated, in the order of --spoke_langs)")
+parser.add_argument("--model", type=str, default="single", help="Mapping of each spoke (single: Trainer, cycle: Trainer_Cycle)")
+parser.add_argument("--retrain", type=bool_flag, default=False, help="Retrain the spokes already trained in exp_path")
+parser.add_argument("--n_workers", type=int, default=1, help="Spokes trained concurrently (1: sequentially)")
+parser.add_argument("--threads_per_run", type=int, default=4, help="CPU threads of each spoke (if n_workers > 1)")
+# data
+parser.add_argument("--emb_dim", type=int, default=300, help="Embedding dimension")
+parser.add_argument("--max_vocab", type=int, default=200000, help="Maximum vocabulary size")
+# mapping
+parser.add_argument("--map_id_init", type=bool_flag, default=True, help="Initialize the mapping as an identity matrix")
+parser.add_argument("--map_beta", type=float, default=0.001, help="Beta for orthogonalization")
+# cycle consistency
+parser.add_argument("--lambda_a", type=int, default=10, help="Cycle consistency loss feedback coefficient from src to src")
+parser.add_argument("--lambda_b", type=int, default=10, help="Cycle consistency loss feedback coefficient from tgt to tgt")
+parser.add_argument("--cc_method", type=str, default='default', help="The method to calculate cycle consistency")
+# discriminator
+parser.add_argument("--dis_layers", type=int, default=2, help="Discriminator layers")
+parser.add_argument("--dis_hid_dim", type=int, default=2048, help="Discriminator hidden layer dimensions")
+parser.add_argument("--dis_dropout", type=float, default=0., help="Discriminator dropout")
+parser.add_argument("--dis_input_dropout", type=float, default=0.1, help="Discriminator input dropout")
+parser.add_argument("--dis_steps", type=int, default=5, help="Discriminator steps")
+parser.add_argument("--dis_lambda", type=float, default=1, help="Discriminator loss feedback coefficient")
+parser.add_argument("--dis_most_frequent", type=int, default=75000, help="Select embeddings of the k most frequent words for discrimination (0 to disable)")
+parser.add_argument("--dis_smooth", type=float, default=0.1, help="Discriminator smooth predictions")
+parser.add_argument("--dis_clip_weights", type=float, default=0, help="Clip discriminator weights (0 to disable)")
+# training adversarial
+parser.add_argument("--adversarial", type=bool_flag, default=True, help="Use adversarial training")
+parser.add_argument("--n_epochs", type=int, default=5, help="Number of epochs")
+parser.add_argument("--epoch_size", type=int, default=1000000, help="Iterations per epoch")
+parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+parser.add_argument("--map_optimizer", type=str, default="sgd,lr=0.1", help="Mapping optimizer")
+parser.add_argument("--dis_optimizer", type=str, default="sgd,lr=0.1", help="Discriminator optimizer")
+parser.add_argument("--lr_decay", type=float, default=0.98, help="Learning rate decay (SGD only)")
+parser.add_argument("--min_lr", type=float, default=1e-6, help="Minimum learning rate (SGD only)")
+parser.add_argument("--lr_shrink", type=float, default=0.5, help="Shrink the learning rate if the validation metric decreases (1 to disable)")
+# training refinement
+parser.add_argument("--refinement", type=bool_flag, default=False, help="Use iterative Procrustes refinement")
+parser.add_argument("--n_iters", type=int, default=5, help="Number of iterations")
+parser.add_argument("--refine_min_overlap", type=float, default=1, help="Stop the refinement once the dictionary overlap with the previous iteration is above this value")
+parser.add_argument("--refine_max_delta", type=float, default=0, help="and the relative change of the mapping below this one (by default: once the dictionary is unchanged)")
+# dictionary creation parameters (for refinement)
+parser.add_argument("--dico_method", type=str, default='csls_knn_10', help="Method used for dictionary generation (nn/invsm_beta_30/csls_knn_10)")
+parser.add_argument("--dico_build", type=str, default='S2T&T2S', help="S2T,T2S,S2T|T2S,S2T&T2S")
+parser.add_argument("--dico_threshold", type=float, default=0, help="Threshold confidence for dictionary generation")
+parser.add_argument("--dico_max_rank", type=int, default=15000, help="Maximum dictionary words rank (0 to disable)")
+parser.add_argument("--dico_min_size", type=int, default=0, help="Minimum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_max_size", type=int, default=0, help="Maximum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_index", type=str, default="", help="Approximate candidates search with a PQ index, e.g. pq,code_size=50,n_lists=1024,nprobe=16,shortlist=100 (empty for exact search)")
+parser.add_argument("--autotune", type=bool_flag, default=True, help="Benchmark the block sizes of the similarity kernels on first use (cached per machine and shape)")
+parser.add_argument("--autotune_memory", type=int, default=1024, help="Memory budget of a block of similarity scores, in MB")
+parser.add_argument("--autotune_cache", type=str, default="", help="Block sizes cache file (default: ~/.cache/unsupervised_word_mapping/block_sizes.json)")
+parser.add_argument("--normalize_embeddings", type=str, default="", help="Normalize embeddings before training")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+
+
+# pivot data, loaded once and shared with the spokes (set before forking the workers)
+SHARED = {}
+
+
+def load_pivot(params):
+    """
+    Load the pivot embeddings / dictionary, and the pivot-side data that
+    does not depend on the spokes: the normalized embeddings (used to build
+    the dictionaries / export) and the monolingual word similarity scores.
+    """
+    _params = deepcopy(params)
+    _params.cuda = False
+    _params.tgt_lang = params.pivot_lang
+    _params.tgt_emb = params.pivot_emb
+    pivot_dico, pivot_emb = load_external_embeddings(_params, source=False)
+    normalize_embeddings(pivot_emb, params.normalize_embeddings)
+    pivot_normalized = pivot_emb / pivot_emb.norm(2, 1, keepdim=True).expand_as(pivot_emb)
+    ws_scores = get_wordsim_scores(params.pivot_lang, pivot_dico.word2id, pivot_emb.numpy())
+    pivot_emb = cast_embeddings(pivot_emb, params.emb_dtype)
+    pivot_normalized = cast_embeddings(pivot_normalized, params.emb_dtype)
+    return pivot_dico, pivot_emb.share_memory_(), pivot_normalized.share_memory_(), ws_scores
+
+
+def spoke_params(params, spoke):
+    """
+    Parameters of a spoke -> pivot run.
+    """
+    _params = deepcopy(params)
+    _params.src_lang = spoke
+    _params.tgt_lang = params.pivot_lang
+    _params.src_emb = dict(zip(params.spoke_langs.split(','), params.spoke_embs.split(',')))[spoke]
+    _params.tgt_emb = params.pivot_emb
+    _params.exp_path = os.path.join(params.exp_path, '%s-%s' % (spoke, params.pivot_lang))
+    return _params
+
+
+def train_single(trainer, evaluator, params, logger):
+    """
+    Adversarial training / refinement of a Trainer (as in `unsupervised_single.py`).
+    """
+    if params.adversarial:
+        for n_epoch in range(params.n_epochs):
+            logger.info('Starting adversarial training epoch %i...' % n_epoch)
+            tic = time.time()
+            stats = {'DIS_COSTS': []}
+            for n_iter in range(0, params.epoch_size, params.batch_size):
+                for _ in range(params.dis_steps):
+                    trainer.dis_step(stats)
+                trainer.mapping_step(stats)
+            logger.info('Discriminator loss: %.4f - %i samples/s'
+                        % (np.mean(stats['DIS_COSTS']), int(2 * params.epoch_size / (time.time() - tic))))
+
+            to_log = OrderedDict({'n_epoch': n_epoch})
+            evaluator.all_eval(to_log)
+            evaluator.eval_dis(to_log)
+            logger.info("__log__:%s" % json.dumps(to_log))
+            trainer.save_best(to_log, VALIDATION_METRIC)
+            logger.info('End of epoch %i.\n\n' % n_epoch)
+
+            trainer.update_lr(to_log, VALIDATION_METRIC)
+            if trainer.map_optimizer.param_groups[0]['lr'] < params.min_lr:
+                logger.info('Learning rate < 1e-6. BREAK.')
+                break
+
+    if params.refinement:
+        trainer.reload_best()
+        for n_iter in range(params.n_iters):
+            logger.info('Starting refinement iteration %i...' % n_iter)
+            trainer.build_dictionary()
+            stats = trainer.procrustes()
+            to_log = OrderedDict({'n_iter': n_iter})
+            to_log.update(('refine_%s' % k, v) for k, v in stats.items())
+            evaluator.all_eval(to_log)
+            logger.info("__log__:%s" % json.dumps(to_log))
+            trainer.save_best(to_log, VALIDATION_METRIC)
+            logger.info('End of refinement iteration %i.\n\n' % n_iter)
+            if refinement_converged(stats, params):
+                logger.info('The refinement dictionary / mapping converged. BREAK.')
+                break
+
+    trainer.reload_best()
+    to_log = OrderedDict()
+    evaluator.all_eval(to_log)
+    return [('', to_log)]
+
+
+def train_cycle(trainer, evaluator1, evaluator2, params, logger):
+    """
+    Adversarial training / refinement of a Trainer_Cycle (as in `sweep.py`).
+    """
+    if params.adversarial:
+        for n_epoch in range(params.n_epochs):
+            logger.info('Starting adversarial training epoch %i...' % n_epoch)
+            tic = time.time()
+            stats = {'DIS_A_COSTS': [], 'DIS_B_COSTS': [], 'GAN_A_COSTS': [], 'GAN_B_COSTS': [], 'CYC_A_COSTS': [], 'CYC_B_COSTS': []}
+            for n_iter in range(0, params.epoch_size, params.batch_size):
+                for _ in range(params.dis_steps):
+                    trainer.dis_step(stats, False)
+                    trainer.dis_step(stats, True)
+                trainer.mapping_step(stats, False)
+                trainer.mapping_step(stats, True)
+            logger.info('%i samples/s' % int(2 * params.epoch_size / (time.time() - tic)))
+
+            to_log1 = OrderedDict({'n_epoch': n_epoch})
+            to_log2 = OrderedDict({'n_epoch': n_epoch})
+            evaluator1.all_eval(to_log1)
+            evaluator2.all_eval(to_log2)
+            logger.info("__log__:%s" % json.dumps(to_log1))
+            logger.info("__log__:%s" % json.dumps(to_log2))
+            trainer.save_best(to_log1, VALIDATION_METRIC)
+            logger.info('End of epoch %i.\n\n' % n_epoch)
+
+            trainer.update_lr(to_log1, VALIDATION_METRIC)
+            if min(trainer.map_optimizer(True).param_groups[0]['lr'],
+                   trainer.map_optimizer(False).param_groups[0]['lr']) < params.min_lr:
+                logger.info('Learning rate < 1e-6. BREAK.')
+                break
+
+    if params.refinement:
+        trainer.reload_best()
+        for n_iter in range(params.n_iters):
+            logger.info('Starting refinement iteration %i...' % n_iter)
+            trainer.build_dictionary(True)
+            stats1 = trainer.procrustes(True)
+            trainer.build_dictionary(False)
+            stats2 = trainer.procrustes(False)
+            to_log1 = OrderedDict({'n_iter': n_iter})
+            to_log1.update(('refine_%s' % k, v) for k, v in stats1.items())
+            evaluator1.dist_mean_cosine(to_log1)
+            logger.info("__log__:%s" % json.dumps(to_log1))
+            trainer.save_best(to_log1, VALIDATION_METRIC)
+            if refinement_converged(stats1, params) and refinement_converged(stats2, params):
+                logger.info('The refinement dictionary / mapping converged. BREAK.')
+                break
+
+    trainer.reload_best()
+    to_log1 = OrderedDict()
+    to_log2 = OrderedDict()
+    evaluator1.all_eval(to_log1)
+    evaluator2.all_eval(to_log2)
+    return [('_t', to_log1), ('_f', to_log2)]
+
+
+def run_spoke(spoke):
+    """
+    Train the mapping of one spoke to the pivot, with the shared pivot data.
+    """
+    params = spoke_params(SHARED['params'], spoke)
+    if not os.path.isdir(params.exp_path):
+        os.makedirs(params.exp_path)
+    if SHARED['params'].n_workers > 1:
+        torch.set_num_threads(params.threads_per_run)
+    logger = initialize_exp(params)
+    initialize_autotuner(params)
+    logger.info('Training %s -> %s' % (spoke, params.pivot_lang))
+
+    # only the spoke embeddings are loaded
+    pivot_dico, pivot_emb, pivot_normalized, pivot_ws_scores = SHARED['pivot']
+    _params = deepcopy(params)
+    _params.cuda = False
+    spoke_dico, spoke_emb = load_external_embeddings(_params, source=True)
+    normalize_embeddings(spoke_emb, params.normalize_embeddings)
+    shared_embeddings = (spoke_dico, spoke_emb, pivot_dico, pivot_emb)
+
+    if params.model == 'single':
+        src_emb, tgt_emb, mapping, discriminator = build_model(params, True, shared_embeddings=shared_embeddings)
+        trainer = Trainer(src_emb, tgt_emb, mapping, discriminator, params)
+        evaluator = Evaluator(trainer)
+        evaluator.tgt_ws_scores = pivot_ws_scores
+    else:
+        models = build_model_cycle(params, True, True, shared_embeddings=shared_embeddings)
+        trainer = Trainer_Cycle(*(models + (params,)))
+        params2 = deepcopy(params)
+        params2.src_emb, params2.tgt_emb = params.tgt_emb, params.src_emb
+        params2.src_lang, params2.tgt_lang = params.tgt_lang, params.src_lang
+        evaluator1 = Evaluator_Cycle(trainer, params, True)
+        evaluator2 = Evaluator_Cycle(trainer, params2, False)
+        evaluator1.tgt_ws_scores = pivot_ws_scores
+    trainer.tgt_emb_normalized = pivot_normalized.cuda() if params.cuda else pivot_normalized
+
+    if params.model == 'single':
+        logs = train_single(trainer, evaluator, params, logger)
+    else:
+        logs = train_cycle(trainer, evaluator1, evaluator2, params, logger)
+    if params.export:
+        trainer.export()
+
+    results = OrderedDict([('spoke', spoke), ('exp_path', params.exp_path)])
+    for suffix, to_log in logs:
+        results.update((k + suffix, v) for k, v in to_log.items()
+                       if k.startswith('precision_at_') or k.startswith('mean_cosine'))
+    with open(os.path.join(params.exp_path, RESULTS_FILE), 'w') as f:
+        json.dump(results, f)
+    return results
+
+
+def load_mappings(params, spoke):
+    """
+    spoke -> pivot and pivot -> spoke mappings of a trained spoke.
+    """
+    exp_path = spoke_params(params, spoke).exp_path
+    if params.model == 'single':
+        W = torch.load(os.path.join(exp_path, 'best_mapping.t7'))
+        # orthogonal mapping: the inverse is the transpose
+        return W, W.T
+    return (torch.load(os.path.join(exp_path, 'best_mapping_True.t7')),
+            torch.load(os.path.join(exp_path, 'best_mapping_False.t7')))
+
+
+def compose_mappings(params, spokes, logger):
+    """
+    Spoke-to-spoke mappings through the pivot: a -> b is (pivot -> b) (a -> pivot).
+    They are stored as the best_mapping_True.t7 (a -> b) / best_mapping_False.t7
+    (b -> a) of exp_path/composed/a-b.
+    """
+    mappings = dict((spoke, load_mappings(params, spoke)) for spoke in spokes)
+    for a in spokes:
+        for b in spokes:
+            if a == b:
+                continue
+            path = os.path.join(params.exp_path, 'composed', '%s-%s' % (a, b))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            torch.save(mappings[b][1].dot(mappings[a][0]), os.path.join(path, 'best_mapping_True.t7'))
+            torch.save(mappings[a][1].dot(mappings[b][0]), os.path.join(path, 'best_mapping_False.t7'))
+    logger.info('Composed %i spoke-to-spoke mappings in %s'
+                % (len(spokes) * (len(spokes) - 1), os.path.join(params.exp_path, 'composed')))
+
+
+if __name__ == '__main__':
+
+    # parse parameters
+    params = parser.parse_args()
+    spokes = params.spoke_langs.split(',')
+
+    # check parameters
+    assert not params.cuda or torch.cuda.is_available()
+    assert params.export_format in ["txt", "store"]
+    assert params.dico_index == "" or params.dico_index.split(",")[0] == "pq"
+    assert params.autotune_memory > 0
+    assert params.emb_dtype in EMB_DTYPES
+    assert 0 <= params.dis_dropout < 1
+    assert 0 <= params.dis_input_dropout < 1
+    assert 0 <= params.dis_smooth < 0.5
+    assert params.dis_lambda > 0 and params.dis_steps > 0
+    assert 0 < params.lr_shrink <= 1
+    assert params.model in ['single', 'cycle']
+    assert params.n_workers > 0 and params.threads_per_run > 0
+    assert os.path.isfile(params.pivot_emb)
+    assert len(spokes) == len(set(spokes)) > 0 and params.pivot_lang not in spokes
+    assert len(params.spoke_embs.split(',')) == len(spokes)
+    assert all(os.path.isfile(path) for path in params.spoke_embs.split(','))
+
+    params.exp_path = params.exp_path or get_exp_path(params)
+    if not os.path.isdir(params.exp_path):
+        os.makedirs(params.exp_path)
+    logger = create_logger(os.path.join(params.exp_path, 'train.log'), vb=params.verbose)
+    logger.info('\n'.join('%s: %s' % (k, str(v)) for k, v in sorted(dict(vars(params)).items())))
+
+    # spokes already trained (onboarding a new language only trains this language)
+    results = OrderedDict()
+    for spoke in spokes:
+        path = os.path.join(spoke_params(params, spoke).exp_path, RESULTS_FILE)
+        if not params.retrain and os.path.isfile(path):
+            results[spoke] = json.load(open(path), object_pairs_hook=OrderedDict)
+            logger.info('%s -> %s already trained in %s' % (spoke, params.pivot_lang, os.path.dirname(path)))
+    to_train = [spoke for spoke in spokes if spoke not in results]
+
+    if to_train:
+        # load the pivot once for all the spokes
+        tic = time.time()
+        SHARED['params'] = params
+        SHARED['pivot'] = load_pivot(params)
+        logger.info('Loaded the %s pivot in %.2fs' % (params.pivot_lang, time.time() - tic))
+
+        # train the spokes sequentially, or in worker processes (forked, so they share the pivot)
+        if params.n_workers == 1:
+            trained = [run_spoke(spoke) for spoke in to_train]
+        else:
+            pool = mp.Pool(processes=min(params.n_workers, len(to_train)), maxtasksperchild=1)
+            trained = pool.map(run_spoke, to_train, chunksize=1)
+            pool.close()
+            pool.join()
+        logger = create_logger(os.path.join(params.exp_path, 'train.log'), vb=params.verbose)
+        results.update((res['spoke'], res) for res in trained)
+
+    # spoke-to-spoke mappings
+    if len(spokes) > 1:
+        compose_mappings(params, spokes, logger)
+
+    # results table
+    columns = []
+    for res in results.values():
+        columns += [k for k in res if k not in columns]
+    path = os.path.join(params.exp_path, 'results.tsv')
+    with open(path, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for spoke in spokes:
+            f.write('\t'.join(str(results[spoke].get(k, '')) for k in columns) + '\n')
+    logger.info('Results written to %s' % path)
+    logger.info('\n' + open(path).read())
@@ -9,14 +9,23 @@ import numpy as np
 import torch
 from copy import deepcopy
 
+from src.metrics import MetricsReader
 
 
+reader = MetricsReader('./dumped/')
+
 
 #no lambda
 def load_plot_info(name):
+	# experiments run before the metrics stream only have a plot_info.test dump
+	if reader.header(name) is not None:
+		return reader.plot_info(name)
 	path='./dumped/'
 	return json.load(open(path+name+'/plot_info.test'))
 
+# experiments can also be selected by tag / parameters, e.g.
+# lambdas=[load_plot_info(name) for name in reader.find(tags=['lambda'], epoch_size=1000000)]
+
 # e1=load_plot_info('30cxvylr8w')
 # #no organ no lambda
 # e2=load_plot_info('pxivch863r')
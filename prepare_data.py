@@ -1,124 +1,166 @@
 from __future__ import print_function
-from fasttext import FastVector
+import os
+import json
+import hashlib
+import argparse
+from multiprocessing import Pool
 import numpy as np
+from numpy.lib.format import open_memmap
+
+# bump when the layout of the generated files changes
+CACHE_VERSION = 1
+
+
+def file_hash(path, manifest):
+	"""
+	SHA1 of a file, reused from the manifest when its size / mtime did not change.
+	"""
+	stat = os.stat(path)
+	entry = manifest.get('files', {}).get(path)
+	if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+		return entry
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 22), b''):
+			sha1.update(chunk)
+	return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+
+
+def read_vocabulary(path):
+	"""
+	Stream the first token of every line of a frequency-ordered embedding file.
+	"""
+	words = []
+	with open(path, 'r') as f:
+		for line in f:
+			words.append(line.split(' ', 1)[0].rstrip())
+	return words
+
+
+def read_dictionary(path):
+	pairs = []
+	with open(path, 'r') as f:
+		for line in f:
+			pairs.append(line.split())
+	return pairs
+
+
+def encode_language(args):
+	"""
+	Stream a .vec file once and copy the vectors of the requested words into a
+	memory-mapped buffer. Returns the word -> buffer row lookup built while reading.
+	"""
+	lang, vec_path, wanted, buffer_path = args
+	wanted = set(wanted)
+	lookup = {}
+	print('reading word vectors from %s' % vec_path)
+	with open(vec_path, 'r') as f:
+		dim = int(f.readline().split()[1])
+		buf = open_memmap(buffer_path, mode='w+', dtype=np.float32, shape=(max(len(wanted), 1), dim))
+		for line in f:
+			word, vect = line.rstrip('\n').split(' ', 1)
+			if word in wanted and word not in lookup:
+				buf[len(lookup)] = np.fromstring(vect, sep=' ', dtype=np.float32)[:dim]
+				lookup[word] = len(lookup)
+				if len(lookup) == len(wanted):
+					break
+		buf.flush()
+	print('%s: found %i / %i words' % (lang, len(lookup), len(wanted)))
+	return lookup, dim
+
+
+def word2vector_mo(wordlist, lookup, buf, out_path):
+	"""
+	Write the vectors of the words of `wordlist` found in `lookup` to a .npy file.
+	"""
+	rows = np.array([lookup[w] for w in wordlist if w in lookup], dtype=np.int64)
+	out = open_memmap(out_path, mode='w+', dtype=np.float32, shape=(len(rows), buf.shape[1]))
+	for i in range(0, len(rows), 65536):
+		out[i:i + 65536] = buf[rows[i:i + 65536]]
+	out.flush()
+	return out.shape
+
+
+def word2vector_bi(pairs, lookup1, lookup2, buf1, buf2, out_path):
+	"""
+	Write the (source, target) vector pairs of a bilingual dictionary to a .npy file.
+	"""
+	found = [(lookup1[w1], lookup2[w2]) for w1, w2 in pairs if w1 in lookup1 and w2 in lookup2]
+	rows = np.array(found, dtype=np.int64).reshape(-1, 2)
+	out = open_memmap(out_path, mode='w+', dtype=np.float32, shape=(len(rows), 2, buf1.shape[1]))
+	out[:, 0] = buf1[rows[:, 0]]
+	out[:, 1] = buf2[rows[:, 1]]
+	out.flush()
+	return out.shape
 
-def word2vector_mo(wordlist,dictionary):
-	reslist=[]
-	for word in wordlist:
-		if word in dictionary:
-			reslist.append(dictionary[word])
-		else:
-			pass
-			# reslist.append(np.zeros([300]))
-	return np.array(reslist)
-
-def word2vector_bi(wl1,wl2,dict1,dict2):
-	reslist=[]
-	assert wl1.shape[0]==wl2.shape[0]
-	for i in range(wl1.shape[0]):
-		w1=wl1[i]
-		w2=wl2[i]
-		if w1 in dict1 and w2 in dict2:
-			reslist.append([dict1[w1],dict2[w2]])
-		else:
-			pass
-			# reslist.append(np.zeros([300]))
-	return np.array(reslist)
-
-def getTheFrequency():
-	address="./data/embeddings/original/en.emb.txt"
-	f = open(address,'r')
-	res=[]
-	for line in f.readlines():
-		word=line.split()[0]
-		res.append(word)
-	f.close()
-	np.save("./data/en.npy",np.array(res))
-
-	address="./data/embeddings/original/it.emb.txt"
-	f = open(address,'r')
-	res=[]
-	for line in f.readlines():
-		word=line.split()[0]
-		res.append(word)
-	f.close()
-	np.save("./data/it.npy",np.array(res))
-
-def createTrainAndTest():
-	address="./data/dictionaries/en-it.train.txt"
-	f = open(address,'r')
-	res=[]
-	for line in f.readlines():
-		word=line.split()
-		res.append(word)
-	f.close()
-
-	np.save("./data/en_it_train.npy",np.array(res))
-
-	address="./data/dictionaries/en-it.test.txt"
-	f = open(address,'r')
-	res=[]
-	for line in f.readlines():
-		word=line.split()
-		res.append(word)
-	f.close()
-	np.save("./data/en_it_test.npy",np.array(res))
-	
-def encodingFiles_mo():
-	en_dictionary = FastVector(vector_file="./data/pretrained/en.vec")
-	it_dictionary = FastVector(vector_file="./data/pretrained/it.vec")
-	
-	file="./data/en"
-	array=np.load(file+".npy")
-	vec=word2vector_mo(array,en_dictionary)
-	np.save(file+'_vec.npy',vec)
-	print(vec.shape)
-
-	file="./data/it"
-	array=np.load(file+".npy")
-	vec=word2vector_mo(array,it_dictionary)
-	np.save(file+'_vec.npy',vec)
-	print(vec.shape)
-
-def encodingFiles_bi():
-	en_dictionary = FastVector(vector_file="./data/pretrained/en.vec")
-	it_dictionary = FastVector(vector_file="./data/pretrained/it.vec")
-
-	file="./data/en_it_train"
-	array=np.load(file+".npy")
-	vec=word2vector_bi(array[:,0],array[:,1],en_dictionary,it_dictionary)
-	np.save(file+'_vec.npy',vec)
-	print(vec.shape)
-
-	file="./data/en_it_test"
-	array=np.load(file+".npy")
-	vec=word2vector_bi(array[:,0],array[:,1],en_dictionary,it_dictionary)
-	np.save(file+'_vec.npy',vec)
-	print(vec.shape)
-
-	del en_dictionary
-	del it_dictionary
 
 def main():
-	getTheFrequency()
-	createTrainAndTest()	
-	encodingFiles_mo()
-	encodingFiles_bi()
-
-
-	# en=["hello","hello","hello","hello","hello"]
-	# it=["Ciao","Ciao","Ciao","Ciao","Ciao"]
-	# 
-	# it_dictionary = FastVector(vector_file="../UnsupervisedWordMappingDataset/wiki.en/wiki.it.vec")
-	# np_it=word2vector(it,it_dictionary)
-	# del it_dictionary
-	# print np_en.shape
-	# print np_it.shape
-	# np.save("en.npy",np_en)
-	# np.save("it.npy",np_it)
-
-
-
-
-main()
-
+	parser = argparse.ArgumentParser(description='Build the word CycleGAN datasets')
+	parser.add_argument("--data_path", type=str, default="./data", help="Data directory")
+	parser.add_argument("--src_lang", type=str, default="en", help="Source language")
+	parser.add_argument("--tgt_lang", type=str, default="it", help="Target language")
+	parser.add_argument("--force", action="store_true", help="Rebuild even if the cached outputs are up to date")
+	params = parser.parse_args()
+
+	data = params.data_path
+	langs = [params.src_lang, params.tgt_lang]
+	pair = '%s_%s' % tuple(langs)
+	emb_txt = dict((lg, os.path.join(data, 'embeddings/original/%s.emb.txt' % lg)) for lg in langs)
+	vec = dict((lg, os.path.join(data, 'pretrained/%s.vec' % lg)) for lg in langs)
+	dicos = dict((split, os.path.join(data, 'dictionaries/%s-%s.%s.txt' % (langs[0], langs[1], split)))
+				 for split in ['train', 'test'])
+	outputs = [os.path.join(data, name) for name in
+			   ['%s.npy' % langs[0], '%s.npy' % langs[1], '%s_vec.npy' % langs[0], '%s_vec.npy' % langs[1]] +
+			   ['%s_%s%s.npy' % (pair, split, suffix) for split in ['train', 'test'] for suffix in ['', '_vec']]]
+
+	# skip everything if the inputs did not change since the last build
+	cache_dir = os.path.join(data, 'cache')
+	if not os.path.isdir(cache_dir):
+		os.makedirs(cache_dir)
+	manifest_path = os.path.join(cache_dir, 'prepare_data.json')
+	manifest = json.load(open(manifest_path)) if os.path.isfile(manifest_path) else {}
+	inputs = sorted(list(emb_txt.values()) + list(vec.values()) + list(dicos.values()))
+	files = dict((path, file_hash(path, manifest)) for path in inputs)
+	key = hashlib.sha1(json.dumps([CACHE_VERSION, outputs] + [files[path]['sha1'] for path in inputs]).encode('utf-8')).hexdigest()
+	if not params.force and manifest.get('key') == key and all(os.path.isfile(path) for path in outputs):
+		print('Datasets are up to date (%s).' % key)
+		return
+
+	# vocabularies and dictionaries
+	vocab = dict((lg, read_vocabulary(emb_txt[lg])) for lg in langs)
+	pairs = dict((split, read_dictionary(dicos[split])) for split in dicos)
+	for lg in langs:
+		np.save(os.path.join(data, '%s.npy' % lg), np.array(vocab[lg]))
+	for split in pairs:
+		np.save(os.path.join(data, '%s_%s.npy' % (pair, split)), np.array(pairs[split]))
+
+	# stream both .vec files once, in parallel
+	wanted = dict((lg, set(vocab[lg])) for lg in langs)
+	for split in pairs:
+		for w1, w2 in pairs[split]:
+			wanted[langs[0]].add(w1)
+			wanted[langs[1]].add(w2)
+	buffers = dict((lg, os.path.join(cache_dir, '%s.vectors.npy' % lg)) for lg in langs)
+	pool = Pool(processes=len(langs))
+	results = pool.map(encode_language, [(lg, vec[lg], sorted(wanted[lg]), buffers[lg]) for lg in langs])
+	pool.close()
+	pool.join()
+	lookup = dict((lg, res[0]) for lg, res in zip(langs, results))
+	buf = dict((lg, np.load(buffers[lg], mmap_mode='r')) for lg in langs)
+
+	# monolingual / bilingual datasets
+	for lg in langs:
+		print(word2vector_mo(vocab[lg], lookup[lg], buf[lg], os.path.join(data, '%s_vec.npy' % lg)))
+	for split in ['train', 'test']:
+		print(word2vector_bi(pairs[split], lookup[langs[0]], lookup[langs[1]], buf[langs[0]], buf[langs[1]],
+							 os.path.join(data, '%s_%s_vec.npy' % (pair, split))))
+
+	del buf
+	for lg in langs:
+		os.remove(buffers[lg])
+	with open(manifest_path, 'w') as f:
+		json.dump({'key': key, 'files': files}, f)
+
+
+if __name__ == '__main__':
+	main()
@@ -13,15 +13,25 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import os
+import platform
+import time
+
 import numpy as np
 
 
-def read(file, threshold=0, vocabulary=None):
+# Cache of the block sizes measured by block_size, per machine and per shape
+BLOCK_SIZE_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'unsupervised_word_mapping', 'block_sizes.json')
+BLOCK_SIZES = [64, 128, 256, 512, 1024, 2048, 4096, 8192]
+
+
+def read(file, threshold=0, vocabulary=None, dtype='float'):
     header = file.readline().split(' ')
     count = int(header[0]) if threshold <= 0 else min(threshold, int(header[0]))
     dim = int(header[1])
     words = []
-    matrix = np.empty((count, dim)) if vocabulary is None else []
+    matrix = np.empty((count, dim), dtype=dtype) if vocabulary is None else []
     for i in range(count):
         word, vec = file.readline().split(' ', 1)
         if vocabulary is None:
@@ -29,8 +39,8 @@ def read(file, threshold=0, vocabulary=None):
             matrix[i] = np.fromstring(vec, sep=' ')
         elif word in vocabulary:
             words.append(word)
-            matrix.append(np.fromstring(vec, sep=' '))
-    return (words, matrix) if vocabulary is None else (words, np.array(matrix))
+            matrix.append(np.fromstring(vec, sep=' ', dtype=dtype))
+    return (words, matrix) if vocabulary is None else (words, np.array(matrix, dtype=dtype))
 
 
 def write(words, matrix, file):
@@ -58,4 +68,53 @@ def length_normalize_dimensionwise(matrix):
 
 def mean_center_embeddingwise(matrix):
     avg = np.mean(matrix, axis=1)
-    return matrix - avg[:, np.newaxis]
\ No newline at end of file
+    return matrix - avg[:, np.newaxis]
+
+
+def block_size(n_cols, dim, max_memory, dtype='float', tune=True):
+    """Number of rows of the (rows, n_cols) similarity blocks fitting in max_memory MB.
+    If tune is set, the fastest of BLOCK_SIZES on this machine, measured on first use and cached."""
+    itemsize = np.dtype(dtype).itemsize
+    max_rows = max(1, int(max_memory * 1024 * 1024 // (itemsize * n_cols)))
+    candidates = [bs for bs in BLOCK_SIZES if bs <= max_rows]
+    if not tune or not candidates:
+        return max_rows
+    if len(candidates) == 1:
+        return candidates[0]
+    machine = '%s|%s/%d cpus|numpy %s' % (platform.node(), platform.processor() or platform.machine(), os.cpu_count(), np.__version__)
+    shape = 'numpy dot|%s|dim=%d|rows=%d|mem=%d' % (np.dtype(dtype).name, dim, 1 << max(0, n_cols - 1).bit_length(), max_memory)
+    try:
+        with open(BLOCK_SIZE_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    choices = cache['machines'] if cache.get('version') == 1 else {}
+    if shape in choices.get(machine, {}):
+        return min(choices[machine][shape], max_rows)
+
+    # Time the similarity blocks of random embeddings, for increasing block sizes
+    rng = np.random.RandomState(0)
+    keys = rng.randn(min(n_cols, 8192), dim).astype(dtype)
+    queries = rng.randn(candidates[-1], dim).astype(dtype)
+    speeds = {}
+    queries[:candidates[0]].dot(keys.T)
+    for bs in candidates:
+        runs, start = 0, time.time()
+        while time.time() - start < 0.05:
+            queries[:bs].dot(keys.T)
+            runs += 1
+        speeds[bs] = runs * bs / (time.time() - start)
+        if speeds[bs] < 0.8 * max(speeds.values()):
+            break
+    best = min(bs for bs in speeds if speeds[bs] >= 0.95 * max(speeds.values()))
+
+    choices.setdefault(machine, {})[shape] = best
+    try:
+        os.makedirs(os.path.dirname(BLOCK_SIZE_CACHE), exist_ok=True)
+        tmp = '%s.%d.tmp' % (BLOCK_SIZE_CACHE, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump({'version': 1, 'machines': choices}, f, indent=2, sort_keys=True)
+        os.replace(tmp, BLOCK_SIZE_CACHE)
+    except OSError:
+        pass
+    return best
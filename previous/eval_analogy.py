@@ -20,7 +20,8 @@ import numpy as np
 import sys
 
 
-BATCH_SIZE = 1000
+# Memory budget for the similarity blocks computed at once
+MAX_MEMORY_MB = 1024
 
 
 def main():
@@ -70,8 +71,9 @@ def main():
 
     # Compute nearest neighbors using efficient matrix multiplication
     nn = []
-    for i in range(0, total, BATCH_SIZE):
-        j = min(i + BATCH_SIZE, total)
+    bs = embeddings.block_size(matrix.shape[0], matrix.shape[1], MAX_MEMORY_MB, matrix.dtype)
+    for i in range(0, total, bs):
+        j = min(i + bs, total)
         similarities = (matrix[src2[i:j]] - matrix[src1[i:j]] + matrix[trg1[i:j]]).dot(matrix.T)
         similarities[range(j-i), src1[i:j]] = -1
         similarities[range(j-i), trg1[i:j]] = -1
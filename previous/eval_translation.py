@@ -21,7 +21,20 @@ import numpy as np
 import sys
 
 
-BATCH_SIZE = 1000
+# Memory budget for the similarity blocks computed at once
+MAX_MEMORY_MB = 512
+
+
+def topk_mean(m, k):
+    """Mean of the k largest values of each row of m."""
+    k = min(k, m.shape[1])
+    return np.partition(m, m.shape[1] - k, axis=1)[:, m.shape[1] - k:].mean(axis=1)
+
+
+def logsumexp(m, axis):
+    """Numerically stable log(sum(exp(m))) along axis."""
+    mmax = m.max(axis=axis, keepdims=True)
+    return np.log(np.exp(m - mmax).sum(axis=axis)) + mmax.squeeze(axis)
 
 
 def main():
@@ -30,6 +43,12 @@ def main():
     parser.add_argument('src_embeddings', help='the source language embeddings')
     parser.add_argument('trg_embeddings', help='the target language embeddings')
     parser.add_argument('-d', '--dictionary', default=sys.stdin.fileno(), help='the test dictionary file (defaults to stdin)')
+    parser.add_argument('--retrieval', default='nn', choices=['nn', 'invsoftmax', 'csls'], help='the retrieval method (nn: standard nearest neighbor; invsoftmax: inverted softmax; csls: cross-domain similarity local scaling)')
+    parser.add_argument('--inv_temperature', default=1, type=float, help='the inverse temperature (only compatible with inverted softmax)')
+    parser.add_argument('-k', '--neighborhood', default=10, type=int, help='the neighborhood size (only compatible with csls)')
+    parser.add_argument('--precision', default=[1, 5, 10], type=int, nargs='+', help='the k values to report precision@k for (defaults to 1 5 10)')
+    parser.add_argument('--max_memory', default=MAX_MEMORY_MB, type=int, help='the memory budget for similarity blocks in MB (defaults to %d)' % MAX_MEMORY_MB)
+    parser.add_argument('--no_autotune', action='store_true', help='use the largest blocks fitting in the memory budget instead of the fastest block size measured on this machine')
     parser.add_argument('--dot', action='store_true', help='use the dot product in the similarity computations instead of the cosine')
     parser.add_argument('--encoding', default='utf-8', help='the character encoding for input/output (defaults to utf-8)')
     args = parser.parse_args()
@@ -37,8 +56,8 @@ def main():
     # Read input embeddings
     srcfile = open(args.src_embeddings, encoding=args.encoding, errors='surrogateescape')
     trgfile = open(args.trg_embeddings, encoding=args.encoding, errors='surrogateescape')
-    src_words, src_matrix = embeddings.read(srcfile)
-    trg_words, trg_matrix = embeddings.read(trgfile)
+    src_words, src_matrix = embeddings.read(srcfile, dtype=np.float32)
+    trg_words, trg_matrix = embeddings.read(trgfile, dtype=np.float32)
 
     # Length normalize embeddings so their dot product effectively computes the cosine similarity
     if not args.dot:
@@ -66,17 +85,45 @@ def main():
     oov -= vocab  # If one of the translation options is in the vocabulary, then the entry is not an oov
     coverage = len(src2trg) / (len(src2trg) + len(oov))
 
-    # Compute accuracy
-    correct = 0
-    src, trg = zip(*src2trg.items())
-    for i in range(0, len(src2trg), BATCH_SIZE):
-        j = min(i + BATCH_SIZE, len(src2trg))
-        similarities = src_matrix[list(src[i:j])].dot(trg_matrix.T)
-        nn = np.argmax(similarities, axis=1).tolist()
-        for k in range(j-i):
-            if nn[k] in trg[i+k]:
-                correct += 1
-    print('Coverage:{0:7.2%}  Accuracy:{1:7.2%}'.format(coverage, correct / len(src2trg)))
+    # Gold (query, target) pairs, encoded as sorted keys for vectorized membership tests
+    src = np.array(sorted(src2trg.keys()))
+    n_trg = trg_matrix.shape[0]
+    gold = np.sort(np.array([q * n_trg + t for q, s in enumerate(src) for t in src2trg[s]], dtype=np.int64))
+
+    # Target-side statistics over the whole source vocabulary, computed blockwise
+    bs = embeddings.block_size(src_matrix.shape[0], src_matrix.shape[1], args.max_memory, np.float32, not args.no_autotune)
+    if args.retrieval == 'csls':
+        knn_sim_bwd = np.zeros(n_trg, dtype=np.float32)
+        for i in range(0, n_trg, bs):
+            knn_sim_bwd[i:i+bs] = topk_mean(trg_matrix[i:i+bs].dot(src_matrix.T), args.neighborhood)
+    elif args.retrieval == 'invsoftmax':
+        log_denominators = np.zeros(n_trg, dtype=np.float32)
+        for i in range(0, n_trg, bs):
+            log_denominators[i:i+bs] = logsumexp(args.inv_temperature * trg_matrix[i:i+bs].dot(src_matrix.T), axis=1)
+
+    # Retrieve the top translations of every query and check them against the gold pairs
+    max_k = min(max(args.precision), n_trg)
+    correct = np.zeros(max_k, dtype=np.int64)
+    bs = embeddings.block_size(n_trg, trg_matrix.shape[1], args.max_memory, np.float32, not args.no_autotune)
+    for i in range(0, len(src), bs):
+        j = min(i + bs, len(src))
+        similarities = src_matrix[src[i:j]].dot(trg_matrix.T)
+        if args.retrieval == 'csls':
+            knn_sim_fwd = topk_mean(similarities, args.neighborhood)
+            similarities *= 2
+            similarities -= knn_sim_fwd[:, np.newaxis]
+            similarities -= knn_sim_bwd[np.newaxis, :]
+        elif args.retrieval == 'invsoftmax':
+            similarities *= args.inv_temperature
+            similarities -= log_denominators[np.newaxis, :]
+        rows = np.arange(j - i)[:, np.newaxis]
+        top = np.argpartition(-similarities, max_k - 1, axis=1)[:, :max_k]
+        top = top[rows, np.argsort(-similarities[rows, top], axis=1)]
+        hits = np.isin((rows + i) * n_trg + top, gold)
+        correct += np.logical_or.accumulate(hits, axis=1).sum(axis=0)
+
+    results = ['P@{0}:{1:7.2%}'.format(k, correct[min(k, max_k) - 1] / len(src)) for k in args.precision]
+    print('Coverage:{0:7.2%}  {1}'.format(coverage, '  '.join(results)))
 
 
 if __name__ == '__main__':
@@ -24,9 +24,10 @@ import time
 
 
 # Maximum dimensions for the similarity matrix computation in memory
-# A MAX_DIM_X * MAX_DIM_Z dimensional matrix will be used
-MAX_DIM_X = 10000
+# At most MAX_DIM_Z target words and MAX_MEMORY_MB of similarities are used
+# (the number of source words of a block is tuned by embeddings.block_size)
 MAX_DIM_Z = 10000
+MAX_MEMORY_MB = 800
 
 
 def main():
@@ -50,6 +51,7 @@ def main():
     self_learning_group.add_argument('--threshold', default=0.000001, type=float, help='the convergence threshold (defaults to 0.000001)')
     self_learning_group.add_argument('--validation', default=None, help='a dictionary file for validation at each iteration')
     self_learning_group.add_argument('--log', help='write to a log file in tsv format at each iteration')
+    self_learning_group.add_argument('--no_autotune', action='store_true', help='use the largest similarity blocks fitting in memory instead of the fastest block size measured on this machine')
     self_learning_group.add_argument('-v', '--verbose', action='store_true', help='write log information to stderr at each iteration')
     args = parser.parse_args()
 
@@ -143,6 +145,7 @@ def main():
 
         # Self-learning
         if args.self_learning:
+            bs = embeddings.block_size(min(z.shape[0], MAX_DIM_Z), z.shape[1], MAX_MEMORY_MB, xw.dtype, not args.no_autotune)
 
             # Update the training dictionary
             best_sim_forward = np.full(x.shape[0], -100.)
@@ -151,9 +154,9 @@ def main():
             best_sim_backward = np.full(z.shape[0], -100.)
             src_indices_backward = np.zeros(z.shape[0], dtype=int)
             trg_indices_backward = range(z.shape[0])
-            for i in range(0, x.shape[0], MAX_DIM_X):
+            for i in range(0, x.shape[0], bs):
                 for j in range(0, z.shape[0], MAX_DIM_Z):
-                    sim = xw[i:i+MAX_DIM_X].dot(z[j:j+MAX_DIM_Z].T)
+                    sim = xw[i:i+bs].dot(z[j:j+MAX_DIM_Z].T)
                     for k in range(sim.shape[0]):
                         l = sim[k].argmax()
                         if sim[k, l] > best_sim_forward[i+k]:
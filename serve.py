@@ -0,0 +1,84 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# python serve.py --src_emb data/pretrained/en.vec --tgt_emb data/pretrained/it.vec --exp_path dumped/30cxvylr8w --port 8080
+# curl "http://localhost:8080/translate?words=cat,dog&direction=s2t&k=5"
+
+import os
+import json
+import argparse
+import torch
+
+from src.utils import bool_flag
+from src.logger import create_logger
+from src.serving import Translator, MicroBatcher, make_server, watch_mappings, benchmark
+
+
+# main
+parser = argparse.ArgumentParser(description='Word translation server')
+parser.add_argument("--verbose", type=int, default=1, help="Verbose level (2:debug, 1:info, 0:warning)")
+parser.add_argument("--exp_path", type=str, default="", help="Experiment directory with the best mappings")
+parser.add_argument("--cuda", type=bool_flag, default=False, help="Run on GPU")
+# data
+parser.add_argument("--src_emb", type=str, default="", help="Source embeddings")
+parser.add_argument("--tgt_emb", type=str, default="", help="Target embeddings")
+parser.add_argument("--max_vocab", type=int, default=200000, help="Maximum vocabulary size (0 to disable)")
+parser.add_argument("--cache_dir", type=str, default="./data/cache", help="Where to store the binary embeddings")
+parser.add_argument("--csls_knn", type=int, default=10, help="Neighborhood of the CSLS radii (0 to only serve nn)")
+# server
+parser.add_argument("--host", type=str, default="127.0.0.1", help="Host")
+parser.add_argument("--port", type=int, default=8080, help="Port")
+parser.add_argument("--unix_socket", type=str, default="", help="Listen on this Unix socket instead of host:port")
+parser.add_argument("--max_batch", type=int, default=1024, help="Maximum number of words of a micro-batch")
+parser.add_argument("--max_wait_ms", type=float, default=2, help="Maximum wait of a request for a micro-batch")
+parser.add_argument("--reload_interval", type=float, default=10, help="Check for new mappings every n seconds (0 to disable)")
+# benchmark
+parser.add_argument("--benchmark", type=bool_flag, default=False, help="Benchmark the server and exit")
+parser.add_argument("--bench_clients", type=int, default=8, help="Concurrent clients")
+parser.add_argument("--bench_requests", type=int, default=100, help="Requests per client")
+parser.add_argument("--bench_batch", type=int, default=16, help="Words per request")
+parser.add_argument("--bench_k", type=int, default=10, help="Translations per word")
+parser.add_argument("--bench_method", type=str, default="csls_knn_10", help="Retrieval method (nn/csls_knn_10)")
+
+
+# parse parameters
+params = parser.parse_args()
+
+# check parameters
+assert not params.cuda or torch.cuda.is_available()
+assert os.path.isfile(params.src_emb)
+assert os.path.isfile(params.tgt_emb)
+assert os.path.isdir(params.exp_path)
+assert params.csls_knn >= 0 and params.max_batch > 0
+
+# load the embeddings / mappings, and start the server
+logger = create_logger(os.path.join(params.exp_path, 'serve.log'), vb=params.verbose)
+translator = Translator(params)
+batcher = MicroBatcher(translator, params.max_batch, params.max_wait_ms / 1000.)
+server = make_server(translator, batcher, params.host, params.port, params.unix_socket)
+if params.reload_interval > 0:
+    watch_mappings(translator, params.reload_interval)
+
+if params.benchmark:
+    import threading
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    for direction in sorted(translator.directions):
+        results = benchmark(translator, params.host, server.server_address[1] if not params.unix_socket else 0,
+                            params.unix_socket, params.bench_clients, params.bench_requests, params.bench_batch,
+                            params.bench_k, params.bench_method, direction)
+        logger.info('Benchmark %s: %s' % (direction, json.dumps(results)))
+    server.shutdown()
+    server.server_close()
+else:
+    logger.info('Serving %s on %s ...' % (', '.join(sorted(translator.directions)),
+                                          params.unix_socket or 'http://%s:%i' % (params.host, params.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
@@ -0,0 +1,191 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import json
+import time
+import platform
+import multiprocessing
+from logging import getLogger
+import torch
+
+
+logger = getLogger()
+
+CACHE_VERSION = 1
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'unsupervised_word_mapping', 'block_sizes.json')
+# memory budget of a block of scores, in MB
+DEFAULT_MAX_MEMORY = 1024
+
+# candidate block sizes (number of rows scored at once)
+CANDIDATES = [64, 128, 256, 512, 1024, 2048, 4096, 8192]
+# maximum number of rows of the benchmarked key tables
+BENCH_ROWS = 8192
+# minimum measured time per candidate, in seconds
+BENCH_TIME = 0.05
+
+
+def _topk_kernel(queries, keys):
+    # nearest neighbors / CSLS: top-k keys of a block of queries
+    if keys.type() != queries.type():
+        keys = keys.float()
+    return queries.mm(keys.transpose(0, 1)).topk(10, dim=1, largest=True, sorted=True)
+
+
+def _softmax_kernel(queries, keys):
+    # inverted softmax: scores of a block of targets, normalized over all the sources (keys)
+    scores = keys.float().mm(queries.transpose(0, 1))
+    scores.exp_()
+    scores.div_(scores.sum(0, keepdim=True).expand_as(scores))
+    return scores.topk(2, dim=1, largest=True, sorted=True)
+
+
+KERNELS = {
+    'topk': _topk_kernel,
+    'softmax': _softmax_kernel,
+}
+
+
+def _bucket(n):
+    """
+    Smallest power of 2 >= n.
+    """
+    return 1 << max(0, int(n) - 1).bit_length()
+
+
+class BlockSizeTuner(object):
+    """
+    Block sizes of the similarity kernels: number of rows of the blocks of
+    scores computed at once. On first use for a kernel and a shape, the
+    candidate sizes whose blocks fit in the memory budget are benchmarked,
+    and the fastest one is cached in a JSON file, per machine and per shape.
+    When disabled, the kernels use their former hardcoded sizes.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.max_memory = DEFAULT_MAX_MEMORY
+        self.path = DEFAULT_CACHE
+        self._choices = None
+
+    def configure(self, enabled=True, max_memory=DEFAULT_MAX_MEMORY, path=''):
+        self.enabled = enabled
+        self.max_memory = max_memory
+        self.path = path or DEFAULT_CACHE
+        self._choices = None
+
+    def _machine(self, cuda):
+        if cuda:
+            device = 'cuda:%i' % torch.cuda.current_device()
+            if hasattr(torch.cuda, 'get_device_name'):
+                device = torch.cuda.get_device_name(torch.cuda.current_device())
+        else:
+            device = '%s/%i cpus/%i threads' % (platform.processor() or platform.machine(),
+                                                multiprocessing.cpu_count(), torch.get_num_threads())
+        return '%s|%s|torch %s' % (platform.node(), device, torch.__version__)
+
+    def _load(self):
+        """
+        Block sizes of the cache file, by machine and by shape.
+        """
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return cache['machines'] if cache.get('version') == CACHE_VERSION else {}
+
+    def _save(self, machine, shape, bs):
+        """
+        Add a block size to the cache file (merged with the sizes written
+        by other processes since it was loaded).
+        """
+        choices = self._load()
+        choices.setdefault(machine, {})[shape] = bs
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = '%s.%i.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': CACHE_VERSION, 'machines': choices}, f, indent=2, sort_keys=True)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write the block sizes cache %s: %s' % (self.path, e))
+        self._choices = choices
+
+    def block_size(self, kernel, keys, default):
+        """
+        Number of rows of the blocks of `kernel` ("topk" / "softmax") scored
+        against the rows of `keys`, or `default` if the tuner is disabled.
+        """
+        if not self.enabled:
+            return default
+        max_bs = max(1, self.max_memory * 1024 ** 2 // (4 * keys.size(0)))
+        machine = self._machine(keys.is_cuda)
+        shape = '%s|%s|dim=%i|rows=%i|mem=%i' % (kernel, keys.type(), keys.size(1), _bucket(keys.size(0)), self.max_memory)
+        if self._choices is None:
+            self._choices = self._load()
+        bs = self._choices.get(machine, {}).get(shape)
+        if bs is None:
+            bs = self._calibrate(kernel, keys, max_bs)
+            self._save(machine, shape, bs)
+        return min(bs, max_bs)
+
+    def _calibrate(self, kernel, keys, max_bs):
+        """
+        Fastest candidate block size (in rows / s) under `max_bs`. The sizes
+        are tried in increasing order, until one is clearly slower than the
+        best one. The smallest size within 5% of the best one is selected.
+        """
+        candidates = [bs for bs in CANDIDATES if bs <= max_bs]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else max_bs
+        fn = KERNELS[kernel]
+        cuda = keys.is_cuda
+
+        # random tables (without changing the random state of the experiment)
+        rng_state = torch.get_rng_state()
+        bench_keys = torch.randn(min(keys.size(0), BENCH_ROWS), keys.size(1))
+        queries = torch.randn(candidates[-1], keys.size(1))
+        torch.set_rng_state(rng_state)
+        bench_keys.div_(bench_keys.norm(2, 1, keepdim=True).expand_as(bench_keys))
+        queries.div_(queries.norm(2, 1, keepdim=True).expand_as(queries))
+        bench_keys = bench_keys.type(keys.type())
+        queries = queries.cuda() if cuda else queries
+
+        speeds = {}
+        fn(queries[:candidates[0]], bench_keys)
+        for bs in candidates:
+            n_runs = 0
+            start = time.time()
+            while True:
+                fn(queries[:bs], bench_keys)
+                if cuda:
+                    torch.cuda.synchronize()
+                n_runs += 1
+                elapsed = time.time() - start
+                if elapsed >= BENCH_TIME:
+                    break
+            speeds[bs] = n_runs * bs / elapsed
+            if speeds[bs] < 0.8 * max(speeds.values()):
+                break
+        best = max(speeds.values())
+        bs = min(bs for bs, speed in speeds.items() if speed >= 0.95 * best)
+        logger.info('Block size of "%s" against %i x %i %s: %i (%s rows/s)'
+                    % (kernel, keys.size(0), keys.size(1), keys.type(), bs,
+                       ', '.join('%i: %.0f' % (k, speeds[k]) for k in sorted(speeds))))
+        return bs
+
+
+autotuner = BlockSizeTuner()
+
+
+def initialize_autotuner(params):
+    """
+    Configure the global block size tuner from the --autotune* parameters.
+    """
+    autotuner.configure(params.autotune, params.autotune_memory, params.autotune_cache)
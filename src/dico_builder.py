@@ -5,17 +5,30 @@
 from logging import getLogger
 import torch
 
-from .utils import get_nn_avg_dist
+from .utils import get_nn_avg_dist, mm_float
+from .profiler import profiler
+from .distributed import is_distributed, get_shard, merge_topk, get_nn_avg_dist_distributed
+from .pq import get_pq_candidates
+from .autotune import autotuner
 
 
 logger = getLogger()
 
 
-def get_candidates(emb1, emb2, params):
+@profiler.timed('get_candidates')
+def get_candidates(emb1, emb2, params, index1=None, index2=None):
     """
     Get best translation pairs candidates.
+    In distributed mode, every process scores the target words of its shard,
+    and the best candidates of all the shards are merged.
+    With the PQ indexes of `emb1` / `emb2` (see src.pq), nearest neighbors and
+    CSLS candidates are searched among approximate shortlists.
     """
-    bs = 128
+    assert index2 is None or not is_distributed()
+
+    # target words scored by this process
+    shard_start, shard_end = get_shard(emb2.size(0))
+    emb2_shard = emb2[shard_start:shard_end]
 
     all_scores = []
     all_targets = []
@@ -24,20 +37,27 @@ def get_candidates(emb1, emb2, params):
     n_src = emb1.size(0)
     if params.dico_max_rank > 0 and not params.dico_method.startswith('invsm_beta_'):
         n_src = params.dico_max_rank
+    profiler.count('get_candidates.queries', n_src)
+
+    # approximate nearest neighbors / CSLS
+    if index2 is not None and not params.dico_method.startswith('invsm_beta_'):
+        all_scores, all_targets = get_pq_candidates(emb1[:n_src], emb1, emb2, params.dico_method, index1, index2)
+        all_scores, all_targets = all_scores.cpu(), all_targets.cpu()
 
     # nearest neighbors
-    if params.dico_method == 'nn':
+    elif params.dico_method == 'nn':
 
         # for every source word
+        bs = autotuner.block_size('topk', emb2_shard, 128)
         for i in range(0, n_src, bs):
 
             # compute target words scores
-            scores = emb2.mm(emb1[i:min(n_src, i + bs)].transpose(0, 1)).transpose(0, 1)
+            scores = mm_float(emb1[i:min(n_src, i + bs)], emb2_shard)
             best_scores, best_targets = scores.topk(2, dim=1, largest=True, sorted=True)
 
             # update scores / potential targets
             all_scores.append(best_scores.cpu())
-            all_targets.append(best_targets.cpu())
+            all_targets.append((best_targets + shard_start).cpu())
 
         all_scores = torch.cat(all_scores, 0)
         all_targets = torch.cat(all_targets, 0)
@@ -46,12 +66,14 @@ def get_candidates(emb1, emb2, params):
     elif params.dico_method.startswith('invsm_beta_'):
 
         beta = float(params.dico_method[len('invsm_beta_'):])
+        emb1 = emb1.float()
+        bs = autotuner.block_size('softmax', emb1, 128)
 
         # for every target word
-        for i in range(0, emb2.size(0), bs):
+        for i in range(0, emb2_shard.size(0), bs):
 
             # compute source words scores
-            scores = emb1.mm(emb2[i:i + bs].transpose(0, 1))
+            scores = emb1.mm(emb2_shard[i:i + bs].float().transpose(0, 1))
             scores.mul_(beta).exp_()
             scores.div_(scores.sum(0, keepdim=True).expand_as(scores))
 
@@ -59,7 +81,7 @@ def get_candidates(emb1, emb2, params):
 
             # update scores / potential targets
             all_scores.append(best_scores.cpu())
-            all_targets.append((best_targets + i).cpu())
+            all_targets.append((best_targets + shard_start + i).cpu())
 
         all_scores = torch.cat(all_scores, 1)
         all_targets = torch.cat(all_targets, 1)
@@ -75,27 +97,39 @@ def get_candidates(emb1, emb2, params):
         knn = int(knn)
 
         # average distances to k nearest neighbors
-        average_dist1 = torch.from_numpy(get_nn_avg_dist(emb2, emb1, knn))
-        average_dist2 = torch.from_numpy(get_nn_avg_dist(emb1, emb2, knn))
-        average_dist1 = average_dist1.type_as(emb1)
-        average_dist2 = average_dist2.type_as(emb2)
+        # (in distributed mode, the source words neighborhoods are merged
+        # across the shards, and the target words ones are those of the shard)
+        if is_distributed():
+            average_dist1 = torch.from_numpy(get_nn_avg_dist_distributed(emb2, emb1, knn))
+        else:
+            average_dist1 = torch.from_numpy(get_nn_avg_dist(emb2, emb1, knn))
+        average_dist2 = torch.from_numpy(get_nn_avg_dist(emb1, emb2_shard, knn))
+        # (kept in float32 when the embeddings are stored in half precision)
+        if emb1.is_cuda:
+            average_dist1 = average_dist1.cuda()
+            average_dist2 = average_dist2.cuda()
 
         # for every source word
+        bs = autotuner.block_size('topk', emb2_shard, 128)
         for i in range(0, n_src, bs):
 
             # compute target words scores
-            scores = emb2.mm(emb1[i:min(n_src, i + bs)].transpose(0, 1)).transpose(0, 1)
+            scores = mm_float(emb1[i:min(n_src, i + bs)], emb2_shard)
             scores.mul_(2)
             scores.sub_(average_dist1[i:min(n_src, i + bs)][:, None] + average_dist2[None, :])
             best_scores, best_targets = scores.topk(2, dim=1, largest=True, sorted=True)
 
             # update scores / potential targets
             all_scores.append(best_scores.cpu())
-            all_targets.append(best_targets.cpu())
+            all_targets.append((best_targets + shard_start).cpu())
 
         all_scores = torch.cat(all_scores, 0)
         all_targets = torch.cat(all_targets, 0)
 
+    # best candidates of all the shards
+    if is_distributed():
+        all_scores, all_targets = merge_topk(all_scores, all_targets, 2)
+
     all_pairs = torch.cat([
         torch.arange(0, all_targets.size(0)).long().unsqueeze(1),
         all_targets[:, 0].unsqueeze(1)
@@ -137,9 +171,12 @@ def get_candidates(emb1, emb2, params):
     return all_pairs
 
 
-def build_dictionary(src_emb, tgt_emb, params, s2t_candidates=None, t2s_candidates=None):
+@profiler.timed('build_dictionary')
+def build_dictionary(src_emb, tgt_emb, params, s2t_candidates=None, t2s_candidates=None,
+                     src_index=None, tgt_index=None):
     """
-    Build a training dictionary given current embeddings / mapping.
+    Build a training dictionary given current embeddings / mapping
+    (and their PQ indexes, see get_candidates).
     """
     logger.info("Building the train dictionary ...")
     s2t = 'S2T' in params.dico_build
@@ -148,10 +185,10 @@ def build_dictionary(src_emb, tgt_emb, params, s2t_candidates=None, t2s_candidat
 
     if s2t:
         if s2t_candidates is None:
-            s2t_candidates = get_candidates(src_emb, tgt_emb, params)
+            s2t_candidates = get_candidates(src_emb, tgt_emb, params, src_index, tgt_index)
     if t2s:
         if t2s_candidates is None:
-            t2s_candidates = get_candidates(tgt_emb, src_emb, params)
+            t2s_candidates = get_candidates(tgt_emb, src_emb, params, tgt_index, src_index)
         t2s_candidates = torch.cat([t2s_candidates[:, 1:], t2s_candidates[:, :1]], 1)
 
     if params.dico_build == 'S2T':
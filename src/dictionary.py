@@ -2,11 +2,16 @@
 # LICENSE file in the root directory of this source tree.
 #
 
+import os
+import zlib
 from logging import getLogger
+import numpy as np
 
 
 logger = getLogger()
 
+COMPACT_MAGIC = 0x44494344  # "DCID"
+
 
 class Dictionary(object):
 
@@ -58,3 +63,274 @@ class Dictionary(object):
         Returns the index of the specified word.
         """
         return self.word2id[word]
+
+
+def _encode(word):
+    return word if isinstance(word, bytes) else word.encode('utf-8')
+
+
+def _hash(b):
+    return zlib.crc32(b) & 0xffffffff
+
+
+def _build_table(hashes):
+    """
+    Open-addressing (linear probing) table of a load factor <= 0.5, storing
+    word IDs + 1 (0 for empty slots). Words are inserted in rounds: a word
+    moves to the next slot when its current one is taken, and the first ID
+    claiming a free slot gets it, so a duplicated word resolves to its first ID.
+    """
+    n = len(hashes)
+    size = 2
+    while size < 2 * n:
+        size *= 2
+    mask = size - 1
+    table = np.zeros(size, dtype=np.int32)
+    slots = hashes.astype(np.int64) & mask
+    pending = np.arange(n, dtype=np.int64)
+    while len(pending) > 0:
+        pos = slots[pending]
+        free = table[pos] == 0
+        _pos, first = np.unique(pos[free], return_index=True)
+        placed = pending[free][first]
+        table[_pos] = placed + 1
+        done = np.zeros(n, dtype=bool)
+        done[placed] = True
+        pending = pending[~done[pending]]
+        slots[pending] = (slots[pending] + 1) & mask
+    return table
+
+
+class _Word2Id(object):
+    """
+    Read-only `word -> ID` view of a CompactDictionary, used as a dict.
+    """
+
+    def __init__(self, dico):
+        self.dico = dico
+
+    def __len__(self):
+        return len(self.dico)
+
+    def __contains__(self, word):
+        return self.dico.find(word) >= 0
+
+    def __getitem__(self, word):
+        i = self.dico.find(word)
+        if i < 0:
+            raise KeyError(word)
+        return i
+
+    def __iter__(self):
+        return iter(self.dico)
+
+    def get(self, word, default=None):
+        i = self.dico.find(word)
+        return default if i < 0 else i
+
+    def keys(self):
+        return list(self.dico)
+
+    def values(self):
+        return list(range(len(self.dico)))
+
+    def items(self):
+        return [(w, i) for i, w in enumerate(self.dico)]
+
+
+class _Id2Word(object):
+    """
+    Read-only `ID -> word` view of a CompactDictionary, used as a dict.
+    """
+
+    def __init__(self, dico):
+        self.dico = dico
+
+    def __len__(self):
+        return len(self.dico)
+
+    def __contains__(self, i):
+        return 0 <= i < len(self.dico)
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self.dico):
+            raise KeyError(i)
+        return self.dico[i]
+
+    def __iter__(self):
+        return iter(range(len(self.dico)))
+
+    def get(self, i, default=None):
+        return self.dico[i] if 0 <= i < len(self.dico) else default
+
+    def keys(self):
+        return list(range(len(self.dico)))
+
+    def values(self):
+        return list(self.dico)
+
+    def items(self):
+        return list(enumerate(self.dico))
+
+
+class CompactDictionary(object):
+    """
+    Dictionary stored in a few arrays instead of Python dicts: the UTF-8
+    words concatenated in one blob, their offsets and CRC32 hashes, and a
+    hash index. It can be saved and memory-mapped, and is immutable, so
+    that copies (e.g. `deepcopy(params)`) share it.
+    """
+
+    def __init__(self, blob, offsets, hashes, table, lang, check=False):
+        assert len(offsets) == len(hashes) + 1
+        self.blob = blob
+        self.offsets = offsets
+        self.hashes = hashes
+        self.table = table
+        self.mask = len(table) - 1
+        self.lang = lang
+        self.word2id = _Word2Id(self)
+        self.id2word = _Id2Word(self)
+        if check:
+            self.check_valid()
+
+    @classmethod
+    def from_words(cls, words, lang, check=False):
+        """
+        Build the dictionary of a list of words (word IDs are positions).
+        """
+        encoded = [_encode(w) for w in words]
+        n = len(encoded)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(b) for b in encoded), dtype=np.int64, count=n), out=offsets[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        hashes = np.fromiter((_hash(b) for b in encoded), dtype=np.uint32, count=n)
+        return cls(blob, offsets, hashes, _build_table(hashes), lang, check=check)
+
+    def save(self, path):
+        """
+        Save the dictionary in a single binary file (see `load`).
+        """
+        header = np.array([COMPACT_MAGIC, len(self), len(self.blob), len(self.table)], dtype=np.int64)
+        with open(path + '.tmp', 'wb') as f:
+            for x, dtype in [(header, np.int64), (self.offsets, np.int64), (self.hashes, np.uint32),
+                             (self.table, np.int32), (self.blob, np.uint8)]:
+                f.write(np.ascontiguousarray(x, dtype=dtype).tobytes())
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, lang, mmap=True, check=False):
+        """
+        Load a dictionary saved with `save`, memory-mapped by default.
+        """
+        header = np.fromfile(path, dtype=np.int64, count=4)
+        assert len(header) == 4 and header[0] == COMPACT_MAGIC, 'not a dictionary file: %s' % path
+        _, n, blob_len, table_len = [int(x) for x in header]
+        arrays = []
+        offset = header.nbytes
+        for dtype, count in [(np.int64, n + 1), (np.uint32, n), (np.int32, table_len), (np.uint8, blob_len)]:
+            if mmap:
+                x = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)) if count > 0 else np.zeros(0, dtype=dtype)
+            else:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    x = np.fromfile(f, dtype=dtype, count=count)
+            arrays.append(x)
+            offset += count * np.dtype(dtype).itemsize
+        assert offset == os.path.getsize(path), 'truncated dictionary file: %s' % path
+        offsets, hashes, table, blob = arrays
+        return cls(blob, offsets, hashes, table, lang, check=check)
+
+    def __len__(self):
+        """
+        Returns the number of words in the dictionary.
+        """
+        return len(self.hashes)
+
+    def __getitem__(self, i):
+        """
+        Returns the word of the specified index.
+        """
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        blob = self.blob.tobytes()
+        offsets = self.offsets.tolist()
+        for i in range(len(self)):
+            yield blob[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+    def __contains__(self, w):
+        """
+        Returns whether a word is in the dictionary.
+        """
+        return self.find(w) >= 0
+
+    def __eq__(self, y):
+        """
+        Compare the dictionary with another one.
+        """
+        if len(self) != len(y) or self.lang != y.lang:
+            return False
+        if isinstance(y, CompactDictionary):
+            return np.array_equal(self.offsets, y.offsets) and np.array_equal(self.blob, y.blob)
+        return all(self[i] == y[i] for i in range(len(y)))
+
+    def __ne__(self, y):
+        return not self == y
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def find(self, word):
+        """
+        Index of a word, -1 if it is not in the dictionary.
+        """
+        b = _encode(word)
+        h = _hash(b)
+        slot = h & self.mask
+        while True:
+            i = int(self.table[slot]) - 1
+            if i < 0:
+                return -1
+            if self.hashes[i] == h and self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes() == b:
+                return i
+            slot = (slot + 1) & self.mask
+
+    def index(self, word):
+        """
+        Returns the index of the specified word.
+        """
+        i = self.find(word)
+        if i < 0:
+            raise KeyError(word)
+        return i
+
+    def check_valid(self):
+        """
+        Check that the dictionary is valid: consistent offsets, every word
+        reachable from its hash slot, and no duplicated word.
+        """
+        n = len(self)
+        offsets = np.asarray(self.offsets)
+        assert offsets[0] == 0 and offsets[-1] == len(self.blob)
+        assert np.all(offsets[1:] >= offsets[:-1])
+        table = np.asarray(self.table, dtype=np.int64)
+        size = len(table)
+        assert size & (size - 1) == 0 and size >= n
+        # every ID is stored exactly once
+        slots = np.nonzero(table)[0]
+        ids = table[slots] - 1
+        assert len(ids) == n and np.array_equal(np.bincount(ids, minlength=n), np.ones(n, dtype=np.int64))
+        # with no empty slot between the hash slot of a word and its slot
+        home = self.hashes[ids].astype(np.int64) & self.mask
+        empty = np.concatenate([[0], np.cumsum(np.concatenate([table, table]) == 0)])
+        end = np.where(slots >= home, slots, slots + size)
+        assert np.all(empty[end + 1] - empty[home] == 0)
+        # duplicated words have the same hash
+        order = np.argsort(self.hashes, kind='mergesort')
+        same = np.nonzero(self.hashes[order][1:] == self.hashes[order][:-1])[0]
+        words = set()
+        for i in np.unique(np.concatenate([order[same], order[same + 1]])):
+            word = self[int(i)]
+            assert word not in words, 'Word "%s" appears several times' % word
+            words.add(word)
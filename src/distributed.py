@@ -0,0 +1,96 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+from logging import getLogger
+import torch
+import torch.distributed as dist
+
+from .utils import mm_float
+from .autotune import autotuner
+
+
+logger = getLogger()
+
+# process group of the dictionary induction (see init_distributed)
+_WORLD = {'size': 1, 'rank': 0}
+
+
+def init_distributed(params):
+    """
+    Join the process group of `params.world_size` processes (gloo backend,
+    `params.dist_url` rendez-vous, e.g. tcp://host:port or file:///shared/path).
+    Every process then owns a shard of the target words in `get_candidates`.
+    Processes other than the first one log in `exp_path/rank_i`, and do not
+    export the embeddings.
+    """
+    if params.world_size <= 1:
+        return
+    assert params.dist_url and 0 <= params.rank < params.world_size
+    assert params.exp_path, "distributed runs need an experiment path, shared by the processes"
+    dist.init_process_group(backend='gloo', init_method=params.dist_url,
+                            world_size=params.world_size, rank=params.rank)
+    _WORLD['size'] = params.world_size
+    _WORLD['rank'] = params.rank
+    if params.rank > 0:
+        params.exp_path = os.path.join(params.exp_path, 'rank_%i' % params.rank)
+        if not os.path.isdir(params.exp_path):
+            os.makedirs(params.exp_path)
+        params.export = False
+
+
+def is_distributed():
+    return _WORLD['size'] > 1
+
+
+def get_shard(n):
+    """
+    Rows [start, end) of a table of `n` rows owned by this process.
+    """
+    start = n * _WORLD['rank'] // _WORLD['size']
+    end = n * (_WORLD['rank'] + 1) // _WORLD['size']
+    return start, end
+
+
+def all_gather(x):
+    """
+    Tensors `x` of all the processes, concatenated along their last
+    dimension (in rank order). The exchange is an all-reduce of a zero
+    buffer where every process writes its slot, in float64, so that
+    float32 scores and word IDs are exchanged exactly.
+    """
+    size = _WORLD['size']
+    buffer = torch.zeros(*((size,) + tuple(x.size()))).double()
+    buffer[_WORLD['rank']].copy_(x.cpu().double())
+    dist.all_reduce(buffer)
+    return torch.cat([buffer[i] for i in range(size)], x.dim() - 1)
+
+
+def merge_topk(scores, targets, k):
+    """
+    Global top-k of the (n, k) scores / target IDs of every process.
+    """
+    all_scores = all_gather(scores).float()
+    all_targets = all_gather(targets).long()
+    scores, best = all_scores.topk(k, dim=1, largest=True, sorted=True)
+    return scores, all_targets.gather(1, best)
+
+
+def get_nn_avg_dist_distributed(emb, query, knn):
+    """
+    get_nn_avg_dist where every process owns a shard of the rows of `emb`:
+    the top-k similarities of the queries to each shard are merged.
+    """
+    start, end = get_shard(emb.size(0))
+    assert end - start >= knn, "shards with less than %i words" % knn
+    bs = autotuner.block_size('topk', emb[start:end], 1024)
+    best_distances = []
+    for i in range(0, query.size(0), bs):
+        distances = mm_float(query[i:i + bs], emb[start:end])
+        best_distances.append(distances.topk(knn, dim=1, largest=True, sorted=True)[0].cpu())
+    best_distances = all_gather(torch.cat(best_distances, 0)).float()
+    return best_distances.topk(knn, dim=1, largest=True, sorted=True)[0].mean(1).numpy()
@@ -1,5 +1,7 @@
 from .wordsim import get_wordsim_scores, get_crosslingual_wordsim_scores, get_wordanalogy_scores
 from .word_translation import get_word_translation_accuracy
 from .sent_translation import get_sent_translation_accuracy, load_europarl_data
+from .discriminator import get_dis_predictions, get_dis_accuracy
+from .proxy import MeanCosineProxy
 from .evaluator import Evaluator
 from .evaluator_Cycle import Evaluator_Cycle
\ No newline at end of file
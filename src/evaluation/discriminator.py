@@ -0,0 +1,69 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from collections import OrderedDict
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+
+# memory of the activations of a discriminator evaluation batch (bytes)
+DIS_EVAL_MEMORY = 256 * 1024 ** 2
+
+
+def get_dis_sample(n_words, n_samples, cuda):
+    """
+    Sorted random sample of `n_samples` word IDs (all the words if 0).
+    """
+    if n_samples <= 0 or n_samples >= n_words:
+        return None
+    ids = torch.from_numpy(np.sort(np.random.choice(n_words, n_samples, replace=False)))
+    return ids.cuda() if cuda else ids
+
+
+def get_dis_predictions(discriminator, emb, mapping=None, ids=None, mem=DIS_EVAL_MEMORY):
+    """
+    Discriminator predictions of the embeddings `emb` (of the rows `ids` only
+    if given), mapped with `mapping` if given. Batches are as large as
+    `mem` bytes of activations allow, and the predictions are written in
+    one float tensor.
+    """
+    n = emb.size(0) if ids is None else ids.size(0)
+    hid_dim = discriminator.dis_hid_dim if discriminator.dis_layers > 0 else 0
+    bs = max(1, mem // (4 * 2 * (emb.size(1) + hid_dim)))
+    preds = torch.FloatTensor(n)
+    preds = preds.cuda() if emb.is_cuda else preds
+    for i in range(0, n, bs):
+        x = emb[i:i + bs] if ids is None else emb.index_select(0, ids[i:i + bs])
+        x = Variable(x.float(), volatile=True)
+        if mapping is not None:
+            x = mapping(x)
+        preds[i:i + bs] = discriminator(x).data
+    return preds
+
+
+def get_dis_accuracy(discriminator, mapping, src_emb, tgt_emb, src_ids=None, tgt_ids=None):
+    """
+    Mean predictions and accuracy of the discriminator on the mapped source
+    and target embeddings (on the sampled words if given).
+    """
+    training = discriminator.training
+    discriminator.eval()
+    src_preds = get_dis_predictions(discriminator, src_emb, mapping, src_ids)
+    tgt_preds = get_dis_predictions(discriminator, tgt_emb, None, tgt_ids)
+    discriminator.train(training)
+
+    src_accu = float((src_preds >= 0.5).float().mean())
+    tgt_accu = float((tgt_preds < 0.5).float().mean())
+    n_src, n_tgt = src_preds.size(0), tgt_preds.size(0)
+    return OrderedDict([
+        ('dis_accu', (src_accu * n_src + tgt_accu * n_tgt) / (n_src + n_tgt)),
+        ('dis_src_pred', float(src_preds.mean())),
+        ('dis_tgt_pred', float(tgt_preds.mean())),
+        ('dis_src_accu', src_accu),
+        ('dis_tgt_accu', tgt_accu),
+    ])
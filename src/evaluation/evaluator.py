@@ -5,12 +5,14 @@
 from logging import getLogger
 from copy import deepcopy
 import numpy as np
-from torch.autograd import Variable
 
 from . import get_wordsim_scores, get_crosslingual_wordsim_scores
 from . import get_word_translation_accuracy
 from . import load_europarl_data, get_sent_translation_accuracy
+from .discriminator import get_dis_sample, get_dis_accuracy
+from .proxy import MeanCosineProxy
 from ..dico_builder import get_candidates, build_dictionary
+from ..profiler import profiler
 from src.utils import get_idf
 
 
@@ -42,6 +44,10 @@ class Evaluator(object):
             self.discriminator = trainer.discriminator
 
         self.params = deepcopy(trainer.params)
+        # word samples of eval_dis, by sample size
+        self.dis_samples = {}
+        # cheap mean-cosine criterion (built by proxy_mean_cosine)
+        self.proxy = None
         
         if not direction:
             temp=self.params.tgt_lang
@@ -49,18 +55,22 @@ class Evaluator(object):
             self.params.src_lang=temp
 
 
+    @profiler.timed('monolingual_wordsim')
     def monolingual_wordsim(self, to_log):
         """
         Evaluation on monolingual word similarity.
         """
         src_ws_scores = get_wordsim_scores(
             self.src_dico.lang, self.src_dico.word2id,
-            self.mapping(self.src_emb.weight).data.cpu().numpy()
+            self.src_emb.mapped(self.mapping, normalize=False).float().cpu().numpy()
         )
-        tgt_ws_scores = get_wordsim_scores(
-            self.tgt_dico.lang, self.tgt_dico.word2id,
-            self.tgt_emb.weight.data.cpu().numpy()
-        ) if self.params.tgt_lang else None
+        # the target embeddings are not mapped: only evaluate them once
+        if not hasattr(self, 'tgt_ws_scores'):
+            self.tgt_ws_scores = get_wordsim_scores(
+                self.tgt_dico.lang, self.tgt_dico.word2id,
+                self.tgt_emb.weight.float().cpu().numpy()
+            ) if self.params.tgt_lang else None
+        tgt_ws_scores = self.tgt_ws_scores
         if src_ws_scores is not None:
             src_ws_monolingual_scores = np.mean(list(src_ws_scores.values()))
             logger.info("Monolingual source word similarity score average: %.5f" % src_ws_monolingual_scores)
@@ -76,12 +86,13 @@ class Evaluator(object):
             logger.info("Monolingual word similarity score average: %.5f" % ws_monolingual_scores)
             to_log['ws_monolingual_scores'] = ws_monolingual_scores
 
+    @profiler.timed('crosslingual_wordsim')
     def crosslingual_wordsim(self, to_log):
         """
         Evaluation on cross-lingual word similarity.
         """
-        src_emb = self.mapping(self.src_emb.weight).data.cpu().numpy()
-        tgt_emb = self.tgt_emb.weight.data.cpu().numpy()
+        src_emb = self.src_emb.mapped(self.mapping, normalize=False).float().cpu().numpy()
+        tgt_emb = self.tgt_emb.weight.float().cpu().numpy()
         # cross-lingual wordsim evaluation
         src_tgt_ws_scores = get_crosslingual_wordsim_scores(
             self.src_dico.lang, self.src_dico.word2id, src_emb,
@@ -94,13 +105,14 @@ class Evaluator(object):
         to_log['ws_crosslingual_scores'] = ws_crosslingual_scores
         to_log.update({'src_tgt_' + k: v for k, v in src_tgt_ws_scores.items()})
 
+    @profiler.timed('word_translation')
     def word_translation(self, to_log):
         """
         Evaluation on word translation.
         """
         # mapped word embeddings
-        src_emb = self.mapping(self.src_emb.weight).data
-        tgt_emb = self.tgt_emb.weight.data
+        src_emb = self.src_emb.mapped(self.mapping, normalize=False)
+        tgt_emb = self.tgt_emb.weight
 
         for method in ['nn', 'csls_knn_10']:
             results = get_word_translation_accuracy(
@@ -110,6 +122,7 @@ class Evaluator(object):
             )
             to_log.update([('%s-%s' % (k, method), v) for k, v in results])
 
+    @profiler.timed('sent_translation')
     def sent_translation(self, to_log):
         """
         Evaluation on sentence translation.
@@ -134,8 +147,8 @@ class Evaluator(object):
             return
 
         # mapped word embeddings
-        src_emb = self.mapping(self.src_emb.weight).data
-        tgt_emb = self.tgt_emb.weight.data
+        src_emb = self.src_emb.mapped(self.mapping, normalize=False)
+        tgt_emb = self.tgt_emb.weight
 
         # get idf weights
         idf = get_idf(self.europarl_data, lg1, lg2, n_idf=n_idf)
@@ -162,15 +175,14 @@ class Evaluator(object):
             )
             to_log.update([('src_to_tgt_%s-%s' % (k, method), v) for k, v in results])
 
+    @profiler.timed('dist_mean_cosine')
     def dist_mean_cosine(self, to_log):
         """
         Mean-cosine model selection criterion.
         """
         # get normalized embeddings
-        src_emb = self.mapping(self.src_emb.weight).data
-        tgt_emb = self.tgt_emb.weight.data
-        src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-        tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
+        src_emb = self.src_emb.mapped(self.mapping)
+        tgt_emb = self.tgt_emb.mapped()
 
         # build dictionary
         for dico_method in ['nn', 'csls_knn_10']:
@@ -191,11 +203,24 @@ class Evaluator(object):
             if dico is None:
                 mean_cosine = -1e9
             else:
-                mean_cosine = (src_emb[dico[:dico_max_size, 0]] * tgt_emb[dico[:dico_max_size, 1]]).sum(1).mean()
+                mean_cosine = (src_emb[dico[:dico_max_size, 0]].float() * tgt_emb[dico[:dico_max_size, 1]].float()).sum(1).mean()
             logger.info("Mean cosine (%s method, %s build, %i max size): %.5f"
                         % (dico_method, _params.dico_build, dico_max_size, mean_cosine))
             to_log['mean_cosine-%s-%s-%i' % (dico_method, _params.dico_build, dico_max_size)] = mean_cosine
 
+    @profiler.timed('proxy_mean_cosine')
+    def proxy_mean_cosine(self, to_log, n_samples=1000):
+        """
+        Cheap mean-cosine criterion, on a fixed sample of `n_samples`
+        frequent source words (see MeanCosineProxy).
+        """
+        if self.proxy is None:
+            self.proxy = MeanCosineProxy(self.src_emb.weight, self.tgt_emb.weight, n_samples)
+        mean_cosine = self.proxy(self.mapping.weight.data)
+        logger.info("Proxy mean cosine (csls_knn_10, %i sampled words): %.5f" % (n_samples, mean_cosine))
+        to_log['proxy_mean_cosine'] = mean_cosine
+
+    @profiler.timed('all_eval')
     def all_eval(self, to_log):
         """
         Run all evaluations.
@@ -206,38 +231,27 @@ class Evaluator(object):
         self.sent_translation(to_log)
         self.dist_mean_cosine(to_log)
 
-    def eval_dis(self, to_log):
+    @profiler.timed('eval_dis')
+    def eval_dis(self, to_log, n_samples=0):
         """
-        Evaluate discriminator predictions and accuracy.
+        Evaluate discriminator predictions and accuracy, on the whole
+        vocabularies or on a fixed sample of `n_samples` words per language.
         """
-        bs = 128
-        src_preds = []
-        tgt_preds = []
-
-        self.discriminator.eval()
-
-        for i in range(0, self.src_emb.num_embeddings, bs):
-            emb = Variable(self.src_emb.weight[i:i + bs].data, volatile=True)
-            preds = self.discriminator(self.mapping(emb))
-            src_preds.extend(preds.data.cpu().tolist())
-
-        for i in range(0, self.tgt_emb.num_embeddings, bs):
-            emb = Variable(self.tgt_emb.weight[i:i + bs].data, volatile=True)
-            preds = self.discriminator(emb)
-            tgt_preds.extend(preds.data.cpu().tolist())
-
-        src_pred = np.mean(src_preds)
-        tgt_pred = np.mean(tgt_preds)
-        logger.info("Discriminator source / target predictions: %.5f / %.5f"
-                    % (src_pred, tgt_pred))
-
-        src_accu = np.mean([x >= 0.5 for x in src_preds])
-        tgt_accu = np.mean([x < 0.5 for x in tgt_preds])
-        dis_accu = ((src_accu * self.src_emb.num_embeddings + tgt_accu * self.tgt_emb.num_embeddings) /
-                    (self.src_emb.num_embeddings + self.tgt_emb.num_embeddings))
-        logger.info("Discriminator source / target / global accuracy: %.5f / %.5f / %.5f"
-                    % (src_accu, tgt_accu, dis_accu))
-
-        to_log['dis_accu'] = dis_accu
-        to_log['dis_src_pred'] = src_pred
-        to_log['dis_tgt_pred'] = tgt_pred
+        if n_samples not in self.dis_samples:
+            self.dis_samples[n_samples] = (
+                get_dis_sample(self.src_emb.num_embeddings, n_samples, self.params.cuda),
+                get_dis_sample(self.tgt_emb.num_embeddings, n_samples, self.params.cuda),
+            )
+        src_ids, tgt_ids = self.dis_samples[n_samples]
+        scores = get_dis_accuracy(self.discriminator, self.mapping, self.src_emb.weight, self.tgt_emb.weight,
+                                  src_ids, tgt_ids)
+
+        log = logger.info if n_samples == 0 else logger.debug
+        log("Discriminator source / target predictions: %.5f / %.5f"
+            % (scores['dis_src_pred'], scores['dis_tgt_pred']))
+        log("Discriminator source / target / global accuracy: %.5f / %.5f / %.5f"
+            % (scores['dis_src_accu'], scores['dis_tgt_accu'], scores['dis_accu']))
+
+        to_log['dis_accu'] = scores['dis_accu']
+        to_log['dis_src_pred'] = scores['dis_src_pred']
+        to_log['dis_tgt_pred'] = scores['dis_tgt_pred']
@@ -0,0 +1,59 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import numpy as np
+import torch
+
+from ..retrieval import map_embeddings, csls_radii, translate
+
+
+class MeanCosineProxy(object):
+    """
+    Cheap version of the mean-cosine criterion, to validate the mapping
+    within the epochs: mean cosine of the mutual CSLS nearest neighbors of a
+    fixed random sample of frequent source words, among the frequent target
+    words. The CSLS radii of the frequent words are the expensive part: they
+    are cached and recomputed every `radii_refresh` evaluations only.
+    """
+
+    def __init__(self, src_emb, tgt_emb, n_samples=1000, max_rank=10000, knn=10, radii_refresh=10):
+        """
+        `src_emb` / `tgt_emb` are the (normalized) embedding tables.
+        """
+        self.cuda = src_emb.is_cuda
+        self.src_emb = src_emb[:max_rank]
+        self.tgt_emb = map_embeddings(tgt_emb[:max_rank], cuda=self.cuda)
+        self.knn = knn
+        self.radii_refresh = radii_refresh
+        n_src = self.src_emb.size(0)
+        samples = np.sort(np.random.choice(n_src, min(n_samples, n_src), replace=False))
+        self.samples = torch.from_numpy(samples)
+        self.samples = self.samples.cuda() if self.cuda else self.samples
+        self.n_evals = 0
+        self.src_radii = None
+        self.tgt_radii = None
+
+    def __call__(self, mapping):
+        """
+        Criterion for the given mapping weight (-1e9 without mutual neighbors).
+        """
+        src_emb = map_embeddings(self.src_emb, mapping, cuda=self.cuda)
+        if self.n_evals % self.radii_refresh == 0:
+            self.src_radii, self.tgt_radii = csls_radii(src_emb, self.tgt_emb, self.knn)
+        self.n_evals += 1
+
+        # source -> target -> source translations of the sampled words
+        queries = src_emb.index_select(0, self.samples)
+        _, s2t = translate(queries, self.tgt_emb, 1, self.src_radii.index_select(0, self.samples), self.tgt_radii)
+        s2t = s2t[:, 0]
+        targets = self.tgt_emb.index_select(0, s2t)
+        _, t2s = translate(targets, src_emb, 1, self.tgt_radii.index_select(0, s2t), self.src_radii)
+        mutual = t2s[:, 0] == self.samples
+
+        if mutual.sum() == 0:
+            return -1e9
+        return float((queries * targets).sum(1).masked_select(mutual).mean())
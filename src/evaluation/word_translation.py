@@ -7,7 +7,9 @@ from logging import getLogger
 import numpy as np
 import torch
 
-from ..utils import get_nn_avg_dist
+from ..utils import get_nn_avg_dist, mm_float
+from ..retrieval import mapped_embeddings
+from ..autotune import autotuner
 
 
 DIC_EVAL_PATH = 'data/crosslingual/dictionaries/'
@@ -99,21 +101,23 @@ def get_word_translation_accuracy(lang1, word2id1, emb1, lang2, word2id2, emb2,
 
 def get_word_translation_accuracy_score(dico, emb1, emb2, method):
     # normalize word embeddings
-    emb1 = emb1 / emb1.norm(2, 1, keepdim=True).expand_as(emb1)
-    emb2 = emb2 / emb2.norm(2, 1, keepdim=True).expand_as(emb2)
+    # (in the precision of the embeddings, scores are computed in float32)
+    emb1 = mapped_embeddings(emb1)
+    emb2 = mapped_embeddings(emb2)
 
     # nearest neighbors
     if method == 'nn':
         query = emb1[dico[:, 0]]
-        scores = query.mm(emb2.transpose(0, 1))
+        scores = mm_float(query, emb2)
 
     # inverted softmax
     elif method.startswith('invsm_beta_'):
         beta = float(method[len('invsm_beta_'):])
-        bs = 128
+        emb1 = emb1.float()
+        bs = autotuner.block_size('softmax', emb1, 128)
         word_scores = []
         for i in range(0, emb2.size(0), bs):
-            scores = emb1.mm(emb2[i:i + bs].transpose(0, 1))
+            scores = emb1.mm(emb2[i:i + bs].float().transpose(0, 1))
             scores.mul_(beta).exp_()
             scores.div_(scores.sum(0, keepdim=True).expand_as(scores))
             word_scores.append(scores.index_select(0, dico[:, 0]))
@@ -127,11 +131,14 @@ def get_word_translation_accuracy_score(dico, emb1, emb2, method):
         knn = int(knn)
         average_dist1 = get_nn_avg_dist(emb2, emb1, knn)
         average_dist2 = get_nn_avg_dist(emb1, emb2, knn)
-        average_dist1 = torch.from_numpy(average_dist1).type_as(emb1)
-        average_dist2 = torch.from_numpy(average_dist2).type_as(emb2)
+        average_dist1 = torch.from_numpy(average_dist1)
+        average_dist2 = torch.from_numpy(average_dist2)
+        if emb1.is_cuda:
+            average_dist1 = average_dist1.cuda()
+            average_dist2 = average_dist2.cuda()
         # queries / scores
         query = emb1[dico[:, 0]]
-        scores = query.mm(emb2.transpose(0, 1))
+        scores = mm_float(query, emb2)
         scores.mul_(2)
         scores.sub_(average_dist1[dico[:, 0]][:, None] + average_dist2[None, :])
 
@@ -0,0 +1,127 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import time
+from logging import getLogger
+from collections import defaultdict
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+
+logger = getLogger()
+
+# iterations of a worker between two progress reports
+LOG_INTERVAL = 100
+
+
+def share_trainer(trainer):
+    """
+    Move the embedding tables and the trained parameters of a trainer
+    (Trainer or Trainer_Cycle) to shared memory, before forking workers.
+    """
+    for name in ['src_emb', 'tgt_emb', 'mapping', 'mapping1', 'mapping2',
+                 'discriminator', 'discriminator1', 'discriminator2']:
+        module = getattr(trainer, name, None)
+        if isinstance(module, torch.nn.Module):
+            module.share_memory()
+
+
+def _locked(fn, lock):
+    def locked_fn(*args, **kwargs):
+        with lock:
+            return fn(*args, **kwargs)
+    return locked_fn
+
+
+def _worker(trainer, step, rank, n_iters, seed, n_threads, lock, queue):
+    """
+    Run `n_iters` training iterations on the shared parameters, without
+    locks (Hogwild), except for the orthogonalization of the mappings.
+    """
+    torch.set_num_threads(n_threads)
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    # W <- (1 + beta) W - beta W W^T W reads and writes the whole mapping:
+    # one worker at a time
+    trainer.orthogonalize = _locked(trainer.orthogonalize, lock)
+    stats = defaultdict(list)
+    n_words_proc = 0
+    for n_iter in range(n_iters):
+        n_words_proc += step(trainer, stats)
+        if (n_iter + 1) % LOG_INTERVAL == 0 or n_iter == n_iters - 1:
+            queue.put((rank, n_iter % LOG_INTERVAL + 1, n_words_proc, dict(stats)))
+            n_words_proc = 0
+            stats = defaultdict(list)
+    queue.put((rank, 0, None, None))
+
+
+def hogwild_epoch(trainer, step, n_iters, n_workers, log_stats):
+    """
+    Train for `n_iters` iterations with `n_workers` forked processes that
+    share the parameters of the trainer (see `share_trainer`). `step(trainer,
+    stats)` runs one iteration, appends its costs to the `stats` lists and
+    returns the number of processed words. Every worker has its own
+    optimizer state (SGD has none), and learning rate updates between
+    epochs are seen by the next epoch's workers.
+    `log_stats(n_iter, stats, samples_per_s)` is called with the costs
+    reported by the workers, and the number of iterations done by all of
+    them. Return the number of processed words / s.
+    """
+    ctx = mp.get_context('fork') if hasattr(mp, 'get_context') else mp
+    lock = ctx.Lock()
+    queue = ctx.Queue()
+    n_threads = max(1, torch.get_num_threads() // n_workers)
+    seeds = np.random.randint(1 << 31, size=n_workers)
+    workers = [ctx.Process(target=_worker, args=(trainer, step, rank, n_iters // n_workers + (rank < n_iters % n_workers),
+                                                  int(seeds[rank]), n_threads, lock, queue))
+               for rank in range(n_workers)]
+    start = tic = time.time()
+    for worker in workers:
+        worker.start()
+
+    # progress of the workers, logged once all of them reported
+    n_running = n_workers
+    n_reports = 0
+    n_iters_done = 0
+    n_words_proc = 0
+    total_words = 0
+    stats = defaultdict(list)
+    finished = set()
+    while n_running > 0:
+        try:
+            rank, n_iters_proc, n_words, worker_stats = queue.get(timeout=1)
+        except Empty:
+            # workers that stopped without completing their iterations (error / NaN)
+            if any(w.exitcode is not None for w in workers if w.pid not in finished):
+                for w in workers:
+                    w.terminate()
+                raise Exception('A Hogwild worker stopped before the end of the epoch')
+            continue
+        if n_words is None:
+            n_running -= 1
+            finished.add(workers[rank].pid)
+        else:
+            n_reports += 1
+            n_iters_done += n_iters_proc
+            n_words_proc += n_words
+            total_words += n_words
+            for k, v in worker_stats.items():
+                stats[k].extend(v)
+        if n_words_proc > 0 and (n_reports % n_workers == 0 or n_running == 0):
+            log_stats(n_iters_done, stats, n_words_proc / max(time.time() - tic, 1e-6))
+            tic = time.time()
+            n_words_proc = 0
+            stats = defaultdict(list)
+
+    for worker in workers:
+        worker.join()
+    return total_words / max(time.time() - start, 1e-6)
@@ -0,0 +1,149 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import io
+import gzip
+import time
+from logging import getLogger
+import numpy as np
+from numpy.lib.format import open_memmap
+import torch
+
+from .retrieval import map_embeddings, translate
+
+
+logger = getLogger()
+
+FORMATS = ['tsv', 'npz']
+
+
+def _save_npy(path, array):
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.rename(path + '.tmp', path)
+
+
+def shard_path(output, direction, shard_id, fmt):
+    """
+    Path of a lexicon shard.
+    """
+    return os.path.join(output, '%s.%05i.%s' % (direction, shard_id, 'tsv.gz' if fmt == 'tsv' else 'npz'))
+
+
+def shards(n, shard_size):
+    """
+    (shard_id, start, end) of `n` rows.
+    """
+    return [(i, start, min(start + shard_size, n)) for i, start in enumerate(range(0, n, shard_size))]
+
+
+def prepare_matrix(path, emb, mapping=None, bs=65536):
+    """
+    Write the normalized (and mapped) embeddings to a .npy file, unless a
+    previous run already did. Workers memory-map it.
+    """
+    if os.path.isfile(path):
+        return
+    tic = time.time()
+    dim = emb.shape[1] if mapping is None else mapping.size(0)
+    out = open_memmap(path + '.tmp.npy', mode='w+', dtype=np.float32, shape=(emb.shape[0], dim))
+    map_embeddings(emb, mapping, bs=bs, out=out)
+    out.flush()
+    del out
+    os.rename(path + '.tmp.npy', path)
+    logger.info('Wrote %i normalized%s embeddings to %s (%.2fs)'
+                % (emb.shape[0], '' if mapping is None else ' mapped', path, time.time() - tic))
+
+
+class LexiconWorker(object):
+    """
+    Shard jobs of a lexicon. Matrices are memory-mapped, and scores are
+    computed `bs` x `key_bs` at a time, so that the memory of a worker only
+    depends on the shard and block sizes.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._arrays = {}
+        self._words = {}
+
+    def array(self, path):
+        if path not in self._arrays:
+            self._arrays[path] = np.load(path, mmap_mode='r')
+        return self._arrays[path]
+
+    def words(self, path):
+        if path not in self._words:
+            with io.open(path, 'r', encoding='utf-8') as f:
+                self._words[path] = [line.rstrip('\n') for line in f]
+        return self._words[path]
+
+    def avg_sim(self, queries, keys):
+        """
+        Average similarity of each query to its `knn` nearest keys.
+        """
+        scores, _ = translate(queries, keys, self.config['knn'], bs=self.config['bs'], key_bs=self.config['key_bs'])
+        return scores.mean(1)
+
+    def key_radii(self, job):
+        """
+        CSLS radii of a shard of keys.
+        """
+        direction, shard_id, start, end = job
+        d = self.config['directions'][direction]
+        path = os.path.join(self.config['work_dir'], 'key_radii.%s.%05i.npy' % (direction, shard_id))
+        if not os.path.isfile(path):
+            keys = torch.from_numpy(np.array(self.array(d['keys'])[start:end]))
+            _save_npy(path, self.avg_sim(keys, self.array(d['queries'])).numpy())
+        return path
+
+    def translate(self, job):
+        """
+        Top-k translations of a shard of queries.
+        """
+        direction, shard_id, start, end = job
+        config = self.config
+        d = config['directions'][direction]
+        path = shard_path(config['output'], direction, shard_id, config['format'])
+        if os.path.isfile(path):
+            return path, 0
+        queries = torch.from_numpy(np.array(self.array(d['queries'])[start:end]))
+        keys = self.array(d['keys'])
+        if config['knn'] > 0:
+            scores, ids = translate(queries, keys, config['k'], self.avg_sim(queries, keys),
+                                    self.array(d['key_radii']), bs=config['bs'], key_bs=config['key_bs'])
+        else:
+            scores, ids = translate(queries, keys, config['k'], bs=config['bs'], key_bs=config['key_bs'])
+        scores, ids = scores.numpy(), ids.numpy().astype(np.int32)
+        if config['format'] == 'tsv':
+            src_words = self.words(d['src_vocab'])
+            tgt_words = self.words(d['tgt_vocab'])
+            with gzip.open(path + '.tmp', 'wb') as f:
+                for i in range(end - start):
+                    word = src_words[start + i]
+                    f.write(u''.join(u'%s\t%s\t%.6f\n' % (word, tgt_words[j], s)
+                                     for j, s in zip(ids[i], scores[i])).encode('utf-8'))
+        else:
+            with open(path + '.tmp', 'wb') as f:
+                np.savez_compressed(f, start=start, ids=ids, scores=scores)
+        os.rename(path + '.tmp', path)
+        return path, end - start
+
+
+_worker = None
+
+
+def init_worker(config, n_threads):
+    global _worker
+    torch.set_num_threads(n_threads)
+    _worker = LexiconWorker(config)
+
+
+def run_job(job):
+    kind, job = job
+    return kind, job, getattr(_worker, kind)(job)
@@ -0,0 +1,169 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import json
+import time
+from collections import OrderedDict
+from logging import getLogger
+
+
+METRICS_FILE = 'metrics.jsonl'
+
+
+logger = getLogger()
+
+
+def _to_json(x):
+    # numpy / torch scalars
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return str(x)
+
+
+class MetricsWriter(object):
+    """
+    Append-only metrics stream of an experiment: one compact JSON record
+    per line, written in batches. The first line is a header holding the
+    experiment name, its tags and its parameters, so that experiments can be
+    searched without reading their records.
+    """
+
+    def __init__(self, path, tags=None, params=None, flush_every=100, flush_secs=30):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self._buffer = []
+        self._last_flush = time.time()
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            header = OrderedDict([
+                ('stream', '__header__'),
+                ('expname', os.path.basename(os.path.dirname(os.path.abspath(path)))),
+                ('created', time.time()),
+                ('tags', list(tags or [])),
+                ('params', dict((k, v) for k, v in vars(params).items()
+                                if isinstance(v, (int, float, str, bool)) or v is None) if params is not None else {}),
+            ])
+            self._buffer.append(json.dumps(header, separators=(',', ':'), default=_to_json))
+            self.flush()
+
+    def write(self, stream, record):
+        """
+        Append a record (a dictionary of JSON serializable values) to `stream`.
+        """
+        line = OrderedDict([('stream', stream), ('time', time.time())])
+        line.update(record)
+        self._buffer.append(json.dumps(line, separators=(',', ':'), default=_to_json))
+        if len(self._buffer) >= self.flush_every or time.time() - self._last_flush >= self.flush_secs:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(self._buffer) + '\n')
+            self._buffer = []
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+
+
+class MetricsReader(object):
+    """
+    Read the metrics streams of the experiments stored in `root`.
+    Files are read line by line, so runs can be read while they are still going.
+    """
+
+    def __init__(self, root='./dumped'):
+        self.root = root
+
+    def path(self, expname):
+        return os.path.join(self.root, expname, METRICS_FILE)
+
+    def header(self, expname):
+        """
+        Return the header of an experiment (None if it has no metrics).
+        """
+        path = self.path(expname)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return None
+        return header if header.get('stream') == '__header__' else None
+
+    def find(self, tags=None, **params):
+        """
+        Names of the experiments having all the given tags and parameter values.
+        Only the headers are read.
+        """
+        found = []
+        if not os.path.isdir(self.root):
+            return found
+        for expname in sorted(os.listdir(self.root)):
+            header = self.header(expname)
+            if header is None:
+                continue
+            if not all(tag in header['tags'] for tag in (tags or [])):
+                continue
+            if not all(header['params'].get(k) == v for k, v in params.items()):
+                continue
+            found.append(expname)
+        return found
+
+    def records(self, expname, stream=None, keys=None):
+        """
+        Iterate over the records of an experiment, optionally restricted
+        to one stream and to a subset of keys.
+        """
+        with open(self.path(expname)) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # last line of a run that is still being written
+                    continue
+                if record['stream'] == '__header__' or (stream is not None and record['stream'] != stream):
+                    continue
+                if keys is not None:
+                    record = dict((k, record[k]) for k in keys if k in record)
+                yield record
+
+    def load(self, expname, stream=None, keys=None):
+        """
+        Columns of the records of an experiment: key -> list of values.
+        """
+        columns = OrderedDict()
+        for record in self.records(expname, stream, keys):
+            for k, v in record.items():
+                columns.setdefault(k, []).append(v)
+        return columns
+
+    def plot_info(self, expname):
+        """
+        Rebuild the `plot_info` dictionary previously dumped by `unsupervised.py`.
+        """
+        plot_info = OrderedDict([('expname', expname), ('iter_train', []), ('epoch_train', []), ('iter_refine', [])])
+        for record in self.records(expname):
+            stream = record.pop('stream')
+            record.pop('time', None)
+            if stream == 'train_loss':
+                for k, v in record.items():
+                    plot_info.setdefault(k, []).append(v)
+                continue
+            direction = record.pop('direction')
+            if stream == 'train' and direction == 't':
+                plot_info['epoch_train'].append(record['n_epoch'])
+            if stream == 'refine' and direction == 't':
+                plot_info['iter_refine'].append(record['n_iter'])
+            for k, v in record.items():
+                plot_info.setdefault('%s_%s_%s' % (k, direction, stream), []).append(v)
+        plot_info['iter_train'] = plot_info.pop('n_iter', [])
+        return plot_info
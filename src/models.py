@@ -5,7 +5,9 @@
 import torch
 from torch import nn
 
-from .utils import load_external_embeddings, normalize_embeddings
+from .utils import normalize_embeddings, cast_embeddings
+from .vocab import load_embeddings
+from .retrieval import mapped_embeddings
 
 
 class Discriminator(nn.Module):
@@ -35,25 +37,97 @@ class Discriminator(nn.Module):
         return self.layers(x).view(-1)
 
 
-def build_model(params, with_dis):
+class FrozenEmbedding(nn.Module):
     """
-    Build all components of the model.
+    Embedding table that is never trained: the weights are a buffer (not a
+    parameter, and without gradient), and lookups are `index_select` gathers.
     """
+
+    def __init__(self, weight):
+        super(FrozenEmbedding, self).__init__()
+        self.register_buffer('weight', weight)
+
+    @property
+    def num_embeddings(self):
+        return self.weight.size(0)
+
+    @property
+    def embedding_dim(self):
+        return self.weight.size(1)
+
+    def forward(self, ids):
+        return self.weight.index_select(0, ids)
+
+    def mapped(self, mapping=None, normalize=True):
+        """
+        Whole table mapped by `mapping` (a linear layer) and / or normalized,
+        computed on the tensors (no graph is built).
+        """
+        return mapped_embeddings(self.weight, None if mapping is None else mapping.weight.data, normalize=normalize)
+
+
+def build_embeddings(params, shared_embeddings=None):
+    """
+    Build the source / target embedding layers.
+    `shared_embeddings` is an optional (src_dico, src_emb, tgt_dico, tgt_emb)
+    tuple of already normalized tensors, used by reference instead of
+    reloading and normalizing the embedding files.
+    The tables are stored in `params.emb_dtype` (float32 by default).
+    """
+    emb_dtype = getattr(params, 'emb_dtype', 'float32')
+    if shared_embeddings is not None:
+        src_dico, _src_emb, tgt_dico, _tgt_emb = shared_embeddings
+        params.src_dico = src_dico
+        src_emb = FrozenEmbedding(cast_embeddings(_src_emb, emb_dtype))
+        tgt_emb = None
+        if tgt_dico is not None:
+            params.tgt_dico = tgt_dico
+            tgt_emb = FrozenEmbedding(cast_embeddings(_tgt_emb, emb_dtype))
+        if params.cuda:
+            src_emb.cuda()
+            if tgt_emb is not None:
+                tgt_emb.cuda()
+        return src_emb, tgt_emb
+
     # source embeddings
-    src_dico, _src_emb = load_external_embeddings(params, source=True)
+    src_dico, _src_emb = load_embeddings(params, source=True)
     params.src_dico = src_dico
-    src_emb = nn.Embedding(len(src_dico), params.emb_dim, sparse=True)
-    src_emb.weight.data.copy_(_src_emb)
+    src_emb = FrozenEmbedding(_src_emb)
 
     # target embeddings
     if params.tgt_lang:
-        tgt_dico, _tgt_emb = load_external_embeddings(params, source=False)
+        tgt_dico, _tgt_emb = load_embeddings(params, source=False)
         params.tgt_dico = tgt_dico
-        tgt_emb = nn.Embedding(len(tgt_dico), params.emb_dim, sparse=True)
-        tgt_emb.weight.data.copy_(_tgt_emb)
+        tgt_emb = FrozenEmbedding(_tgt_emb)
     else:
         tgt_emb = None
 
+    # cuda
+    if params.cuda:
+        src_emb.cuda()
+        if params.tgt_lang:
+            tgt_emb.cuda()
+
+    # normalize embeddings
+    normalize_embeddings(src_emb.weight, params.normalize_embeddings)
+    if params.tgt_lang:
+        normalize_embeddings(tgt_emb.weight, params.normalize_embeddings)
+
+    # precision of the stored tables
+    src_emb.weight = cast_embeddings(src_emb.weight, emb_dtype)
+    if params.tgt_lang:
+        tgt_emb.weight = cast_embeddings(tgt_emb.weight, emb_dtype)
+
+    return src_emb, tgt_emb
+
+
+def build_model(params, with_dis, shared_embeddings=None):
+    """
+    Build all components of the model.
+    """
+    # source / target embeddings
+    src_emb, tgt_emb = build_embeddings(params, shared_embeddings)
+
     # mapping
     mapping = nn.Linear(params.emb_dim, params.emb_dim, bias=False)
     if getattr(params, 'map_id_init', True):
@@ -64,38 +138,18 @@ def build_model(params, with_dis):
 
     # cuda
     if params.cuda:
-        src_emb.cuda()
-        if params.tgt_lang:
-            tgt_emb.cuda()
         mapping.cuda()
         if with_dis:
             discriminator.cuda()
 
-    # normalize embeddings
-    normalize_embeddings(src_emb.weight.data, params.normalize_embeddings)
-    if params.tgt_lang:
-        normalize_embeddings(tgt_emb.weight.data, params.normalize_embeddings)
-
     return src_emb, tgt_emb, mapping, discriminator
 
-def build_model_cycle(params, with_dis, cycle=True):
+def build_model_cycle(params, with_dis, cycle=True, shared_embeddings=None):
     """
     Build all components of the model.
     """
-    # source embeddings
-    src_dico, _src_emb = load_external_embeddings(params, source=True)
-    params.src_dico = src_dico
-    src_emb = nn.Embedding(len(src_dico), params.emb_dim, sparse=True)
-    src_emb.weight.data.copy_(_src_emb)
-
-    # target embeddings
-    if params.tgt_lang:
-        tgt_dico, _tgt_emb = load_external_embeddings(params, source=False)
-        params.tgt_dico = tgt_dico
-        tgt_emb = nn.Embedding(len(tgt_dico), params.emb_dim, sparse=True)
-        tgt_emb.weight.data.copy_(_tgt_emb)
-    else:
-        tgt_emb = None
+    # source / target embeddings
+    src_emb, tgt_emb = build_embeddings(params, shared_embeddings)
 
     # mapping
     mapping1 = nn.Linear(params.emb_dim, params.emb_dim, bias=False)
@@ -110,19 +164,11 @@ def build_model_cycle(params, with_dis, cycle=True):
 
     # cuda
     if params.cuda:
-        src_emb.cuda()
-        if params.tgt_lang:
-            tgt_emb.cuda()
         mapping1.cuda()
         mapping2.cuda()
         if with_dis:
             discriminator1.cuda()
             discriminator2.cuda()
 
-    # normalize embeddings
-    normalize_embeddings(src_emb.weight.data, params.normalize_embeddings)
-    if params.tgt_lang:
-        normalize_embeddings(tgt_emb.weight.data, params.normalize_embeddings)
-
     return src_emb, tgt_emb, mapping1, mapping2, discriminator1, discriminator2
 
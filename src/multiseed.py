@@ -0,0 +1,359 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+from logging import getLogger
+from copy import deepcopy
+import numpy as np
+import torch
+from torch import nn
+from torch.autograd import Variable
+from torch.nn import functional as F
+
+from .utils import get_optimizer, clip_parameters
+from .models import Discriminator
+from .dico_builder import get_candidates
+from .retrieval import mapped_embeddings
+from .profiler import profiler
+
+
+logger = getLogger()
+
+
+class StackedMapping(nn.Module):
+    """
+    Linear mappings (without bias) of several seeds, stored in one
+    (n_seeds, dim, dim) weight and applied with a batched matrix multiply
+    to (n_seeds, bs, dim) inputs.
+    """
+
+    def __init__(self, weight):
+        super(StackedMapping, self).__init__()
+        self.weight = nn.Parameter(weight)
+
+    @staticmethod
+    def from_mappings(mappings):
+        return StackedMapping(torch.stack([m.weight.data for m in mappings]))
+
+    def forward(self, x):
+        return x.bmm(self.weight.transpose(1, 2))
+
+    def unstack(self, k, mapping):
+        mapping.weight.data.copy_(self.weight.data[k])
+
+    def select(self, ids):
+        return StackedMapping(self.weight.data.index_select(0, ids))
+
+
+class StackedDiscriminator(nn.Module):
+    """
+    Discriminators of several seeds (see models.Discriminator), applied with
+    batched matrix multiplies to (n_seeds, bs, dim) inputs.
+    Linear layer `i` has a (n_seeds, input_dim, output_dim) weight and a
+    (n_seeds, 1, output_dim) bias.
+    """
+
+    def __init__(self, weights, biases, params):
+        super(StackedDiscriminator, self).__init__()
+        self.dis_layers = params.dis_layers
+        self.dis_hid_dim = params.dis_hid_dim
+        self.params = params
+        self.weights = nn.ParameterList([nn.Parameter(w) for w in weights])
+        self.biases = nn.ParameterList([nn.Parameter(b) for b in biases])
+        self.input_dropout = nn.Dropout(params.dis_input_dropout)
+        self.dropout = nn.Dropout(params.dis_dropout)
+
+    @staticmethod
+    def from_discriminators(discriminators, params):
+        layers = [[m for m in d.layers if isinstance(m, nn.Linear)] for d in discriminators]
+        weights = [torch.stack([l[i].weight.data.t() for l in layers]) for i in range(params.dis_layers + 1)]
+        biases = [torch.stack([l[i].bias.data.unsqueeze(0) for l in layers]) for i in range(params.dis_layers + 1)]
+        return StackedDiscriminator(weights, biases, params)
+
+    def forward(self, x):
+        x = self.input_dropout(x)
+        for i in range(self.dis_layers + 1):
+            x = x.bmm(self.weights[i]) + self.biases[i]
+            if i < self.dis_layers:
+                x = self.dropout(F.leaky_relu(x, 0.2))
+        return torch.sigmoid(x).squeeze(2)
+
+    def unstack(self, k, discriminator):
+        linears = [m for m in discriminator.layers if isinstance(m, nn.Linear)]
+        for i, linear in enumerate(linears):
+            linear.weight.data.copy_(self.weights[i].data[k].t())
+            linear.bias.data.copy_(self.biases[i].data[k].view(-1))
+
+    def select(self, ids):
+        return StackedDiscriminator([w.data.index_select(0, ids) for w in self.weights],
+                                    [b.data.index_select(0, ids) for b in self.biases], self.params)
+
+
+def select_optimizer(optimizer, module, ids, s):
+    """
+    Optimizer of `module.select(ids)`: same learning rate, and state of the
+    selected seeds (the first dimension of every parameter is the seed).
+    """
+    selected = module.select(ids)
+    optim_fn, optim_params = get_optimizer(s)
+    new_optimizer = optim_fn(selected.parameters(), **optim_params)
+    new_optimizer.param_groups[0]['lr'] = optimizer.param_groups[0]['lr']
+    for p, new_p in zip(module.parameters(), selected.parameters()):
+        new_optimizer.state[new_p] = dict(
+            (k, v.index_select(0, ids) if torch.is_tensor(v) and v.dim() > 0 and v.size(0) == p.size(0) else v)
+            for k, v in optimizer.state[p].items()
+        )
+    return selected, new_optimizer
+
+
+def get_mean_cosine(src_emb, tgt_emb, dico_method, params):
+    """
+    Mean cosine of the S2T dictionary of the 10k most frequent source words,
+    as in Evaluator.dist_mean_cosine. Only the S2T candidates are computed:
+    the T2S ones are not used by an S2T dictionary.
+    """
+    _params = deepcopy(params)
+    _params.dico_method = dico_method
+    _params.dico_threshold = 0
+    _params.dico_max_rank = 10000
+    _params.dico_min_size = 0
+    _params.dico_max_size = 10000
+    dico = get_candidates(src_emb, tgt_emb, _params)
+    dico = dico.cuda() if src_emb.is_cuda else dico
+    return float((src_emb[dico[:, 0]].float() * tgt_emb[dico[:, 1]].float()).sum(1).mean())
+
+
+class MultiSeedTrainer(object):
+    """
+    Adversarial training of several seeds at once. The mappings and
+    discriminators of the seeds are stacked and trained with batched matrix
+    multiplies on the same embedding tables (each seed samples its own
+    batches). `trainer` is a regular Trainer, whose mapping / discriminator
+    receive the seed selected with `select` (to evaluate, save or refine it).
+    """
+
+    def __init__(self, trainer, seeds):
+        self.trainer = trainer
+        self.src_emb = trainer.src_emb
+        self.tgt_emb = trainer.tgt_emb
+        self.params = params = trainer.params
+        self.seeds = list(seeds)
+
+        # seed initializations, as in models.build_model
+        rng_state = torch.get_rng_state()
+        mappings = []
+        discriminators = []
+        for seed in self.seeds:
+            torch.manual_seed(seed)
+            mapping = nn.Linear(params.emb_dim, params.emb_dim, bias=False)
+            if getattr(params, 'map_id_init', True):
+                mapping.weight.data.copy_(torch.diag(torch.ones(params.emb_dim)))
+            mappings.append(mapping)
+            discriminators.append(Discriminator(params))
+        torch.set_rng_state(rng_state)
+        self.mapping = StackedMapping.from_mappings(mappings)
+        self.discriminator = StackedDiscriminator.from_discriminators(discriminators, params)
+        if params.cuda:
+            self.mapping.cuda()
+            self.discriminator.cuda()
+
+        # optimizers (the learning rate of each seed is applied by scaling its SGD gradients)
+        optim_fn, optim_params = get_optimizer(params.map_optimizer)
+        self.map_optimizer = optim_fn(self.mapping.parameters(), **optim_params)
+        optim_fn, optim_params = get_optimizer(params.dis_optimizer)
+        self.dis_optimizer = optim_fn(self.discriminator.parameters(), **optim_params)
+        self.map_lr = np.full(len(self.seeds), self.map_optimizer.param_groups[0]['lr'])
+
+        # best validation score / mapping of each seed
+        self.best_valid_metric = np.full(len(self.seeds), -1e12)
+        self.best_mappings = [None] * len(self.seeds)
+        self.decrease_lr = np.zeros(len(self.seeds), dtype=bool)
+
+    @property
+    def n_seeds(self):
+        return len(self.seeds)
+
+    @profiler.timed('get_dis_xy')
+    def get_dis_xy(self, volatile):
+        """
+        Get discriminator input batch (n_seeds, 2 * bs, dim) / output target.
+        """
+        # select random word IDs (different ones for every seed)
+        bs = self.params.batch_size
+        mf = self.params.dis_most_frequent
+        assert mf <= min(len(self.params.src_dico), len(self.params.tgt_dico))
+        src_ids = torch.LongTensor(self.n_seeds * bs).random_(self.src_emb.num_embeddings if mf == 0 else mf)
+        tgt_ids = torch.LongTensor(self.n_seeds * bs).random_(self.tgt_emb.num_embeddings if mf == 0 else mf)
+        if self.params.cuda:
+            src_ids = src_ids.cuda()
+            tgt_ids = tgt_ids.cuda()
+
+        # get word embeddings
+        src_emb = self.src_emb(src_ids).float().view(self.n_seeds, bs, -1)
+        tgt_emb = self.tgt_emb(tgt_ids).float().view(self.n_seeds, bs, -1)
+        src_emb = self.mapping(Variable(src_emb, volatile=volatile))
+        tgt_emb = Variable(tgt_emb, volatile=volatile)
+
+        # input / target
+        x = torch.cat([src_emb, tgt_emb], 1)
+        y = torch.FloatTensor(self.n_seeds, 2 * bs).zero_()
+        y[:, :bs] = 1 - self.params.dis_smooth
+        y[:, bs:] = self.params.dis_smooth
+        y = Variable(y.cuda() if self.params.cuda else y)
+
+        return x, y
+
+    @profiler.timed('dis_step')
+    def dis_step(self, stats):
+        """
+        Train the discriminators.
+        """
+        self.discriminator.train()
+
+        # loss (sum of the mean loss of each seed)
+        x, y = self.get_dis_xy(volatile=True)
+        preds = self.discriminator(Variable(x.data))
+        loss = F.binary_cross_entropy(preds, y)
+        stats['DIS_COSTS'].append(loss.data[0])
+        loss = self.n_seeds * loss
+
+        # check NaN
+        if (loss != loss).data.any():
+            logger.error("NaN detected (discriminator)")
+            exit()
+
+        # optim
+        self.dis_optimizer.zero_grad()
+        loss.backward()
+        self.dis_optimizer.step()
+        clip_parameters(self.discriminator, self.params.dis_clip_weights)
+
+    @profiler.timed('mapping_step')
+    def mapping_step(self, stats):
+        """
+        Fooling discriminator training step.
+        """
+        if self.params.dis_lambda == 0:
+            return 0
+
+        self.discriminator.eval()
+
+        # loss (sum of the mean loss of each seed)
+        x, y = self.get_dis_xy(volatile=False)
+        preds = self.discriminator(x)
+        loss = F.binary_cross_entropy(preds, 1 - y)
+        loss = self.n_seeds * self.params.dis_lambda * loss
+
+        # check NaN
+        if (loss != loss).data.any():
+            logger.error("NaN detected (fool discriminator)")
+            exit()
+
+        # optim
+        self.map_optimizer.zero_grad()
+        loss.backward()
+        if 'sgd' in self.params.map_optimizer:
+            scale = torch.from_numpy(self.map_lr / self.map_optimizer.param_groups[0]['lr']).float()
+            scale = scale.cuda() if self.params.cuda else scale
+            self.mapping.weight.grad.data.mul_(scale.view(-1, 1, 1))
+        self.map_optimizer.step()
+        self.orthogonalize()
+
+        return 2 * self.params.batch_size * self.n_seeds
+
+    @profiler.timed('orthogonalize')
+    def orthogonalize(self):
+        """
+        Orthogonalize the mappings.
+        """
+        if self.params.map_beta > 0:
+            W = self.mapping.weight.data
+            beta = self.params.map_beta
+            W.copy_((1 + beta) * W - beta * W.bmm(W.transpose(1, 2).bmm(W)))
+
+    def select(self, k):
+        """
+        Copy the mapping / discriminator of seed `k` to the regular trainer.
+        """
+        self.mapping.unstack(k, self.trainer.mapping)
+        self.discriminator.unstack(k, self.trainer.discriminator)
+
+    @profiler.timed('dist_mean_cosine')
+    def dist_mean_cosine(self, to_logs):
+        """
+        Mean-cosine model selection criterion of every seed. The normalized
+        target embeddings are computed once for all the seeds.
+        """
+        tgt_emb = self.trainer.normalized_tgt_emb()
+        for k, to_log in enumerate(to_logs):
+            src_emb = mapped_embeddings(self.src_emb.weight, self.mapping.weight.data[k])
+            for dico_method in ['nn', 'csls_knn_10']:
+                to_log['mean_cosine-%s-S2T-10000' % dico_method] = get_mean_cosine(src_emb, tgt_emb, dico_method, self.params)
+            logger.info("Seed %i - mean cosine (nn / csls_knn_10 method, S2T build, 10000 max size): %.5f / %.5f"
+                        % (self.seeds[k], to_log['mean_cosine-nn-S2T-10000'], to_log['mean_cosine-csls_knn_10-S2T-10000']))
+
+    def save_best(self, to_logs, metric):
+        """
+        Keep the best mapping of every seed for the given validation metric.
+        """
+        for k, to_log in enumerate(to_logs):
+            if to_log[metric] > self.best_valid_metric[k]:
+                self.best_valid_metric[k] = to_log[metric]
+                self.best_mappings[k] = self.mapping.weight.data[k].cpu().numpy()
+                logger.info('* Seed %i - best value for "%s": %.5f' % (self.seeds[k], metric, to_log[metric]))
+
+    def update_lr(self, to_logs, metric):
+        """
+        Update the learning rate of every seed when using SGD (see Trainer.update_lr).
+        """
+        if 'sgd' not in self.params.map_optimizer:
+            return
+        self.map_lr = np.maximum(self.params.min_lr, self.map_lr * self.params.lr_decay)
+        if self.params.lr_shrink < 1:
+            for k, to_log in enumerate(to_logs):
+                if -1e7 <= to_log[metric] < self.best_valid_metric[k]:
+                    # second time the validation metric decreases
+                    if self.decrease_lr[k]:
+                        self.map_lr[k] *= self.params.lr_shrink
+                        logger.info("Seed %i - shrinking the learning rate to %.5f" % (self.seeds[k], self.map_lr[k]))
+                    self.decrease_lr[k] = True
+        logger.info("Learning rates: %s" % ' / '.join('%.8f' % lr for lr in self.map_lr))
+
+    def prune(self, n_keep):
+        """
+        Only keep training the `n_keep` seeds with the best validation metric.
+        """
+        if n_keep >= self.n_seeds:
+            return
+        kept = np.sort(np.argsort(-self.best_valid_metric, kind='mergesort')[:n_keep])
+        logger.info('Pruning seeds %s: keeping seeds %s'
+                    % (', '.join(str(self.seeds[k]) for k in range(self.n_seeds) if k not in kept),
+                       ', '.join(str(self.seeds[k]) for k in kept)))
+        ids = torch.from_numpy(kept)
+        ids = ids.cuda() if self.params.cuda else ids
+        self.mapping, self.map_optimizer = select_optimizer(self.map_optimizer, self.mapping, ids, self.params.map_optimizer)
+        self.discriminator, self.dis_optimizer = select_optimizer(self.dis_optimizer, self.discriminator, ids, self.params.dis_optimizer)
+        self.seeds = [self.seeds[k] for k in kept]
+        self.map_lr = self.map_lr[kept]
+        self.best_valid_metric = self.best_valid_metric[kept]
+        self.best_mappings = [self.best_mappings[k] for k in kept]
+        self.decrease_lr = self.decrease_lr[kept]
+
+    def save_winner(self):
+        """
+        Save the best mapping of the best seed as the mapping of the
+        experiment (see Trainer.save_best). Return the seed.
+        """
+        k = int(np.argmax(self.best_valid_metric))
+        assert self.best_mappings[k] is not None
+        path = os.path.join(self.params.exp_path, 'best_mapping.t7')
+        logger.info('* Best seed: %i (%.5f). Saving its mapping to %s ...'
+                    % (self.seeds[k], self.best_valid_metric[k], path))
+        torch.save(self.best_mappings[k], path)
+        self.trainer.best_valid_metric = self.best_valid_metric[k]
+        self.select(k)
+        return self.seeds[k]
@@ -0,0 +1,371 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import copy
+import time
+import zlib
+from logging import getLogger
+import numpy as np
+import torch
+
+from .retrieval import parse_method
+
+
+logger = getLogger()
+
+
+def parse_index(s):
+    """
+    Parse the parameters of an index, e.g. "pq,code_size=50,n_lists=1024,nprobe=16,shortlist=100"
+    (same syntax as the optimizers). Return None for "" (exact search).
+    """
+    if s == "":
+        return None
+    split = s.split(',')
+    assert split[0] == 'pq', 'unknown index: "%s"' % split[0]
+    config = {'code_size': 50, 'n_lists': 1024, 'nprobe': 16, 'shortlist': 100, 'n_iter': 15, 'n_train': 65536}
+    for x in split[1:]:
+        k, v = x.split('=')
+        assert k in config, 'unknown index parameter: "%s"' % k
+        config[k] = int(v)
+    return config
+
+
+def assign(x, centroids, bs=16384):
+    """
+    Nearest centroid (L2) of every row of `x`.
+    """
+    c_norms = (centroids * centroids).sum(1)
+    out = torch.LongTensor(x.size(0))
+    for i in range(0, x.size(0), bs):
+        scores = x[i:i + bs].mm(centroids.transpose(0, 1))
+        scores.mul_(2).sub_(c_norms[None, :].expand_as(scores))
+        out[i:i + bs] = scores.max(1)[1].cpu()
+    return out
+
+
+def kmeans(x, k, n_iter, rng):
+    """
+    Lloyd's k-means of the rows of `x`. Empty clusters are re-seeded with
+    random points.
+    """
+    n = x.size(0)
+    centroids = x.index_select(0, torch.from_numpy(rng.choice(n, k, replace=False))).clone()
+    ones = x.new(n).fill_(1)
+    for _ in range(n_iter):
+        ids = assign(x, centroids)
+        ids = ids.cuda() if x.is_cuda else ids
+        sums = x.new(k, x.size(1)).zero_().index_add_(0, ids, x)
+        counts = x.new(k).zero_().index_add_(0, ids, ones)
+        centroids = sums / counts.clamp(min=1)[:, None].expand_as(sums)
+        empty = np.nonzero(counts.cpu().numpy() == 0)[0]
+        if len(empty) > 0:
+            reseed = torch.from_numpy(rng.choice(n, len(empty), replace=False))
+            centroids.index_copy_(0, torch.from_numpy(empty), x.index_select(0, reseed))
+    return centroids
+
+
+class ProductQuantizer(object):
+    """
+    Product quantizer: vectors are split in `code_size` sub-vectors, each one
+    encoded by the ID (one byte) of its nearest centroid in a codebook of
+    256 centroids learned with k-means.
+    """
+
+    def __init__(self, dim, code_size):
+        assert dim % code_size == 0, "the dimension (%i) must be a multiple of the code size (%i)" % (dim, code_size)
+        self.dim = dim
+        self.code_size = code_size
+        self.dsub = dim // code_size
+        self.codebooks = None
+
+    def train(self, x, n_iter, rng):
+        self.codebooks = torch.stack([
+            kmeans(x[:, m * self.dsub:(m + 1) * self.dsub].contiguous(), 256, n_iter, rng)
+            for m in range(self.code_size)
+        ])
+
+    def encode(self, x):
+        codes = torch.ByteTensor(x.size(0), self.code_size)
+        for m in range(self.code_size):
+            codes[:, m] = assign(x[:, m * self.dsub:(m + 1) * self.dsub].contiguous(), self.codebooks[m]).byte()
+        return codes
+
+    def decode(self, codes):
+        # one gather in the concatenated codebooks
+        offsets = torch.arange(0, self.code_size).long() * 256
+        ids = codes.long() + offsets[None, :].expand_as(codes)
+        codebooks = self.codebooks.view(-1, self.dsub)
+        return codebooks.index_select(0, ids.view(-1)).view(codes.size(0), self.dim)
+
+
+class PQIndex(object):
+    """
+    Approximate inner product (or CSLS) search of normalized embeddings, with
+    an inverted file of `n_lists` k-means cells, and the residuals of the
+    embeddings to their cell centroid encoded by a product quantizer. A search
+    scores the queries against the decoded embeddings of their `nprobe`
+    nearest cells only, and returns a shortlist of candidates, to be
+    re-ranked with the exact embeddings (see `rerank`).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.centroids = None
+        self.pq = None
+        self.codes = None
+        self.ids = None
+        self.offsets = None
+        # keys mapped by this matrix (see `mapped`)
+        self.mapping = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def build(self, emb, seed=0):
+        """
+        Build the index of the rows of `emb` (normalized embeddings).
+        """
+        tic = time.time()
+        rng = np.random.RandomState(seed)
+        emb = emb.float()
+        n, dim = emb.size()
+        n_lists = min(self.config['n_lists'], n)
+        sample = torch.from_numpy(np.sort(rng.choice(n, min(n, self.config['n_train']), replace=False)))
+        sample = emb.index_select(0, sample.cuda() if emb.is_cuda else sample)
+        self.centroids = kmeans(sample, n_lists, self.config['n_iter'], rng)
+
+        # cell of every embedding, and product quantizer of the residuals
+        lists = assign(emb, self.centroids)
+        self.pq = ProductQuantizer(dim, self.config['code_size'])
+        sample_lists = assign(sample, self.centroids)
+        sample_lists = sample_lists.cuda() if emb.is_cuda else sample_lists
+        self.pq.train(sample - self.centroids.index_select(0, sample_lists), self.config['n_iter'], rng)
+
+        # codes, sorted by cell
+        self.ids = torch.from_numpy(np.argsort(lists.numpy(), kind='mergesort'))
+        counts = np.bincount(lists.numpy(), minlength=n_lists)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.codes = torch.ByteTensor(n, self.pq.code_size)
+        bs = 16384
+        for i in range(0, n, bs):
+            ids = self.ids[i:i + bs]
+            ids = ids.cuda() if emb.is_cuda else ids
+            _lists = lists.index_select(0, self.ids[i:i + bs])
+            _lists = _lists.cuda() if emb.is_cuda else _lists
+            self.codes[i:i + bs] = self.pq.encode(emb.index_select(0, ids) - self.centroids.index_select(0, _lists))
+        self.centroids = self.centroids.cpu()
+        self.pq.codebooks = self.pq.codebooks.cpu()
+        logger.info('Built a PQ index of %i embeddings (%i cells, %i bytes codes) in %.2fs'
+                    % (n, n_lists, self.pq.code_size, time.time() - tic))
+        return self
+
+    def mapped(self, mapping):
+        """
+        View of the index for the keys mapped by `mapping` (x -> x W^T):
+        queries are multiplied by W instead, which is exact for orthogonal
+        mappings, and only affects the shortlists otherwise.
+        """
+        index = copy.copy(self)
+        index.mapping = mapping.float().cpu()
+        return index
+
+    def search(self, queries, k, key_radii=None, bs=8192):
+        """
+        Shortlist of the `k` best keys of every query, by approximate inner
+        product, or by approximate CSLS score if the keys radii are given
+        (the query radii do not change the ranking). Returns a (n_queries, k)
+        tensor of key IDs, -1 if there are fewer candidates.
+        """
+        nprobe = min(self.config['nprobe'], len(self.offsets) - 1)
+        radii = None if key_radii is None else key_radii.float().cpu().index_select(0, self.ids)
+        shortlists = []
+        for i in range(0, queries.size(0), bs):
+            q = queries[i:i + bs].float().cpu()
+            if self.mapping is not None:
+                q = q.mm(self.mapping)
+            nq = q.size(0)
+            probes = q.mm(self.centroids.transpose(0, 1)).topk(nprobe, 1, largest=True, sorted=True)[1]
+
+            # queries (and probe rank) of every cell
+            probes = probes.numpy().reshape(-1)
+            order = np.argsort(probes, kind='mergesort')
+            query_ids = order // nprobe
+            columns = (order % nprobe) * k
+            starts = np.searchsorted(probes[order], np.arange(len(self.offsets)))
+
+            best_scores = q.new(nq * nprobe * k).fill_(-1e9)
+            best_ids = torch.LongTensor(nq * nprobe * k).fill_(-1)
+            for l in np.nonzero(starts[1:] > starts[:-1])[0]:
+                start, end = self.offsets[l], self.offsets[l + 1]
+                if start == end:
+                    continue
+                _keys = self.pq.decode(self.codes[start:end])
+                _keys.add_(self.centroids[l][None, :].expand_as(_keys))
+                _query_ids = torch.from_numpy(query_ids[starts[l]:starts[l + 1]])
+                scores = q.index_select(0, _query_ids).mm(_keys.transpose(0, 1))
+                if radii is not None:
+                    scores.mul_(2).sub_(radii[start:end][None, :].expand_as(scores))
+                kk = min(k, end - start)
+                top_scores, top_ids = scores.topk(kk, 1, largest=True, sorted=True)
+                positions = (_query_ids * nprobe * k + torch.from_numpy(columns[starts[l]:starts[l + 1]]))[:, None]
+                positions = (positions.expand_as(top_ids) + torch.arange(0, kk).long()[None, :].expand_as(top_ids)).contiguous().view(-1)
+                best_scores.index_copy_(0, positions, top_scores.contiguous().view(-1))
+                best_ids.index_copy_(0, positions, (top_ids + int(start)).view(-1))
+
+            # best candidates of the probed cells, as key IDs
+            best = best_scores.view(nq, -1).topk(k, 1, largest=True, sorted=True)[1]
+            best_ids = best_ids.view(nq, -1).gather(1, best)
+            shortlist = self.ids.index_select(0, best_ids.clamp(min=0).view(-1)).view(nq, k)
+            shortlist.masked_fill_(best_ids < 0, -1)
+            shortlists.append(shortlist)
+        return torch.cat(shortlists, 0)
+
+    def save(self, path):
+        torch.save({'config': self.config, 'centroids': self.centroids, 'codebooks': self.pq.codebooks,
+                    'codes': self.codes, 'ids': self.ids, 'offsets': self.offsets}, path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        data = torch.load(path)
+        index = cls(data['config'])
+        index.centroids = data['centroids']
+        index.pq = ProductQuantizer(index.centroids.size(1), data['codebooks'].size(0))
+        index.pq.codebooks = data['codebooks']
+        index.codes = data['codes']
+        index.ids = data['ids']
+        index.offsets = data['offsets']
+        return index
+
+
+def rerank(queries, keys, shortlist, k, query_radii=None, key_radii=None, bs=256):
+    """
+    Exact scores (cosine, or CSLS if the radii are given) of the shortlisted
+    keys of every query, and top-k. Returns (scores, ids) (n_queries, k) tensors.
+    """
+    all_scores = []
+    all_ids = []
+    for i in range(0, queries.size(0), bs):
+        candidates = shortlist[i:i + bs]
+        missing = candidates < 0
+        candidates = candidates.clamp(min=0)
+        candidates = candidates.cuda() if keys.is_cuda else candidates
+        b, n = candidates.size()
+        _keys = keys.index_select(0, candidates.view(-1)).float().view(b, n, -1)
+        scores = _keys.bmm(queries[i:i + bs].float()[:, :, None]).squeeze(2)
+        if query_radii is not None:
+            scores.mul_(2)
+            scores.sub_(query_radii[i:i + bs][:, None].expand_as(scores))
+            scores.sub_(key_radii.index_select(0, candidates.view(-1)).view(b, n))
+        scores.masked_fill_(missing.cuda() if scores.is_cuda else missing, -1e9)
+        top_scores, top = scores.topk(k, 1, largest=True, sorted=True)
+        all_scores.append(top_scores)
+        all_ids.append(candidates.gather(1, top))
+    return torch.cat(all_scores, 0), torch.cat(all_ids, 0)
+
+
+def get_nn_avg_dist_pq(index, emb, query, knn):
+    """
+    get_nn_avg_dist with the shortlists of a PQ index of `emb`.
+    """
+    shortlist = index.search(query, max(knn, index.config['shortlist']))
+    return rerank(query, emb, shortlist, knn)[0].mean(1).cpu().numpy()
+
+
+def get_pq_candidates(queries, emb1, emb2, method, index1, index2):
+    """
+    Best 2 targets (by nearest neighbors or CSLS) of the queries, the first
+    rows of `emb1`, among the shortlists of `index2` (the index of `emb2`)
+    re-ranked exactly. The CSLS radii of the targets use `index1` (of `emb1`).
+    Returns (scores, targets), two (n_queries, 2) tensors.
+    """
+    knn = parse_method(method)
+    shortlist_size = index2.config['shortlist']
+    if knn == 0:
+        return rerank(queries, emb2, index2.search(queries, shortlist_size), 2)
+    query_radii = torch.from_numpy(get_nn_avg_dist_pq(index2, emb2, queries, knn))
+    key_radii = torch.from_numpy(get_nn_avg_dist_pq(index1, emb1, emb2, knn))
+    shortlist = index2.search(queries, shortlist_size, key_radii=key_radii)
+    if queries.is_cuda:
+        query_radii = query_radii.cuda()
+        key_radii = key_radii.cuda()
+    return rerank(queries, emb2, shortlist, 2, query_radii, key_radii)
+
+
+def load_pq_index(emb, config, path=None):
+    """
+    PQ index of normalized embeddings. If `path` is given (a file name
+    specific to the embeddings, see `index_path`), the index is built once
+    and reloaded from there.
+    """
+    if path is not None and os.path.isfile(path):
+        logger.info('Reloading the PQ index from %s ...' % path)
+        index = PQIndex.load(path)
+        if len(index) == emb.size(0):
+            return index
+        logger.warning('%s does not index %i embeddings: building it again' % (path, emb.size(0)))
+    index = PQIndex(config).build(emb)
+    if path is not None:
+        try:
+            index.save(path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not save the PQ index to %s: %s' % (path, e))
+    return index
+
+
+def index_path(emb_path, config, params, rows=None):
+    """
+    Cache file of the PQ index of the embeddings of `emb_path`, next to it:
+    it depends on the vocabulary (rows of the file), the normalization and
+    the index parameters. None if the embedding file is more recent.
+    """
+    key = '%s|%i|%s|%i|%i|%i' % (params.normalize_embeddings, params.max_vocab, '' if rows is None else
+                                 zlib.crc32(np.ascontiguousarray(rows, dtype=np.int64).tobytes()),
+                                 config['code_size'], config['n_lists'], config['n_iter'])
+    path = '%s.pq%08x' % (emb_path, zlib.crc32(key.encode('utf-8')) & 0xffffffff)
+    if os.path.isfile(path) and os.path.getmtime(path) < os.path.getmtime(emb_path):
+        os.remove(path)
+    return path
+
+
+def load_embedding_index(emb, params, source):
+    """
+    PQ index (`params.dico_index`) of the normalized source / target
+    embeddings, cached next to the embedding file.
+    """
+    config = parse_index(params.dico_index)
+    emb_path = params.src_emb if source else params.tgt_emb
+    rows = getattr(params, 'src_rows' if source else 'tgt_rows', None)
+    path = index_path(emb_path, config, params, rows) if os.path.isfile(emb_path) else None
+    return load_pq_index(emb, config, path)
+
+
+def recall_report(index, emb, query, k=10, n_queries=1000, key_radii=None, query_radii=None, seed=0):
+    """
+    Recall of the top-1 / top-k exact neighbors (cosine, or CSLS if the radii
+    are given) of a sample of queries, by the index shortlists re-ranked
+    exactly. Returns a dictionary with the recalls and the shortlist size.
+    """
+    rng = np.random.RandomState(seed)
+    ids = torch.from_numpy(np.sort(rng.choice(query.size(0), min(n_queries, query.size(0)), replace=False)))
+    ids = ids.cuda() if query.is_cuda else ids
+    q = query.index_select(0, ids).float()
+    q_radii = None if query_radii is None else query_radii.index_select(0, ids)
+    scores = q.mm(emb.float().transpose(0, 1))
+    if q_radii is not None:
+        scores.mul_(2).sub_(q_radii[:, None].expand_as(scores)).sub_(key_radii[None, :].expand_as(scores))
+    exact = scores.topk(k, 1, largest=True, sorted=True)[1].cpu()
+    shortlist = index.search(q, max(k, index.config['shortlist']), key_radii=key_radii)
+    approx = rerank(q, emb, shortlist, k, q_radii, key_radii)[1].cpu()
+    found = (approx[:, :, None].expand(approx.size(0), k, k) == exact[:, None, :].expand(exact.size(0), k, k))
+    return {
+        'recall_at_1': float((approx[:, 0] == exact[:, 0]).float().mean()),
+        'recall_at_%i' % k: float(found.float().sum(1).clamp(max=1).mean()),
+        'shortlist': index.config['shortlist'],
+    }
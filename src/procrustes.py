@@ -0,0 +1,101 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+from collections import OrderedDict
+from logging import getLogger
+import numpy as np
+import scipy
+import scipy.linalg
+import torch
+
+
+logger = getLogger()
+
+
+class IncrementalProcrustes(object):
+    """
+    Cross-covariance M = B^T A of the dictionary pairs (A: embeddings to map,
+    B: embeddings mapped to). Between two refinement iterations only the pairs
+    added to / removed from the dictionary are gathered, and M is updated.
+    """
+
+    def __init__(self, emb_a, emb_b):
+        self.emb_a = emb_a
+        self.emb_b = emb_b
+        self.keys = None
+        self.M = None
+
+    def _covariance(self, keys):
+        n_b = self.emb_b.size(0)
+        ids_a = torch.from_numpy(keys // n_b)
+        ids_b = torch.from_numpy(keys % n_b)
+        if self.emb_a.is_cuda:
+            ids_a, ids_b = ids_a.cuda(), ids_b.cuda()
+        A = self.emb_a.index_select(0, ids_a).float()
+        B = self.emb_b.index_select(0, ids_b).float()
+        return B.transpose(0, 1).mm(A).cpu().numpy().astype(np.float64)
+
+    def update(self, dico):
+        """
+        Update M with a new dictionary of (A, B) pairs.
+        Return the size / churn of the dictionary since the previous one.
+        """
+        dico = dico.cpu().numpy().astype(np.int64)
+        keys = np.unique(dico[:, 0] * self.emb_b.size(0) + dico[:, 1])
+        if self.keys is None:
+            added, removed = keys, keys[:0]
+        else:
+            added = np.setdiff1d(keys, self.keys, assume_unique=True)
+            removed = np.setdiff1d(self.keys, keys, assume_unique=True)
+        # recompute M from scratch if that gathers fewer pairs
+        if self.M is None or len(added) + len(removed) >= len(keys):
+            self.M = self._covariance(keys)
+        else:
+            if len(added) > 0:
+                self.M += self._covariance(added)
+            if len(removed) > 0:
+                self.M -= self._covariance(removed)
+        previous = len(self.keys) if self.keys is not None else 0
+        self.keys = keys
+        return OrderedDict([
+            ('size', len(keys)),
+            ('added', len(added)),
+            ('removed', len(removed)),
+            ('overlap', (len(keys) - len(added)) / float(max(len(keys), previous, 1))),
+        ])
+
+    def solve(self):
+        """
+        Orthogonal matrix W maximizing tr(W^T M) (economical SVD, in float32).
+        """
+        U, S, V_t = scipy.linalg.svd(self.M.astype(np.float32), full_matrices=False)
+        return U.dot(V_t)
+
+
+def procrustes_step(state, dico, W):
+    """
+    Update the Procrustes state with a new dictionary, and the mapping `W`
+    with the new solution. Return the churn statistics of the iteration,
+    with the relative change of the mapping.
+    """
+    stats = state.update(dico)
+    W_old = W.clone()
+    W.copy_(torch.from_numpy(state.solve()).type_as(W))
+    stats['delta'] = float((W - W_old).norm()) / max(float(W_old.norm()), 1e-8)
+    logger.info('Procrustes: %i pairs (+%i / -%i), overlap %.4f, mapping delta %.6f'
+                % (stats['size'], stats['added'], stats['removed'], stats['overlap'], stats['delta']))
+    return stats
+
+
+def refinement_converged(stats, params):
+    """
+    Whether the dictionary and the mapping stopped changing (see
+    --refine_min_overlap / --refine_max_delta): with the default values,
+    the dictionary is unchanged, and so would be the next iterations.
+    """
+    return (stats['overlap'] >= getattr(params, 'refine_min_overlap', 1) and
+            stats['delta'] <= getattr(params, 'refine_max_delta', 0))
@@ -0,0 +1,248 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import json
+import time
+import functools
+from collections import OrderedDict
+from logging import getLogger
+import torch
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+logger = getLogger()
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._start(self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.profiler._stop()
+        return False
+
+
+class Profiler(object):
+    """
+    Nested named timers, call counters and optional peak memory sampling.
+    Timers are identified by their path in the stack of open timers
+    (e.g. "mapping_step/consistency_loss"). When disabled, `timer` returns a
+    shared no-op context manager and `timed` functions only check one flag.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.cuda = False
+        self.trace = ''
+        self.trace_window = (0, 0)
+        self.trace_path = ''
+        self._tracer = None
+        self._n_steps = 0
+        self._records = []
+        self.reset()
+
+    def enable(self, memory=False, cuda=False):
+        """
+        Turn the profiler on. If `cuda` is set, CUDA is synchronized
+        before reading the clock, so that asynchronous kernels are timed.
+        """
+        self.enabled = True
+        self.memory = memory
+        self.cuda = cuda
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the timers / counters (called at the beginning of each epoch).
+        """
+        self.timings = OrderedDict()
+        self.counters = OrderedDict()
+        self.peak_memory = OrderedDict()
+        self._stack = []
+        self._reset_time = time.time()
+        if self.memory and self.cuda and hasattr(torch.cuda, 'reset_max_memory_allocated'):
+            torch.cuda.reset_max_memory_allocated()
+
+    def timer(self, name):
+        """
+        Context manager timing the enclosed block under `name`.
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def timed(self, name):
+        """
+        Decorator timing every call of a function under `name`.
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Timer(self, name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, n=1):
+        """
+        Increment a counter.
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def _start(self, name):
+        if self.cuda:
+            torch.cuda.synchronize()
+        self._stack.append((name, time.time()))
+
+    def _stop(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        path = '/'.join(name for name, _ in self._stack)
+        _, tic = self._stack.pop()
+        total, calls = self.timings.get(path, (0., 0))
+        self.timings[path] = (total + time.time() - tic, calls + 1)
+        if self.memory:
+            self.peak_memory[path] = max(self.peak_memory.get(path, 0), self._memory_usage())
+
+    def _memory_usage(self):
+        """
+        Peak memory usage in MB (GPU if running on CUDA, resident set size otherwise).
+        """
+        if self.cuda:
+            return torch.cuda.max_memory_allocated() / 1024. ** 2
+        if resource is not None:
+            # kilobytes on Linux
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+        return 0
+
+    def summary(self):
+        """
+        Timers of the current epoch: total / mean time, calls, percentage of the wall time.
+        """
+        wall = time.time() - self._reset_time
+        timers = OrderedDict()
+        for path in sorted(self.timings, key=lambda x: x.split('/')):
+            total, calls = self.timings[path]
+            timers[path] = OrderedDict([
+                ('total', total),
+                ('calls', calls),
+                ('mean', total / calls),
+                ('percent', 100. * total / wall if wall > 0 else 0.),
+            ])
+            if path in self.peak_memory:
+                timers[path]['peak_memory_mb'] = self.peak_memory[path]
+        return OrderedDict([('wall', wall), ('timers', timers), ('counters', OrderedDict(self.counters))])
+
+    def log_epoch(self, name, path=None):
+        """
+        Log the breakdown of the current epoch, append it to the JSON file
+        `path`, and reset the timers.
+        """
+        if not self.enabled:
+            return
+        summary = self.summary()
+        pattern = "%-60s %10s %8s %10s %7s"
+        lines = [pattern % ("Timer", "Total (s)", "Calls", "Mean (ms)", "%")]
+        for timer, res in summary['timers'].items():
+            depth = timer.count('/')
+            lines.append(pattern % ('  ' * depth + timer.split('/')[-1], '%.3f' % res['total'], res['calls'],
+                                    '%.3f' % (1000 * res['mean']), '%.1f' % res['percent']) +
+                         (' %.0fMB' % res['peak_memory_mb'] if 'peak_memory_mb' in res else ''))
+        for counter, n in summary['counters'].items():
+            lines.append('%-60s %10i' % (counter, n))
+        logger.info('Profile of %s (%.3fs wall time):\n%s' % (name, summary['wall'], '\n'.join(lines)))
+        if path is not None:
+            summary['name'] = name
+            self._records.append(summary)
+            with open(path, 'w') as f:
+                json.dump(self._records, f)
+        self.reset()
+
+    def set_trace(self, mode, window, path):
+        """
+        Dump a cProfile ("cprofile") or torch autograd profiler ("torch") trace
+        of the iterations in the [start, end) `window` to `path`.
+        """
+        assert mode in ['', 'cprofile', 'torch']
+        assert len(window) == 2 and 0 <= window[0] < window[1]
+        self.trace = mode
+        self.trace_window = window
+        self.trace_path = path
+
+    def step(self):
+        """
+        Called at the beginning of each training iteration: start / stop
+        the trace around the chosen window of iterations (counted from 0).
+        """
+        if not self.trace:
+            return
+        if self._n_steps == self.trace_window[0] and self._tracer is None:
+            logger.info('Starting %s trace at iteration %i ...' % (self.trace, self._n_steps))
+            if self.trace == 'cprofile':
+                import cProfile
+                self._tracer = cProfile.Profile()
+                self._tracer.enable()
+            else:
+                self._tracer = torch.autograd.profiler.profile()
+                self._tracer.__enter__()
+        elif self._n_steps == self.trace_window[1] and self._tracer is not None:
+            if self.trace == 'cprofile':
+                self._tracer.disable()
+                self._tracer.dump_stats(self.trace_path)
+            else:
+                self._tracer.__exit__(None, None, None)
+                self._tracer.export_chrome_trace(self.trace_path)
+            logger.info('Wrote the %s trace of iterations %i to %i to %s'
+                        % (self.trace, self.trace_window[0], self._n_steps, self.trace_path))
+            self._tracer = None
+            self.trace = ''
+        self._n_steps += 1
+
+
+profiler = Profiler()
+
+
+def initialize_profiler(params):
+    """
+    Configure the global profiler from the --profile* parameters.
+    """
+    if not getattr(params, 'profile', False):
+        return None
+    profiler.enable(memory=params.profile_memory, cuda=params.cuda)
+    if params.profile_trace:
+        mode, window = params.profile_trace.split(':')
+        start, end = [int(x) for x in window.split('-')]
+        ext = 'prof' if mode == 'cprofile' else 'json'
+        profiler.set_trace(mode, (start, end), os.path.join(params.exp_path, 'trace.%s' % ext))
+    return os.path.join(params.exp_path, 'profile.json')
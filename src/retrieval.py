@@ -0,0 +1,121 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import numpy as np
+import torch
+
+from .utils import get_nn_avg_dist
+
+
+def _as_tensor(x, like=None):
+    """
+    Float torch tensor of a torch tensor or (memory-mapped) numpy array,
+    of the same type / device as `like` if given.
+    """
+    if isinstance(x, np.ndarray):
+        x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+    x = x.float()
+    return x if like is None else x.type_as(like)
+
+
+def map_embeddings(emb, mapping=None, bs=65536, cuda=False, out=None, normalize=True):
+    """
+    Map (if `mapping` is given, as in `nn.Linear`: x -> x W^T) and normalize
+    embeddings block by block, in float32. `emb` can be a torch tensor or a
+    (memory-mapped) numpy array. Returns a new float torch tensor, or writes
+    the result in `out` (a tensor of any precision, or a numpy array).
+    """
+    n, dim = emb.shape
+    if out is None:
+        out = torch.FloatTensor(n, dim if mapping is None else mapping.size(0))
+        out = out.cuda() if cuda else out
+    if mapping is not None:
+        mapping = mapping.float()
+        mapping = mapping.cuda() if cuda else mapping.cpu()
+    for i in range(0, n, bs):
+        x = _as_tensor(emb[i:i + bs])
+        x = x.cuda() if cuda else x
+        # compute in place in `out` when it has the same type
+        inplace = torch.is_tensor(out) and out.type() == x.type()
+        if mapping is not None:
+            x = torch.mm(x, mapping.transpose(0, 1), out=out[i:i + bs]) if inplace else x.mm(mapping.transpose(0, 1))
+        elif inplace:
+            x = out[i:i + bs].copy_(x)
+        elif normalize:
+            x = x.clone()
+        if normalize:
+            x.div_(x.norm(2, 1, keepdim=True).clamp(min=1e-8).expand_as(x))
+        if isinstance(out, np.ndarray):
+            out[i:i + bs] = x.cpu().numpy()
+        elif not inplace:
+            out[i:i + bs].copy_(x)
+    return out
+
+
+def mapped_embeddings(emb, mapping=None, normalize=True, bs=65536):
+    """
+    Mapped (by the weight of a linear mapping) and / or normalized embeddings,
+    computed in float32 and stored in the precision of `emb`.
+    """
+    dim = emb.size(1) if mapping is None else mapping.size(0)
+    return map_embeddings(emb, mapping, bs=bs, cuda=emb.is_cuda, out=emb.new(emb.size(0), dim), normalize=normalize)
+
+
+def parse_method(method):
+    """
+    Return the number of neighbors of a "csls_knn_K" method, 0 for "nn".
+    """
+    if method == 'nn':
+        return 0
+    assert method.startswith('csls_knn_') and method[len('csls_knn_'):].isdigit(), method
+    return int(method[len('csls_knn_'):])
+
+
+def csls_radii(queries, keys, knn):
+    """
+    CSLS penalties of the queries and of the keys: the average similarity
+    of each of them to its `knn` nearest neighbors in the other space.
+    """
+    query_radii = torch.from_numpy(get_nn_avg_dist(keys, queries, knn)).type_as(queries)
+    key_radii = torch.from_numpy(get_nn_avg_dist(queries, keys, knn)).type_as(keys)
+    return query_radii, key_radii
+
+
+def translate(queries, keys, k, query_radii=None, key_radii=None, bs=1024, key_bs=0):
+    """
+    Top-k keys of normalized queries, by cosine similarity, or by CSLS
+    score if the radii are given. Scores are computed `bs` queries at a time.
+    If `key_bs` is set, keys are read `key_bs` at a time and the top-k are
+    merged across the blocks: `keys` / `key_radii` can then be memory-mapped
+    numpy arrays, and the memory only depends on the block sizes.
+    Returns (scores, ids), two (n_queries, k) tensors.
+    """
+    assert (query_radii is None) == (key_radii is None)
+    n_keys = keys.shape[0]
+    key_bs = key_bs if key_bs > 0 else n_keys
+    best_scores, best_ids = None, None
+    for j in range(0, n_keys, key_bs):
+        _keys = _as_tensor(keys[j:j + key_bs], queries)
+        _key_radii = None if key_radii is None else _as_tensor(key_radii[j:j + key_bs], queries)
+        all_scores = []
+        all_ids = []
+        for i in range(0, queries.size(0), bs):
+            scores = queries[i:i + bs].mm(_keys.transpose(0, 1))
+            if query_radii is not None:
+                scores.mul_(2)
+                scores.sub_(query_radii[i:i + bs][:, None]).sub_(_key_radii[None, :])
+            top_scores, top_ids = scores.topk(min(k, scores.size(1)), dim=1, largest=True, sorted=True)
+            all_scores.append(top_scores)
+            all_ids.append(top_ids + j)
+        scores, ids = torch.cat(all_scores, 0), torch.cat(all_ids, 0)
+        if best_scores is not None:
+            scores = torch.cat([best_scores, scores], 1)
+            ids = torch.cat([best_ids, ids], 1)
+            scores, top = scores.topk(min(k, scores.size(1)), dim=1, largest=True, sorted=True)
+            ids = ids.gather(1, top)
+        best_scores, best_ids = scores, ids
+    return best_scores, best_ids
@@ -0,0 +1,444 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+import io
+import json
+import time
+import socket
+import threading
+from logging import getLogger
+import numpy as np
+from numpy.lib.format import open_memmap
+import torch
+
+from .retrieval import map_embeddings, parse_method, csls_radii, translate
+from .dictionary import CompactDictionary
+
+try:
+    import queue
+    from urllib.parse import urlparse, parse_qs
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from http.client import HTTPConnection
+    from socketserver import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    import Queue as queue
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from httplib import HTTPConnection
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+
+
+logger = getLogger()
+
+DIRECTIONS = ['s2t', 't2s']
+
+
+def load_embedding_cache(path, max_vocab, cache_dir):
+    """
+    Return the vocabulary (a CompactDictionary) and the embeddings of a .vec
+    file. Both are converted once to a binary cache, then memory-mapped.
+    """
+    name = '%s.%i' % (os.path.basename(path), max_vocab)
+    npy_path = os.path.join(cache_dir, name + '.npy')
+    vocab_path = os.path.join(cache_dir, name + '.dico')
+    if not (os.path.isfile(npy_path) and os.path.isfile(vocab_path) and
+            os.path.getmtime(npy_path) >= os.path.getmtime(path)):
+        logger.info('Converting %s to %s ...' % (path, npy_path))
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        words = []
+        seen = set()
+        with io.open(path, 'r', encoding='utf-8', errors='replace') as f:
+            n_words, dim = [int(x) for x in f.readline().split()]
+            n_words = min(n_words, max_vocab) if max_vocab > 0 else n_words
+            emb = open_memmap(npy_path + '.tmp', mode='w+', dtype=np.float32, shape=(n_words, dim))
+            for line in f:
+                word, vect = line.rstrip().split(' ', 1)
+                if word in seen:
+                    continue
+                vect = np.fromstring(vect, sep=' ', dtype=np.float32)
+                if np.linalg.norm(vect) == 0:  # avoid to have null embeddings
+                    vect[0] = 0.01
+                emb[len(words)] = vect
+                words.append(word)
+                seen.add(word)
+                if len(words) == n_words:
+                    break
+            emb.flush()
+            del emb
+        assert len(words) == n_words, 'expected %i words in %s, found %i' % (n_words, path, len(words))
+        CompactDictionary.from_words(words, None).save(vocab_path)
+        os.rename(npy_path + '.tmp', npy_path)
+    words = CompactDictionary.load(vocab_path, None)
+    emb = np.load(npy_path, mmap_mode='r')
+    assert len(words) == emb.shape[0]
+    logger.info('Loaded %i x %i embeddings from %s' % (emb.shape[0], emb.shape[1], npy_path))
+    return words, emb
+
+
+def find_mappings(exp_path):
+    """
+    Mapping file of each direction in an experiment directory, and whether
+    it has to be transposed: best_mapping_True.t7 / best_mapping_False.t7
+    (unsupervised.py), or best_mapping.t7 and its transpose for the reverse
+    direction (orthogonal mapping of unsupervised_single.py / supervised.py).
+    """
+    mappings = {}
+    for direction, suffix in zip(DIRECTIONS, ['True', 'False']):
+        path = os.path.join(exp_path, 'best_mapping_%s.t7' % suffix)
+        if os.path.isfile(path):
+            mappings[direction] = (path, False)
+    path = os.path.join(exp_path, 'best_mapping.t7')
+    if os.path.isfile(path):
+        mappings.setdefault('s2t', (path, False))
+        mappings.setdefault('t2s', (path, True))
+    return mappings
+
+
+class Translator(object):
+    """
+    Both embedding tables and, for each direction, the mapped queries and
+    their CSLS radii. Mappings are reloaded when their file changes.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.cuda = params.cuda
+        self.knn = params.csls_knn
+        self.words = {}
+        self.word2id = {}
+        self.normalized = {}
+        for name, path in [('src', params.src_emb), ('tgt', params.tgt_emb)]:
+            words, emb = load_embedding_cache(path, params.max_vocab, params.cache_dir)
+            self.words[name] = words
+            self.word2id[name] = words.word2id
+            self.normalized[name] = map_embeddings(emb, cuda=self.cuda)
+        self.lock = threading.Lock()
+        self.directions = {}
+        self.mappings = {}
+        self.reload()
+        assert len(self.directions) > 0, 'no mapping found in %s' % params.exp_path
+
+    def reload(self):
+        """
+        (Re)load the mappings whose file changed since the last call.
+        """
+        reloaded = []
+        for direction, (path, transpose) in sorted(find_mappings(self.params.exp_path).items()):
+            mtime = os.path.getmtime(path)
+            if self.mappings.get(direction) == (path, mtime):
+                continue
+            # a new mapping may still be being written by the trainer
+            if direction in self.directions and time.time() - mtime < 1:
+                continue
+            try:
+                W = torch.from_numpy(torch.load(path)).float()
+            except Exception as e:
+                logger.warning('Could not load %s: %s' % (path, e))
+                continue
+            W = W.transpose(0, 1).contiguous() if transpose else W
+            src, tgt = ('src', 'tgt') if direction == 's2t' else ('tgt', 'src')
+            tic = time.time()
+            state = {'src': src, 'tgt': tgt, 'path': path, 'mtime': mtime}
+            state['queries'] = map_embeddings(self.normalized[src], W, cuda=self.cuda)
+            state['keys'] = self.normalized[tgt]
+            if self.knn > 0:
+                state['query_radii'], state['key_radii'] = csls_radii(state['queries'], state['keys'], self.knn)
+            with self.lock:
+                self.directions[direction] = state
+                self.mappings[direction] = (path, mtime)
+            logger.info('Loaded the %s mapping from %s (%.2fs)' % (direction, path, time.time() - tic))
+            reloaded.append(direction)
+        return reloaded
+
+    def lookup(self, direction, words):
+        """
+        IDs of the source words of a direction (None for unknown words).
+        """
+        word2id = self.word2id['src' if direction == 's2t' else 'tgt']
+        return [word2id.get(w) for w in words]
+
+    def translate_ids(self, direction, method, ids, k):
+        """
+        Top-k translations of a batch of word IDs.
+        Returns (scores, ids) numpy arrays of shape (len(ids), k).
+        """
+        with self.lock:
+            state = self.directions[direction]
+        knn = parse_method(method)
+        assert knn == 0 or knn == self.knn, 'the server was started with --csls_knn %i' % self.knn
+        ids = torch.LongTensor(ids)
+        ids = ids.cuda() if self.cuda else ids
+        queries = state['queries'].index_select(0, ids)
+        if knn > 0:
+            scores, targets = translate(queries, state['keys'], k,
+                                        state['query_radii'].index_select(0, ids), state['key_radii'])
+        else:
+            scores, targets = translate(queries, state['keys'], k)
+        return scores.cpu().numpy(), targets.cpu().numpy()
+
+    def info(self):
+        with self.lock:
+            return {
+                'vocab': dict((name, len(words)) for name, words in self.words.items()),
+                'csls_knn': self.knn,
+                'directions': dict((d, {'mapping': s['path'], 'mtime': s['mtime']}) for d, s in self.directions.items()),
+            }
+
+
+class _Request(object):
+
+    def __init__(self, direction, method, ids, k):
+        self.direction = direction
+        self.method = method
+        self.ids = ids
+        self.k = k
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Group the queries of concurrent requests in a single batch: the first
+    request waits at most `max_wait` seconds for others, up to `max_batch` words.
+    """
+
+    def __init__(self, translator, max_batch=1024, max_wait=0.002):
+        self.translator = translator
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, direction, method, ids, k):
+        request = _Request(direction, method, ids, k)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            n_words = len(batch[0].ids)
+            deadline = time.time() + self.max_wait
+            while n_words < self.max_batch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                n_words += len(request.ids)
+            # one search per (direction, method)
+            groups = {}
+            for request in batch:
+                groups.setdefault((request.direction, request.method), []).append(request)
+            for (direction, method), requests in groups.items():
+                try:
+                    ids = [i for request in requests for i in request.ids]
+                    k = max(request.k for request in requests)
+                    scores, targets = self.translator.translate_ids(direction, method, ids, k)
+                    start = 0
+                    for request in requests:
+                        end = start + len(request.ids)
+                        request.result = (scores[start:end, :request.k], targets[start:end, :request.k])
+                        start = end
+                except Exception as e:
+                    for request in requests:
+                        request.error = e
+                for request in requests:
+                    request.done.set()
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+    """
+    GET /health
+    GET /translate?words=w1,w2&direction=s2t&k=10&method=csls_knn_10
+    POST /translate {"words": [...], "direction": "s2t", "k": 10, "method": "csls_knn_10"}
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/health':
+            return self._reply(200, self.server.translator.info())
+        if url.path == '/translate':
+            query = parse_qs(url.query)
+            request = dict((k, v[0]) for k, v in query.items())
+            request['words'] = [w for w in request.get('words', '').split(',') if w]
+            return self._translate(request)
+        self._reply(404, {'error': 'unknown path %s' % url.path})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/translate':
+            return self._reply(404, {'error': 'unknown path %s' % self.path})
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError:
+            return self._reply(400, {'error': 'invalid JSON'})
+        self._translate(request)
+
+    def _translate(self, request):
+        translator = self.server.translator
+        direction = request.get('direction', 's2t')
+        method = request.get('method', 'csls_knn_%i' % translator.knn if translator.knn > 0 else 'nn')
+        if direction not in translator.directions:
+            return self._reply(400, {'error': 'unavailable direction %s' % direction})
+        tgt_words = translator.words['tgt' if direction == 's2t' else 'src']
+        try:
+            k = int(request.get('k', 10))
+            parse_method(method)
+            assert 0 < k <= len(tgt_words)
+        except (AssertionError, ValueError):
+            return self._reply(400, {'error': 'invalid k / method'})
+        words = request.get('words', [])
+        ids = translator.lookup(direction, words)
+        known = [i for i in ids if i is not None]
+        results = []
+        if known:
+            try:
+                scores, targets = self.server.batcher.submit(direction, method, known, k)
+            except AssertionError as e:
+                return self._reply(400, {'error': str(e)})
+            except Exception as e:
+                logger.error('Translation failed: %s' % e)
+                return self._reply(500, {'error': str(e)})
+        j = 0
+        for word, i in zip(words, ids):
+            if i is None:
+                results.append({'word': word, 'translations': None})
+                continue
+            results.append({'word': word, 'translations': [[tgt_words[t], float(s)] for t, s in zip(targets[j], scores[j])]})
+            j += 1
+        self._reply(200, {'direction': direction, 'method': method, 'results': results})
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def make_server(translator, batcher, host='127.0.0.1', port=8080, unix_socket=''):
+    """
+    HTTP server on localhost:port, or on a Unix socket if `unix_socket` is given.
+    """
+    if unix_socket:
+        server = ThreadingUnixHTTPServer(unix_socket, TranslationHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), TranslationHandler)
+    server.translator = translator
+    server.batcher = batcher
+    return server
+
+
+def watch_mappings(translator, interval):
+    """
+    Reload the mappings in a background thread when a newer file appears.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            translator.reload()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class UnixHTTPConnection(HTTPConnection):
+
+    def __init__(self, path, timeout=60):
+        HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def benchmark(translator, host, port, unix_socket, n_clients=8, n_requests=100, batch_size=16,
+              k=10, method='nn', direction='s2t', seed=0):
+    """
+    Query a running server from `n_clients` concurrent clients, each sending
+    `n_requests` requests of `batch_size` random words. Returns latency
+    percentiles (ms) and throughput.
+    """
+    words = translator.words['src' if direction == 's2t' else 'tgt']
+    latencies = []
+    lock = threading.Lock()
+
+    def client(client_id):
+        rng = np.random.RandomState(seed + client_id)
+        conn = UnixHTTPConnection(unix_socket) if unix_socket else HTTPConnection(host, port, timeout=60)
+        client_latencies = []
+        for _ in range(n_requests):
+            batch = [words[i] for i in rng.randint(len(words), size=batch_size)]
+            body = json.dumps({'words': batch, 'direction': direction, 'k': k, 'method': method})
+            tic = time.time()
+            conn.request('POST', '/translate', body, {'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            response.read()
+            client_latencies.append(time.time() - tic)
+            assert response.status == 200, response.status
+        conn.close()
+        with lock:
+            latencies.extend(client_latencies)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(n_clients)]
+    tic = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - tic
+    latencies = np.array(latencies) * 1000
+    return {
+        'clients': n_clients,
+        'requests': len(latencies),
+        'batch_size': batch_size,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'mean_ms': float(latencies.mean()),
+        'requests_per_s': len(latencies) / elapsed,
+        'queries_per_s': len(latencies) * batch_size / elapsed,
+    }
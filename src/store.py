@@ -0,0 +1,148 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import os
+from logging import getLogger
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from .utils import normalize_embeddings
+from .vocab import EmbeddingFileIndex
+from .retrieval import map_embeddings
+from .dictionary import CompactDictionary
+
+
+logger = getLogger()
+
+STORE_VERSION = 1
+
+
+def save_mapped_store(path, params, source, mapping=None):
+    """
+    Export the source / target embeddings as a mapped store: a reference to
+    the embedding file, the rows of the words, the normalization steps and
+    the mapping weight. MappedStore computes the exported vectors from it.
+    """
+    emb_path = params.src_emb if source else params.tgt_emb
+    dico = params.src_dico if source else params.tgt_dico
+    rows = getattr(params, 'src_rows' if source else 'tgt_rows', None)
+    store = {
+        'version': STORE_VERSION,
+        'lang': params.src_lang if source else params.tgt_lang,
+        'emb_path': os.path.abspath(emb_path),
+        'emb_size': os.path.getsize(emb_path),
+        'emb_dim': params.emb_dim,
+        'n_words': len(dico),
+        # word i is row rows[i] of the file (row i if None)
+        'rows': None if rows is None else np.asarray(rows, dtype=np.int64),
+        'normalize': params.normalize_embeddings,
+        'mapping': mapping,
+    }
+    logger.info('Writing the mapped store of the %s embeddings to %s ...' % (store['lang'], path))
+    torch.save(store, path)
+
+
+def export_mapped_stores(mapping, params):
+    """
+    Export the mapped source embeddings and the target embeddings as mapped
+    stores (`store-<lang>.t7`), instead of text files.
+    """
+    save_mapped_store(os.path.join(params.exp_path, 'store-%s.t7' % params.src_lang), params, True, mapping)
+    save_mapped_store(os.path.join(params.exp_path, 'store-%s.t7' % params.tgt_lang), params, False)
+
+
+class MappedStore(object):
+    """
+    Reader of a mapped store. The rows of the embedding file are read with
+    an EmbeddingFileIndex, normalized and mapped on the fly, `block_size`
+    words at a time, and the last `cache_blocks` blocks read are cached.
+    Vectors are the ones of the text export (normalized float32).
+    """
+
+    def __init__(self, path, block_size=4096, cache_blocks=64):
+        store = torch.load(path)
+        assert store['version'] == STORE_VERSION, 'unsupported store version: %s' % store['version']
+        emb_path = store['emb_path']
+        if not os.path.isfile(emb_path) or os.path.getsize(emb_path) != store['emb_size']:
+            raise Exception('The embedding file of %s (%s) is missing or changed since the export' % (path, emb_path))
+        self.lang = store['lang']
+        self.index = EmbeddingFileIndex(emb_path)
+        assert self.index.dim == store['emb_dim']
+        self.n_words = store['n_words']
+        self.rows = store['rows']
+        self.normalize = store['normalize']
+        self.mapping = None if store['mapping'] is None else torch.from_numpy(np.asarray(store['mapping'], dtype=np.float32))
+        self.dim = store['emb_dim'] if self.mapping is None else self.mapping.size(0)
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.cache = OrderedDict()
+        self._dico = None
+
+    def __len__(self):
+        return self.n_words
+
+    @property
+    def dico(self):
+        """
+        Vocabulary of the store (built on first access).
+        """
+        if self._dico is None:
+            if self.rows is None and self.n_words == len(self.index):
+                self._dico = self.index.dico
+            else:
+                rows = range(self.n_words) if self.rows is None else self.rows
+                self._dico = CompactDictionary.from_words([self.index.dico[int(i)] for i in rows], self.lang)
+        return self._dico
+
+    def _read_block(self, b):
+        start = b * self.block_size
+        end = min(self.n_words, start + self.block_size)
+        rows = np.arange(start, end) if self.rows is None else self.rows[start:end]
+        emb = torch.from_numpy(self.index.read_rows(rows))
+        normalize_embeddings(emb, self.normalize)
+        return map_embeddings(emb, self.mapping).numpy()
+
+    def block(self, b):
+        """
+        Vectors of the words [b * block_size, (b + 1) * block_size).
+        """
+        if b in self.cache:
+            # most recently used blocks are at the end
+            vectors = self.cache.pop(b)
+        else:
+            vectors = self._read_block(b)
+            if len(self.cache) >= self.cache_blocks:
+                self.cache.popitem(last=False)
+        self.cache[b] = vectors
+        return vectors
+
+    def blocks(self):
+        """
+        Iterate over (first word ID, vectors) of all the blocks.
+        """
+        for b in range((self.n_words + self.block_size - 1) // self.block_size):
+            yield b * self.block_size, self.block(b)
+
+    def __getitem__(self, ids):
+        """
+        Vector of a word ID, or (n, dim) vectors of a slice / list of word IDs.
+        """
+        if isinstance(ids, (int, np.integer)):
+            if not 0 <= ids < self.n_words:
+                raise IndexError(ids)
+            return self.block(ids // self.block_size)[ids % self.block_size]
+        ids = np.arange(self.n_words)[ids] if isinstance(ids, slice) else np.asarray(ids, dtype=np.int64)
+        vectors = np.zeros((len(ids), self.dim), dtype=np.float32)
+        if len(ids) == 0:
+            return vectors
+        assert ids.min() >= 0 and ids.max() < self.n_words
+        blocks = ids // self.block_size
+        for b in np.unique(blocks):
+            selected = np.nonzero(blocks == b)[0]
+            vectors[selected] = self.block(int(b))[ids[selected] - b * self.block_size]
+        return vectors
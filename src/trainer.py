@@ -4,15 +4,17 @@
 
 import os
 from logging import getLogger
-import scipy
-import scipy.linalg
 import torch
 from torch.autograd import Variable
 from torch.nn import functional as F
 
 from .utils import get_optimizer, export_embeddings
 from .utils import clip_parameters
+from .store import export_mapped_stores
+from .pq import load_embedding_index, recall_report
 from .dico_builder import build_dictionary
+from .procrustes import IncrementalProcrustes, procrustes_step
+from .profiler import profiler
 from .evaluation.word_translation import DIC_EVAL_PATH, load_identical_char_dico, load_dictionary
 
 
@@ -46,9 +48,31 @@ class Trainer(object):
 
         # best validation score
         self.best_valid_metric = -1e12
+        # best proxy criterion (see save_best_proxy), and evaluations since it improved
+        self.best_proxy_metric = -1e12
+        self.n_proxy_bad = 0
 
         self.decrease_lr = False
 
+        # normalized target embeddings (can be shared between trainers)
+        self.tgt_emb_normalized = None
+
+        # cross-covariance of the refinement dictionary
+        self.procrustes_state = None
+
+        # PQ indexes of the source / target embeddings (see pq_indexes)
+        self.indexes = None
+
+    def normalized_tgt_emb(self):
+        """
+        Normalized target embeddings. They are not trained, so they are
+        only computed once (or set by the caller, e.g. `multilingual.py`).
+        """
+        if self.tgt_emb_normalized is None:
+            self.tgt_emb_normalized = self.tgt_emb.mapped()
+        return self.tgt_emb_normalized
+
+    @profiler.timed('get_dis_xy')
     def get_dis_xy(self, volatile):
         """
         Get discriminator input batch / output target.
@@ -64,10 +88,10 @@ class Trainer(object):
             tgt_ids = tgt_ids.cuda()
 
         # get word embeddings
-        src_emb = self.src_emb(Variable(src_ids, volatile=True))
-        tgt_emb = self.tgt_emb(Variable(tgt_ids, volatile=True))
-        src_emb = self.mapping(Variable(src_emb.data, volatile=volatile))
-        tgt_emb = Variable(tgt_emb.data, volatile=volatile)
+        src_emb = self.src_emb(src_ids)
+        tgt_emb = self.tgt_emb(tgt_ids)
+        src_emb = self.mapping(Variable(src_emb.float(), volatile=volatile))
+        tgt_emb = Variable(tgt_emb.float(), volatile=volatile)
 
         # input / target
         x = torch.cat([src_emb, tgt_emb], 0)
@@ -78,6 +102,7 @@ class Trainer(object):
 
         return x, y
 
+    @profiler.timed('dis_step')
     def dis_step(self, stats):
         """
         Train the discriminator.
@@ -101,6 +126,7 @@ class Trainer(object):
         self.dis_optimizer.step()
         clip_parameters(self.discriminator, self.params.dis_clip_weights)
 
+    @profiler.timed('mapping_step')
     def mapping_step(self, stats):
         """
         Fooling discriminator training step.
@@ -154,28 +180,50 @@ class Trainer(object):
         if self.params.cuda:
             self.dico = self.dico.cuda()
 
+    @profiler.timed('build_dictionary')
     def build_dictionary(self):
         """
         Build a dictionary from aligned embeddings.
         """
-        src_emb = self.mapping(self.src_emb.weight).data
-        tgt_emb = self.tgt_emb.weight.data
-        src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-        tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
-        self.dico = build_dictionary(src_emb, tgt_emb, self.params)
-
+        src_emb = self.src_emb.mapped(self.mapping)
+        tgt_emb = self.normalized_tgt_emb()
+        src_index, tgt_index = None, None
+        if getattr(self.params, 'dico_index', ''):
+            src_index, tgt_index = self.pq_indexes()
+            src_index = src_index.mapped(self.mapping.weight.data)
+        self.dico = build_dictionary(src_emb, tgt_emb, self.params, src_index=src_index, tgt_index=tgt_index)
+
+    def pq_indexes(self):
+        """
+        PQ indexes of the normalized source / target embeddings (--dico_index),
+        built once per embedding file. The recall of their shortlists with
+        the current mapping is logged when they are loaded.
+        """
+        if self.indexes is None:
+            src_emb = self.src_emb.mapped()
+            tgt_emb = self.normalized_tgt_emb()
+            src_index = load_embedding_index(src_emb, self.params, True)
+            tgt_index = load_embedding_index(tgt_emb, self.params, False)
+            mapped_src_emb = self.src_emb.mapped(self.mapping)
+            logger.info('PQ index recall (S2T): %s' % recall_report(tgt_index, tgt_emb, mapped_src_emb))
+            logger.info('PQ index recall (T2S): %s' % recall_report(src_index.mapped(self.mapping.weight.data),
+                                                                    mapped_src_emb, tgt_emb))
+            self.indexes = (src_index, tgt_index)
+        return self.indexes
+
+    @profiler.timed('procrustes')
     def procrustes(self):
         """
         Find the best orthogonal matrix mapping using the Orthogonal Procrustes problem
         https://en.wikipedia.org/wiki/Orthogonal_Procrustes_problem
+        The cross-covariance is updated with the pairs added / removed since
+        the previous call. Return the dictionary churn / mapping change.
         """
-        A = self.src_emb.weight.data[self.dico[:, 0]]
-        B = self.tgt_emb.weight.data[self.dico[:, 1]]
-        W = self.mapping.weight.data
-        M = B.transpose(0, 1).mm(A).cpu().numpy()
-        U, S, V_t = scipy.linalg.svd(M, full_matrices=True)
-        W.copy_(torch.from_numpy(U.dot(V_t)).type_as(W))
+        if self.procrustes_state is None:
+            self.procrustes_state = IncrementalProcrustes(self.src_emb.weight, self.tgt_emb.weight)
+        return procrustes_step(self.procrustes_state, self.dico, self.mapping.weight.data)
 
+    @profiler.timed('orthogonalize')
     def orthogonalize(self):
         """
         Orthogonalize the mapping.
@@ -225,11 +273,27 @@ class Trainer(object):
             logger.info('* Saving the mapping to %s ...' % path)
             torch.save(W, path)
 
-    def reload_best(self):
+    def save_best_proxy(self, to_log, metric):
         """
-        Reload the best mapping.
+        Save the best model for a proxy criterion evaluated within the epochs,
+        and count the evaluations since it last improved.
         """
-        path = os.path.join(self.params.exp_path, 'best_mapping.t7')
+        if to_log[metric] > self.best_proxy_metric:
+            self.best_proxy_metric = to_log[metric]
+            self.n_proxy_bad = 0
+            logger.info('* Best value for "%s": %.5f' % (metric, to_log[metric]))
+            W = self.mapping.weight.data.cpu().numpy()
+            path = os.path.join(self.params.exp_path, 'best_proxy_mapping.t7')
+            logger.info('* Saving the mapping to %s ...' % path)
+            torch.save(W, path)
+        else:
+            self.n_proxy_bad += 1
+
+    def reload_best(self, name='best_mapping'):
+        """
+        Reload the best mapping (`best_proxy_mapping` for the proxy criterion).
+        """
+        path = os.path.join(self.params.exp_path, '%s.t7' % name)
         logger.info('* Reloading the best model from %s ...' % path)
         # reload the model
         assert os.path.isfile(path)
@@ -240,10 +304,12 @@ class Trainer(object):
 
     def export(self):
         """
-        Export embeddings to a text file.
+        Export embeddings to a text file, or as mapped stores (references to
+        the embedding files, with the mapping) with `--export_format store`.
         """
-        src_emb = self.mapping(self.src_emb.weight).data
-        tgt_emb = self.tgt_emb.weight.data
-        src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-        tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
-        export_embeddings(src_emb.cpu().numpy(), tgt_emb.cpu().numpy(), self.params)
+        if getattr(self.params, 'export_format', 'txt') == 'store':
+            export_mapped_stores(self.mapping.weight.data.cpu().numpy(), self.params)
+            return
+        src_emb = self.src_emb.mapped(self.mapping)
+        tgt_emb = self.normalized_tgt_emb()
+        export_embeddings(src_emb.float().cpu().numpy(), tgt_emb.float().cpu().numpy(), self.params)
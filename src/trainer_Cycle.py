@@ -3,18 +3,20 @@
 #
 
 import os
-import time
 
 from logging import getLogger
-import scipy
-import scipy.linalg
 import torch
 from torch.autograd import Variable
 from torch.nn import functional as F
 
 from .utils import get_optimizer, export_embeddings
 from .utils import clip_parameters
+from .store import export_mapped_stores
+from .pq import load_embedding_index, recall_report
 from .dico_builder import build_dictionary
+from .procrustes import IncrementalProcrustes, procrustes_step
+from .retrieval import mapped_embeddings
+from .profiler import profiler
 from .evaluation.word_translation import DIC_EVAL_PATH, load_identical_char_dico, load_dictionary, get_word_translation_accuracy, get_word_translation_accuracy_score
 
 logger = getLogger()
@@ -55,9 +57,21 @@ class Trainer_Cycle(object):
 
         # best validation score
         self.best_valid_metric = -1e12
+        # best proxy criterion (see save_best_proxy), and evaluations since it improved
+        self.best_proxy_metric = -1e12
+        self.n_proxy_bad = 0
 
         self.decrease_lr = False
 
+        # normalized target embeddings (can be shared between trainers)
+        self.tgt_emb_normalized = None
+
+        # cross-covariance of the refinement dictionary of each direction
+        self.procrustes_state = {}
+
+        # PQ indexes of the source / target embeddings (see pq_indexes)
+        self.indexes = None
+
     def cycle_lambda(self, direction):
         if direction:
             return self.params.lambda_a
@@ -88,6 +102,16 @@ class Trainer_Cycle(object):
         return self.dis_optimizer2
 
 
+    def normalized_tgt_emb(self):
+        """
+        Normalized target embeddings. They are not trained, so they are
+        only computed once (or set by the caller, e.g. `multilingual.py`).
+        """
+        if self.tgt_emb_normalized is None:
+            self.tgt_emb_normalized = self.tgt_emb.mapped()
+        return self.tgt_emb_normalized
+
+    @profiler.timed('get_dis_xy')
     def get_dis_xy(self, volatile, direction):
         """
         Get discriminator input batch / output target.
@@ -102,16 +126,16 @@ class Trainer_Cycle(object):
             src_ids = src_ids.cuda()
             tgt_ids = tgt_ids.cuda()
         # get word embeddings
-        src_emb = self.src_emb(Variable(src_ids, volatile=True))
-        tgt_emb = self.tgt_emb(Variable(tgt_ids, volatile=True))
+        src_emb = self.src_emb(src_ids)
+        tgt_emb = self.tgt_emb(tgt_ids)
 
         if direction:
-            src_emb = self.mapping(direction)(Variable(src_emb.data, volatile=volatile))
-            tgt_emb = Variable(tgt_emb.data, volatile=volatile)
+            src_emb = self.mapping(direction)(Variable(src_emb.float(), volatile=volatile))
+            tgt_emb = Variable(tgt_emb.float(), volatile=volatile)
             x = torch.cat([src_emb, tgt_emb], 0)
         else:
-            src_emb = Variable(src_emb.data, volatile=volatile)
-            tgt_emb = self.mapping(direction)(Variable(tgt_emb.data, volatile=volatile))
+            src_emb = Variable(src_emb.float(), volatile=volatile)
+            tgt_emb = self.mapping(direction)(Variable(tgt_emb.float(), volatile=volatile))
             x = torch.cat([tgt_emb, src_emb], 0)
 
         # input / target
@@ -123,6 +147,7 @@ class Trainer_Cycle(object):
 
         return x, y
 
+    @profiler.timed('dis_step')
     def dis_step(self, stats, direction):
         # if direction:
         #     print("----dis normal")
@@ -154,6 +179,7 @@ class Trainer_Cycle(object):
         self.dis_optimizer(direction).step()
         clip_parameters(self.discriminator(direction), self.params.dis_clip_weights)
 
+    @profiler.timed('mapping_step')
     def mapping_step(self, stats, direction):
         """
         Fooling discriminator training step.
@@ -194,6 +220,7 @@ class Trainer_Cycle(object):
         self.orthogonalize(direction)
 
 
+    @profiler.timed('consistency_loss')
     def consistency_loss(self, volatile, direction):
         bs = 2*self.params.batch_size
         mf = self.params.dis_most_frequent
@@ -211,15 +238,16 @@ class Trainer_Cycle(object):
         if self.params.cuda:
             ids = ids.cuda()
 
-        emb_part = Variable(emb(Variable(ids, volatile=True)).data, volatile=volatile)
+        emb_part = Variable(emb(ids).float(), volatile=volatile)
         
         if self.params.cc_method=='default':
             emb_part_cycle = self.mapping(not direction)(self.mapping(direction)(emb_part))
             loss = F.l1_loss(emb_part,emb_part_cycle)
 
         else:
-            tgt_emb = emb.weight.data
-            src_emb = self.mapping(not direction)(self.mapping(direction)(emb.weight)).data
+            tgt_emb = emb.weight
+            W = self.mapping(not direction).weight.data.mm(self.mapping(direction).weight.data)
+            src_emb = mapped_embeddings(emb.weight, W, normalize=False)
             if self.params.cuda:
                 tgt_emb = tgt_emb.cuda()
                 src_emb = src_emb.cuda()
@@ -232,17 +260,14 @@ class Trainer_Cycle(object):
             if self.params.cuda:
                 dico = dico.cuda()
             
-            t1=time.time()
-            scores = get_word_translation_accuracy_score(dico, src_emb, tgt_emb, method=self.params.cc_method)
-            t2=time.time()
-
+            with profiler.timer('scores'):
+                scores = get_word_translation_accuracy_score(dico, src_emb, tgt_emb, method=self.params.cc_method)
 
             # indices = scores.topk(1, 1, True)[1][:,0]
-            indices = scores.max(1)[1]
-            t3=time.time()
+            with profiler.timer('argmax'):
+                indices = scores.max(1)[1]
 
-            print(t2-t1,t3-t2)
-            emb_part_cycle = Variable(emb(Variable(indices, volatile=True)).data, volatile=volatile)
+            emb_part_cycle = Variable(emb(indices).float(), volatile=volatile)
             loss = F.l1_loss(emb_part,emb_part_cycle)
 
             
@@ -289,37 +314,62 @@ class Trainer_Cycle(object):
         if self.params.cuda:
             self.dico = self.dico.cuda()
 
+    @profiler.timed('build_dictionary')
     def build_dictionary(self, direction):
         """
         Build a dictionary from aligned embeddings.
         """
         if direction:
-            src_emb = self.mapping(direction)(self.src_emb.weight).data
-            tgt_emb = self.tgt_emb.weight.data
+            src_emb = self.src_emb.mapped(self.mapping(direction))
+            tgt_emb = self.normalized_tgt_emb()
         else:
-            src_emb = self.src_emb.weight.data
-            tgt_emb = self.mapping(direction)(self.tgt_emb.weight).data
-
-        src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-        tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
-        self.dico = build_dictionary(src_emb, tgt_emb, self.params)
-
+            src_emb = self.src_emb.mapped()
+            tgt_emb = self.tgt_emb.mapped(self.mapping(direction))
+        src_index, tgt_index = None, None
+        if getattr(self.params, 'dico_index', ''):
+            src_index, tgt_index = self.pq_indexes()
+            if direction:
+                src_index = src_index.mapped(self.mapping(direction).weight.data)
+            else:
+                tgt_index = tgt_index.mapped(self.mapping(direction).weight.data)
+        self.dico = build_dictionary(src_emb, tgt_emb, self.params, src_index=src_index, tgt_index=tgt_index)
+
+    def pq_indexes(self):
+        """
+        PQ indexes of the normalized source / target embeddings (--dico_index),
+        built once per embedding file. The recall of their shortlists with
+        the current normal direction mapping is logged when they are loaded.
+        """
+        if self.indexes is None:
+            src_emb = self.src_emb.mapped()
+            tgt_emb = self.normalized_tgt_emb()
+            src_index = load_embedding_index(src_emb, self.params, True)
+            tgt_index = load_embedding_index(tgt_emb, self.params, False)
+            mapped_src_emb = self.src_emb.mapped(self.mapping(True))
+            logger.info('PQ index recall (S2T): %s' % recall_report(tgt_index, tgt_emb, mapped_src_emb))
+            logger.info('PQ index recall (T2S): %s' % recall_report(src_index.mapped(self.mapping(True).weight.data),
+                                                                    mapped_src_emb, tgt_emb))
+            self.indexes = (src_index, tgt_index)
+        return self.indexes
+
+    @profiler.timed('procrustes')
     def procrustes(self, direction):
         """
         Find the best orthogonal matrix mapping using the Orthogonal Procrustes problem
         https://en.wikipedia.org/wiki/Orthogonal_Procrustes_problem
+        The cross-covariance is updated with the pairs added / removed since
+        the previous call. Return the dictionary churn / mapping change.
         """
-        if direction:
-            A = self.src_emb.weight.data[self.dico[:, 0]]
-            B = self.tgt_emb.weight.data[self.dico[:, 1]]
-        else:
-            B = self.src_emb.weight.data[self.dico[:, 0]]
-            A = self.tgt_emb.weight.data[self.dico[:, 1]]
-        W = self.mapping(direction).weight.data
-        M = B.transpose(0, 1).mm(A).cpu().numpy()
-        U, S, V_t = scipy.linalg.svd(M, full_matrices=True)
-        W.copy_(torch.from_numpy(U.dot(V_t)).type_as(W))
-
+        if direction not in self.procrustes_state:
+            if direction:
+                self.procrustes_state[direction] = IncrementalProcrustes(self.src_emb.weight, self.tgt_emb.weight)
+            else:
+                self.procrustes_state[direction] = IncrementalProcrustes(self.tgt_emb.weight, self.src_emb.weight)
+        # (A, B) pairs
+        dico = self.dico if direction else torch.cat([self.dico[:, 1:], self.dico[:, :1]], 1)
+        return procrustes_step(self.procrustes_state[direction], dico, self.mapping(direction).weight.data)
+
+    @profiler.timed('orthogonalize')
     def orthogonalize(self, direction):
         """
         Orthogonalize the mapping.
@@ -380,22 +430,37 @@ class Trainer_Cycle(object):
             self.save_best_single(to_log, metric, True)
             self.save_best_single(to_log, metric, False)
 
-    def save_best_single(self, to_log, metric, direction):
+    def save_best_single(self, to_log, metric, direction, name='best_mapping'):
         # save the mapping
         W = self.mapping(direction).weight.data.cpu().numpy()
-        path = os.path.join(self.params.exp_path, 'best_mapping_'+str(direction)+'.t7')
+        path = os.path.join(self.params.exp_path, name+'_'+str(direction)+'.t7')
         logger.info('* Saving the mapping to %s ...' % path)
         torch.save(W, path)
 
-    def reload_best(self):
-        self.reload_best_single(True)
-        self.reload_best_single(False)
+    def save_best_proxy(self, to_log, metric):
+        """
+        Save the best models for a proxy criterion evaluated within the epochs,
+        and count the evaluations since it last improved.
+        """
+        if to_log[metric] > self.best_proxy_metric:
+            self.best_proxy_metric = to_log[metric]
+            self.n_proxy_bad = 0
+            logger.info('* Best value for "%s": %.5f' % (metric, to_log[metric]))
+
+            self.save_best_single(to_log, metric, True, 'best_proxy_mapping')
+            self.save_best_single(to_log, metric, False, 'best_proxy_mapping')
+        else:
+            self.n_proxy_bad += 1
 
-    def reload_best_single(self, direction):
+    def reload_best(self, name='best_mapping'):
+        self.reload_best_single(True, name)
+        self.reload_best_single(False, name)
+
+    def reload_best_single(self, direction, name='best_mapping'):
         """
-        Reload the best mapping.
+        Reload the best mapping (`best_proxy_mapping` for the proxy criterion).
         """
-        path = os.path.join(self.params.exp_path, 'best_mapping_'+str(direction)+'.t7')
+        path = os.path.join(self.params.exp_path, name+'_'+str(direction)+'.t7')
         logger.info('* Reloading the best model from %s ...' % path)
         # reload the model
         assert os.path.isfile(path)
@@ -406,10 +471,12 @@ class Trainer_Cycle(object):
 
     def export(self):
         """
-        Export embeddings to a text file.
+        Export embeddings to a text file, or as mapped stores (references to
+        the embedding files, with the mapping) with `--export_format store`.
         """
-        src_emb = self.mapping(True)(self.src_emb.weight).data
-        tgt_emb = self.tgt_emb.weight.data
-        src_emb = src_emb / src_emb.norm(2, 1, keepdim=True).expand_as(src_emb)
-        tgt_emb = tgt_emb / tgt_emb.norm(2, 1, keepdim=True).expand_as(tgt_emb)
-        export_embeddings(src_emb.cpu().numpy(), tgt_emb.cpu().numpy(), self.params)
\ No newline at end of file
+        if getattr(self.params, 'export_format', 'txt') == 'store':
+            export_mapped_stores(self.mapping(True).weight.data.cpu().numpy(), self.params)
+            return
+        src_emb = self.src_emb.mapped(self.mapping(True))
+        tgt_emb = self.normalized_tgt_emb()
+        export_embeddings(src_emb.float().cpu().numpy(), tgt_emb.float().cpu().numpy(), self.params)
\ No newline at end of file
@@ -19,7 +19,9 @@ from torch import optim
 from logging import getLogger
 
 from .logger import create_logger
-from .dictionary import Dictionary
+from .dictionary import CompactDictionary
+from .profiler import profiler
+from .autotune import autotuner
 
 
 MAIN_DUMP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'dumped')
@@ -142,15 +144,32 @@ def read_embeddings(path, dim=None, n_max=1e9):
     return word2id, embeddings
 
 
+def mm_float(a, b, bs=16384):
+    """
+    a.mm(b.transpose(0, 1)), accumulated and returned in float32 for
+    embeddings stored in half precision: `b` is upcast `bs` rows at a time,
+    so that no float32 copy of it is made.
+    """
+    a = a.float()
+    if b.type() == a.type():
+        return a.mm(b.transpose(0, 1))
+    out = a.new(a.size(0), b.size(0))
+    for i in range(0, b.size(0), bs):
+        out[:, i:i + bs] = a.mm(b[i:i + bs].float().transpose(0, 1))
+    return out
+
+
+@profiler.timed('get_nn_avg_dist')
 def get_nn_avg_dist(emb, query, knn):
     """
     Compute the average distance of the `knn` nearest neighbors
     for a given set of embeddings and queries.
     Use Faiss if available.
     """
+    profiler.count('get_nn_avg_dist.queries', query.shape[0])
     if FAISS_AVAILABLE:
-        emb = emb.cpu().numpy()
-        query = query.cpu().numpy()
+        emb = emb.float().cpu().numpy()
+        query = query.float().cpu().numpy()
         if hasattr(faiss, 'StandardGpuResources'):
             # gpu mode
             res = faiss.StandardGpuResources()
@@ -164,11 +183,10 @@ def get_nn_avg_dist(emb, query, knn):
         distances, _ = index.search(query, knn)
         return distances.mean(1)
     else:
-        bs = 1024
+        bs = autotuner.block_size('topk', emb, 1024)
         all_distances = []
-        emb = emb.transpose(0, 1).contiguous()
         for i in range(0, query.shape[0], bs):
-            distances = query[i:i + bs].mm(emb)
+            distances = mm_float(query[i:i + bs], emb)
             best_distances, _ = distances.topk(knn, dim=1, largest=True, sorted=True)
             all_distances.append(best_distances.mean(1).cpu())
         all_distances = torch.cat(all_distances)
@@ -263,12 +281,13 @@ def clip_parameters(model, clip):
             x.data.clamp_(-clip, clip)
 
 
+@profiler.timed('load_external_embeddings')
 def load_external_embeddings(params, source):
     """
     Reload pretrained embeddings from a text file.
     """
     assert type(source) is bool
-    word2id = {}
+    words = []
     vectors = []
 
     # load pretrained embeddings
@@ -286,9 +305,8 @@ def load_external_embeddings(params, source):
                 vect = np.fromstring(vect, sep=' ')
                 if np.linalg.norm(vect) == 0:  # avoid to have null embeddings
                     vect[0] = 0.01
-                assert word not in word2id
                 assert vect.shape == (_emb_dim_file,), i
-                word2id[word] = len(word2id)
+                words.append(word)
                 vectors.append(vect[None])
             if params.max_vocab > 0 and i >= params.max_vocab:
                 break
@@ -296,16 +314,32 @@ def load_external_embeddings(params, source):
     logger.info("Loaded %i pre-trained word embeddings" % len(vectors))
 
     # compute new vocabulary / embeddings
-    id2word = {v: k for k, v in word2id.items()}
-    dico = Dictionary(id2word, word2id, lang)
+    dico = CompactDictionary.from_words(words, lang, check=True)
     embeddings = np.concatenate(vectors, 0)
     embeddings = torch.from_numpy(embeddings).float()
     embeddings = embeddings.cuda() if params.cuda else embeddings
-    assert embeddings.size() == (len(word2id), params.emb_dim), ((len(word2id), params.emb_dim, embeddings.size()))
+    assert embeddings.size() == (len(dico), params.emb_dim), ((len(dico), params.emb_dim, embeddings.size()))
 
     return dico, embeddings
 
 
+EMB_DTYPES = ['float32', 'float16', 'bfloat16']
+
+
+def cast_embeddings(emb, emb_dtype):
+    """
+    Store (frozen) embeddings in float32, float16 or bfloat16.
+    Computations on them accumulate in float32 (see `mm_float`).
+    """
+    assert emb_dtype in EMB_DTYPES
+    if emb_dtype == 'float16':
+        return emb.half()
+    if emb_dtype == 'bfloat16':
+        assert hasattr(emb, 'bfloat16'), 'bfloat16 is not supported by this version of PyTorch'
+        return emb.bfloat16()
+    return emb.float()
+
+
 def normalize_embeddings(emb, types):
     """
     Normalize embeddings by their norms / recenter them.
@@ -0,0 +1,223 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+
+import io
+import os
+import time
+from logging import getLogger
+import numpy as np
+import torch
+
+from .utils import load_external_embeddings
+from .dictionary import CompactDictionary
+from .evaluation.word_translation import DIC_EVAL_PATH
+from .evaluation.wordsim import MONOLINGUAL_EVAL_PATH, SEMEVAL17_EVAL_PATH
+from .evaluation.sent_translation import EUROPARL_DIR
+
+
+logger = getLogger()
+
+# sentences read by Evaluator.sent_translation (n_keys + 2 * n_idf)
+EUROPARL_N_MAX = 200000 + 2 * 300000
+# most frequent words used by Evaluator.dist_mean_cosine
+DIST_MEAN_COSINE_RANK = 10000
+
+
+class EmbeddingFileIndex(object):
+    """
+    Byte offset and word of every line of a .vec file. It is built with one
+    pass that does not parse the vectors, and saved next to the file
+    (`.rows.npy` / `.dico`, memory-mapped), so that rows are then read by
+    seeking to them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        offsets_path = path + '.rows.npy'
+        dico_path = path + '.dico'
+        if (os.path.isfile(offsets_path) and os.path.isfile(dico_path) and
+                os.path.getmtime(offsets_path) >= os.path.getmtime(path)):
+            self.offsets = np.load(offsets_path, mmap_mode='r')
+            self.dico = CompactDictionary.load(dico_path, None)
+            with io.open(path, 'rb') as f:
+                self.dim = int(f.readline().split()[1])
+            return
+        tic = time.time()
+        words = []
+        offsets = []
+        with io.open(path, 'rb') as f:
+            line = f.readline()
+            self.dim = int(line.split()[1])
+            offset = len(line)
+            for line in f:
+                words.append(line[:line.index(b' ')])
+                offsets.append(offset)
+                offset += len(line)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.dico = CompactDictionary.from_words(words, None)
+        logger.info('Indexed %i lines of %s in %.2fs' % (len(words), path, time.time() - tic))
+        try:
+            with open(offsets_path + '.tmp', 'wb') as f:
+                np.save(f, self.offsets)
+            os.rename(offsets_path + '.tmp', offsets_path)
+            self.dico.save(dico_path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not save the index of %s: %s' % (path, e))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def read_rows(self, rows):
+        """
+        Embeddings of the given (sorted) rows.
+        """
+        vectors = np.zeros((len(rows), self.dim), dtype=np.float32)
+        with io.open(self.path, 'rb') as f:
+            position = -1
+            for i, row in enumerate(rows):
+                # consecutive rows are read without seeking
+                if self.offsets[row] != position:
+                    f.seek(self.offsets[row])
+                line = f.readline()
+                position = self.offsets[row] + len(line)
+                vect = np.fromstring(line.decode('utf-8').rstrip().split(' ', 1)[1], sep=' ')
+                assert vect.shape == (self.dim,), row
+                if np.linalg.norm(vect) == 0:  # avoid to have null embeddings
+                    vect[0] = 0.01
+                vectors[i] = vect
+        return vectors
+
+
+def _dictionary_words(path, column):
+    words = set()
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            split = line.rstrip().split()
+            if len(split) == 2:
+                words.add(split[column])
+    return words
+
+
+def _wordsim_words(path, columns):
+    words = set()
+    with io.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            split = line.rstrip().lower().split()
+            if len(split) != 3:
+                continue
+            for column in columns:
+                # see wordsim.get_word_id
+                word = split[column]
+                words.update([word, word.capitalize(), word.title()])
+    return words
+
+
+def required_words(params, source):
+    """
+    Words of the source / target language looked up by the training and
+    evaluation dictionaries, word similarity files and Europarl sentences.
+    """
+    lang = params.src_lang if source else params.tgt_lang
+    other = params.tgt_lang if source else params.src_lang
+    words = set()
+
+    # bilingual dictionaries, in both directions
+    for lang1, lang2 in [(lang, other), (other, lang)]:
+        for name in ['0-5000', '5000-6500']:
+            path = os.path.join(DIC_EVAL_PATH, '%s-%s.%s.txt' % (lang1, lang2, name))
+            if os.path.isfile(path):
+                words |= _dictionary_words(path, 0 if lang1 == lang else 1)
+    dico_train = getattr(params, 'dico_train', 'default')
+    if dico_train not in ['default', 'identical_char'] and os.path.isfile(dico_train):
+        words |= _dictionary_words(dico_train, 0 if source else 1)
+
+    # monolingual / cross-lingual word similarity
+    dirpath = os.path.join(MONOLINGUAL_EVAL_PATH, lang)
+    if os.path.isdir(dirpath):
+        for filename in os.listdir(dirpath):
+            if filename.startswith('%s_' % lang.upper()):
+                words |= _wordsim_words(os.path.join(dirpath, filename), [0, 1])
+    dirpath = os.path.join(SEMEVAL17_EVAL_PATH, '%s-%s' % tuple(sorted([lang, other])))
+    if os.path.isdir(dirpath):
+        for filename in os.listdir(dirpath):
+            if 'SEMEVAL17' in filename:
+                split = filename.split('_')[0].split('-')
+                words |= _wordsim_words(os.path.join(dirpath, filename),
+                                        [i for i in range(2) if split[i] == lang.upper()])
+
+    # Europarl sentences
+    for lang1, lang2 in [(lang, other), (other, lang)]:
+        path = os.path.join(EUROPARL_DIR, 'europarl-v7.%s-%s.%s' % (lang1, lang2, lang))
+        if os.path.isfile(path):
+            with io.open(path, 'r', encoding='utf-8') as f:
+                for i, line in enumerate(f):
+                    if i >= EUROPARL_N_MAX:
+                        break
+                    words.update(line.lower().split())
+            break
+
+    return words
+
+
+def frequent_rank(params):
+    """
+    Number of most frequent words used by training: discriminator inputs,
+    refinement dictionaries and the mean cosine criterion. -1 if training
+    can use any word.
+    """
+    rank = 0
+    if hasattr(params, 'dico_max_rank'):
+        if (params.dico_max_rank == 0 or getattr(params, 'dico_train', '') == 'identical_char' or
+                params.dico_method.startswith('invsm_beta_')):
+            return -1
+        rank = max(params.dico_max_rank, DIST_MEAN_COSINE_RANK)
+    if hasattr(params, 'dis_most_frequent') and getattr(params, 'adversarial', True):
+        if params.dis_most_frequent == 0:
+            return -1
+        rank = max(rank, params.dis_most_frequent)
+    return rank
+
+
+def load_restricted_embeddings(params, source):
+    """
+    Load the embeddings of the words used by training and evaluation only.
+    Rows keep the order of the file, so the most frequent words keep their
+    IDs: word `i` is row `params.src_rows[i]` (`params.tgt_rows[i]`) of the file.
+    """
+    lang = params.src_lang if source else params.tgt_lang
+    emb_path = params.src_emb if source else params.tgt_emb
+    rank = frequent_rank(params)
+    if rank < 0:
+        logger.info('Training uses all the %s words: not restricting the vocabulary' % lang)
+        return load_external_embeddings(params, source)
+
+    tic = time.time()
+    index = EmbeddingFileIndex(emb_path)
+    assert index.dim == params.emb_dim
+    n_words = len(index) if params.max_vocab <= 0 else min(len(index), params.max_vocab)
+    words = required_words(params, source)
+    ids = np.array([index.dico.find(w) for w in words], dtype=np.int64)
+    ids = ids[(ids >= 0) & (ids < n_words)]
+    rows = np.union1d(np.arange(min(rank, n_words), dtype=np.int64), ids)
+
+    dico = CompactDictionary.from_words([index.dico[int(i)] for i in rows], lang, check=True)
+    embeddings = torch.from_numpy(index.read_rows(rows))
+    embeddings = embeddings.cuda() if params.cuda else embeddings
+    setattr(params, 'src_rows' if source else 'tgt_rows', rows)
+    logger.info('Loaded %i / %i %s embeddings (%i most frequent + %i dictionary / evaluation words) in %.2fs'
+                % (len(rows), n_words, lang, min(rank, n_words), len(rows) - min(rank, n_words), time.time() - tic))
+    return dico, embeddings
+
+
+def load_embeddings(params, source):
+    """
+    Load the source / target embeddings, restricted to the words used by
+    training and evaluation with --restrict_vocab.
+    """
+    if getattr(params, 'restrict_vocab', False):
+        return load_restricted_embeddings(params, source)
+    return load_external_embeddings(params, source)
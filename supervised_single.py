@@ -10,10 +10,13 @@ import argparse
 from collections import OrderedDict
 import torch
 
-from src.utils import bool_flag, initialize_exp
+from src.utils import bool_flag, initialize_exp, EMB_DTYPES
+from src.autotune import initialize_autotuner
 from src.models import build_model
 from src.trainer import Trainer
+from src.procrustes import refinement_converged
 from src.evaluation import Evaluator
+from src.distributed import init_distributed
 
 
 VALIDATION_METRIC = 'mean_cosine-csls_knn_10-S2T-10000'
@@ -26,6 +29,7 @@ parser.add_argument("--verbose", type=int, default=2, help="Verbose level (2:deb
 parser.add_argument("--exp_path", type=str, default="", help="Where to store experiment logs and models")
 parser.add_argument("--cuda", type=bool_flag, default=True, help="Run on GPU")
 parser.add_argument("--export", type=bool_flag, default=True, help="Export embeddings after training")
+parser.add_argument("--export_format", type=str, default="txt", help="Export format (txt: text files of the vectors, store: mapped stores referencing the embedding files)")
 # data
 parser.add_argument("--src_lang", type=str, default='en', help="Source language")
 parser.add_argument("--tgt_lang", type=str, default='es', help="Target language")
@@ -33,6 +37,8 @@ parser.add_argument("--emb_dim", type=int, default=300, help="Embedding dimensio
 parser.add_argument("--max_vocab", type=int, default=200000, help="Maximum vocabulary size")
 # training refinement
 parser.add_argument("--n_iters", type=int, default=5, help="Number of iterations")
+parser.add_argument("--refine_min_overlap", type=float, default=1, help="Stop the refinement once the dictionary overlap with the previous iteration is above this value")
+parser.add_argument("--refine_max_delta", type=float, default=0, help="and the relative change of the mapping below this one (by default: once the dictionary is unchanged)")
 # dictionary creation parameters (for refinement)
 parser.add_argument("--dico_train", type=str, default="default", help="Path to training dictionary (default: use identical character strings)")
 parser.add_argument("--dico_method", type=str, default='csls_knn_10', help="Method used for dictionary generation (nn/invsm_beta_30/csls_knn_10)")
@@ -41,10 +47,20 @@ parser.add_argument("--dico_threshold", type=float, default=0, help="Threshold c
 parser.add_argument("--dico_max_rank", type=int, default=10000, help="Maximum dictionary words rank (0 to disable)")
 parser.add_argument("--dico_min_size", type=int, default=0, help="Minimum generated dictionary size (0 to disable)")
 parser.add_argument("--dico_max_size", type=int, default=0, help="Maximum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_index", type=str, default="", help="Approximate candidates search with a PQ index, e.g. pq,code_size=50,n_lists=1024,nprobe=16,shortlist=100 (empty for exact search)")
+parser.add_argument("--autotune", type=bool_flag, default=True, help="Benchmark the block sizes of the similarity kernels on first use (cached per machine and shape)")
+parser.add_argument("--autotune_memory", type=int, default=1024, help="Memory budget of a block of similarity scores, in MB")
+parser.add_argument("--autotune_cache", type=str, default="", help="Block sizes cache file (default: ~/.cache/unsupervised_word_mapping/block_sizes.json)")
 # reload pre-trained embeddings
 parser.add_argument("--src_emb", type=str, default='', help="Reload source embeddings")
 parser.add_argument("--tgt_emb", type=str, default='', help="Reload target embeddings")
 parser.add_argument("--normalize_embeddings", type=str, default="", help="Normalize embeddings before training")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+parser.add_argument("--restrict_vocab", type=bool_flag, default=False, help="Only load the most frequent words used for training, and the words of the training / evaluation dictionaries (evaluations then search among these words)")
+# distributed dictionary induction (every process scores a shard of the target words)
+parser.add_argument("--world_size", type=int, default=1, help="Number of processes (gloo backend)")
+parser.add_argument("--rank", type=int, default=0, help="Rank of this process")
+parser.add_argument("--dist_url", type=str, default="", help="Rendez-vous of the processes (tcp://host:port or file:///shared/path)")
 
 
 # parse parameters
@@ -52,15 +68,23 @@ params = parser.parse_args()
 
 # check parameters
 assert not params.cuda or torch.cuda.is_available()
+assert params.export_format in ["txt", "store"]
+assert params.dico_index == "" or params.dico_index.split(",")[0] == "pq"
+assert params.autotune_memory > 0
+assert params.dico_index == "" or params.world_size == 1
+assert params.emb_dtype in EMB_DTYPES
 assert params.dico_train in ["identical_char", "default"] or os.path.isfile(params.dico_train)
 assert params.dico_build in ["S2T", "T2S", "S2T|T2S", "S2T&T2S"]
 assert params.dico_max_size == 0 or params.dico_max_size < params.dico_max_rank
 assert params.dico_max_size == 0 or params.dico_max_size > params.dico_min_size
 assert os.path.isfile(params.src_emb)
 assert os.path.isfile(params.tgt_emb)
+assert params.world_size == 1 or params.dist_url and 0 <= params.rank < params.world_size
 
 # build logger / model / trainer / evaluator
+init_distributed(params)
 logger = initialize_exp(params)
+initialize_autotuner(params)
 src_emb, tgt_emb, mapping, _ = build_model(params, False)
 trainer = Trainer(src_emb, tgt_emb, mapping, None, params)
 evaluator = Evaluator(trainer)
@@ -82,10 +106,11 @@ for n_iter in range(params.n_iters):
         trainer.build_dictionary()
 
     # apply the Procrustes solution
-    trainer.procrustes()
+    stats = trainer.procrustes()
 
     # embeddings evaluation
     to_log = OrderedDict({'n_iter': n_iter})
+    to_log.update(('refine_%s' % k, v) for k, v in stats.items())
     evaluator.all_eval(to_log)
 
     # JSON log / save best model / end of epoch
@@ -93,6 +118,10 @@ for n_iter in range(params.n_iters):
     trainer.save_best(to_log, VALIDATION_METRIC)
     logger.info('End of refinement iteration %i.\n\n' % n_iter)
 
+    if refinement_converged(stats, params):
+        logger.info('The refinement dictionary / mapping converged. BREAK.')
+        break
+
 
 # export embeddings to a text format
 if params.export:
@@ -0,0 +1,291 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# python sweep.py --grid "lambda_a+lambda_b=1,5,10,20,100" --n_workers 5 --threads_per_run 4 --src_emb data/pretrained/en.vec --tgt_emb data/pretrained/it.vec --refinement True
+
+import os
+import time
+import json
+import argparse
+import itertools
+from collections import OrderedDict
+from copy import deepcopy
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from src.utils import bool_flag, initialize_exp, load_external_embeddings, normalize_embeddings, cast_embeddings, EMB_DTYPES
+from src.logger import create_logger
+from src.models import build_model_cycle
+from src.trainer_Cycle import Trainer_Cycle
+from src.procrustes import refinement_converged
+from src.evaluation import Evaluator_Cycle, load_europarl_data
+
+VALIDATION_METRIC = 'mean_cosine-csls_knn_10-S2T-10000'
+
+
+# main
+
+parser = argparse.ArgumentParser(description='Unsupervised training hyperparameter sweep')
+parser.add_argument("--seed", type=int, default=-1, help="Initialization seed")
+parser.add_argument("--verbose", type=int, default=2, help="Verbose level (2:debug, 1:info, 0:warning)")
+parser.add_argument("--exp_path", type=str, default="", help="Where to store experiment logs and models")
+parser.add_argument("--cuda", type=bool_flag, default=False, help="Run on GPU")
+parser.add_argument("--export", type=bool_flag, default=True, help="Export embeddings after training")
+# data
+parser.add_argument("--src_lang", type=str, default='en', help="Source language")
+parser.add_argument("--tgt_lang", type=str, default='it', help="Target language")
+parser.add_argument("--emb_dim", type=int, default=300, help="Embedding dimension")
+parser.add_argument("--max_vocab", type=int, default=200000, help="Maximum vocabulary size")
+# mapping if beta is zero, there is no orthogonalization
+parser.add_argument("--map_id_init", type=bool_flag, default=True, help="Initialize the mapping as an identity matrix")
+parser.add_argument("--map_beta", type=float, default=0.001, help="Beta for orthogonalization")
+#Cycle consistency
+parser.add_argument("--lambda_a", type=int, default=10, help="Cycle consistency loss feedback coefficient from src to src")
+parser.add_argument("--lambda_b", type=int, default=10, help="Cycle consistency loss feedback coefficient from tgt to tgt")
+parser.add_argument("--cc_method", type=str, default='default', help="The method to calculate cycle consistency")
+# discriminator
+parser.add_argument("--dis_layers", type=int, default=2, help="Discriminator layers")
+parser.add_argument("--dis_hid_dim", type=int, default=2048, help="Discriminator hidden layer dimensions")
+parser.add_argument("--dis_dropout", type=float, default=0., help="Discriminator dropout")
+parser.add_argument("--dis_input_dropout", type=float, default=0.1, help="Discriminator input dropout")
+parser.add_argument("--dis_steps", type=int, default=5, help="Discriminator steps")
+parser.add_argument("--dis_lambda", type=float, default=1, help="Discriminator loss feedback coefficient")
+parser.add_argument("--dis_most_frequent", type=int, default=75000, help="Select embeddings of the k most frequent words for discrimination (0 to disable)")
+parser.add_argument("--dis_smooth", type=float, default=0.1, help="Discriminator smooth predictions")
+parser.add_argument("--dis_clip_weights", type=float, default=0, help="Clip discriminator weights (0 to disable)")
+# training adversarial
+parser.add_argument("--adversarial", type=bool_flag, default=True, help="Use adversarial training")
+parser.add_argument("--n_epochs", type=int, default=5, help="Number of epochs")
+parser.add_argument("--epoch_size", type=int, default=1000000, help="Iterations per epoch")
+parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+parser.add_argument("--map_optimizer", type=str, default="sgd,lr=0.1", help="Mapping optimizer")
+parser.add_argument("--dis_optimizer", type=str, default="sgd,lr=0.1", help="Discriminator optimizer")
+parser.add_argument("--lr_decay", type=float, default=0.98, help="Learning rate decay (SGD only)")
+parser.add_argument("--min_lr", type=float, default=1e-6, help="Minimum learning rate (SGD only)")
+parser.add_argument("--lr_shrink", type=float, default=0.5, help="Shrink the learning rate if the validation metric decreases (1 to disable)")
+# training refinement
+parser.add_argument("--refinement", type=bool_flag, default=False, help="Use iterative Procrustes refinement")
+parser.add_argument("--n_iters", type=int, default=5, help="Number of iterations")
+parser.add_argument("--refine_min_overlap", type=float, default=1, help="Stop the refinement once the dictionary overlap with the previous iteration is above this value")
+parser.add_argument("--refine_max_delta", type=float, default=0, help="and the relative change of the mapping below this one (by default: once the dictionary is unchanged)")
+# dictionary creation parameters (for refinement)
+parser.add_argument("--dico_method", type=str, default='csls_knn_10', help="Method used for dictionary generation (nn/invsm_beta_30/csls_knn_10)")
+parser.add_argument("--dico_build", type=str, default='S2T&T2S', help="S2T,T2S,S2T|T2S,S2T&T2S")
+parser.add_argument("--dico_threshold", type=float, default=0, help="Threshold confidence for dictionary generation")
+parser.add_argument("--dico_max_rank", type=int, default=15000, help="Maximum dictionary words rank (0 to disable)")
+parser.add_argument("--dico_min_size", type=int, default=0, help="Minimum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_max_size", type=int, default=0, help="Maximum generated dictionary size (0 to disable)")
+# reload pre-trained embeddings
+parser.add_argument("--src_emb", type=str, default="", help="Reload source embeddings")
+parser.add_argument("--tgt_emb", type=str, default="", help="Reload target embeddings")
+parser.add_argument("--normalize_embeddings", type=str, default="", help="Normalize embeddings before training")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+# quick test
+parser.add_argument("--quick_test", type=bool_flag, default=False, help="USE quick test")
+
+
+# sweep
+parser.add_argument("--grid", type=str, default="", help="Grid of configurations, e.g. \"lambda_a+lambda_b=1,5,10;epoch_size=500000,1000000\" (keys joined by + share a value)")
+parser.add_argument("--configs", type=str, default="", help="JSON file with a list of configurations (dicts of overridden parameters)")
+parser.add_argument("--n_workers", type=int, default=2, help="Number of runs trained in parallel")
+parser.add_argument("--threads_per_run", type=int, default=4, help="CPU threads of each run")
+
+
+# shared between the worker processes (set before forking them)
+SHARED = {}
+
+
+def parse_configs(params):
+    """
+    Expand the --grid / --configs arguments into a list of parameter overrides.
+    """
+    types = dict((action.dest, action.type) for action in parser._actions)
+    configs = []
+    if params.configs:
+        configs += json.load(open(params.configs))
+    if params.grid:
+        axes = []
+        for axis in params.grid.split(';'):
+            keys, values = axis.split('=')
+            keys = keys.split('+')
+            for k in keys:
+                assert k in types, 'Unknown parameter "%s"' % k
+            axes.append([dict((k, types[k](v) if types[k] is not None else v) for k in keys)
+                         for v in values.split(',')])
+        for point in itertools.product(*axes):
+            config = {}
+            for overrides in point:
+                config.update(overrides)
+            configs.append(config)
+    assert len(configs) > 0, "empty sweep"
+    return configs
+
+
+def load_shared_embeddings(params):
+    """
+    Load and normalize both embedding tables once, in shared memory
+    (stored in `params.emb_dtype`).
+    """
+    _params = deepcopy(params)
+    _params.cuda = False
+    src_dico, src_emb = load_external_embeddings(_params, source=True)
+    tgt_dico, tgt_emb = load_external_embeddings(_params, source=False)
+    normalize_embeddings(src_emb, params.normalize_embeddings)
+    normalize_embeddings(tgt_emb, params.normalize_embeddings)
+    src_emb = cast_embeddings(src_emb, params.emb_dtype)
+    tgt_emb = cast_embeddings(tgt_emb, params.emb_dtype)
+    return src_dico, src_emb.share_memory_(), tgt_dico, tgt_emb.share_memory_()
+
+
+def evaluate(evaluator, to_log, params):
+    evaluator.word_translation(to_log)
+    evaluator.dist_mean_cosine(to_log)
+    if not params.quick_test:
+        evaluator.all_eval(to_log)
+        evaluator.eval_dis(to_log)
+
+
+def run_config(run_id):
+    """
+    Train and evaluate one configuration of the sweep, in a worker process.
+    """
+    params = deepcopy(SHARED['params'])
+    config = SHARED['configs'][run_id]
+    for k, v in config.items():
+        setattr(params, k, v)
+    params.seed = SHARED['seeds'][run_id]
+    params.exp_path = os.path.join(SHARED['params'].exp_path, 'run_%03i' % run_id)
+    if not os.path.isdir(params.exp_path):
+        os.makedirs(params.exp_path)
+    torch.set_num_threads(params.threads_per_run)
+    logger = initialize_exp(params)
+    logger.info('Sweep run %i: %s' % (run_id, json.dumps(config)))
+
+    params1 = params
+    params2 = deepcopy(params1)
+    params2.src_emb, params2.tgt_emb = params1.tgt_emb, params1.src_emb
+    params2.src_lang, params2.tgt_lang = params1.tgt_lang, params1.src_lang
+
+    models = build_model_cycle(params, True, True, shared_embeddings=SHARED['embeddings'])
+    trainer = Trainer_Cycle(*(models + (params,)))
+    evaluator1 = Evaluator_Cycle(trainer, params1, True)
+    evaluator2 = Evaluator_Cycle(trainer, params2, False)
+    if SHARED['europarl'] is not None:
+        evaluator1.europarl_data = SHARED['europarl']
+        evaluator2.europarl_data = SHARED['europarl']
+
+    # adversarial training
+    if params.adversarial:
+        for n_epoch in range(params.n_epochs):
+            logger.info('Starting adversarial training epoch %i...' % n_epoch)
+            tic = time.time()
+            stats = {'DIS_A_COSTS': [], 'DIS_B_COSTS': [], 'GAN_A_COSTS': [], 'GAN_B_COSTS': [], 'CYC_A_COSTS': [], 'CYC_B_COSTS': []}
+            for n_iter in range(0, params.epoch_size, params.batch_size):
+                for _ in range(params.dis_steps):
+                    trainer.dis_step(stats, False)
+                    trainer.dis_step(stats, True)
+                trainer.mapping_step(stats, False)
+                trainer.mapping_step(stats, True)
+            logger.info('%i samples/s' % int(2 * params.epoch_size / (time.time() - tic)))
+
+            to_log1 = OrderedDict({'n_epoch': n_epoch})
+            to_log2 = OrderedDict({'n_epoch': n_epoch})
+            evaluate(evaluator1, to_log1, params)
+            evaluate(evaluator2, to_log2, params)
+            logger.info("__log__:%s" % json.dumps(to_log1))
+            logger.info("__log__:%s" % json.dumps(to_log2))
+            trainer.save_best(to_log1, VALIDATION_METRIC)
+            logger.info('End of epoch %i.\n\n' % n_epoch)
+
+            trainer.update_lr(to_log1, VALIDATION_METRIC)
+            if min(trainer.map_optimizer(True).param_groups[0]['lr'],
+                   trainer.map_optimizer(False).param_groups[0]['lr']) < params.min_lr:
+                logger.info('Learning rate < 1e-6. BREAK.')
+                break
+
+    # iterative Procrustes refinement
+    if params.refinement:
+        trainer.reload_best()
+        for n_iter in range(params.n_iters):
+            logger.info('Starting refinement iteration %i...' % n_iter)
+            trainer.build_dictionary(True)
+            stats1 = trainer.procrustes(True)
+            trainer.build_dictionary(False)
+            stats2 = trainer.procrustes(False)
+            to_log1 = OrderedDict({'n_iter': n_iter})
+            to_log1.update(('refine_%s' % k, v) for k, v in stats1.items())
+            evaluator1.dist_mean_cosine(to_log1)
+            logger.info("__log__:%s" % json.dumps(to_log1))
+            trainer.save_best(to_log1, VALIDATION_METRIC)
+            if refinement_converged(stats1, params) and refinement_converged(stats2, params):
+                logger.info('The refinement dictionary / mapping converged. BREAK.')
+                break
+
+    # evaluate the best model of the run
+    trainer.reload_best()
+    to_log1 = OrderedDict()
+    to_log2 = OrderedDict()
+    evaluate(evaluator1, to_log1, params)
+    evaluate(evaluator2, to_log2, params)
+    logger.info("__log__:%s" % json.dumps(to_log1))
+    logger.info("__log__:%s" % json.dumps(to_log2))
+
+    results = OrderedDict([('run', run_id), ('exp_path', params.exp_path)])
+    results.update(sorted(config.items()))
+    for suffix, to_log in [('_t', to_log1), ('_f', to_log2)]:
+        results.update((k + suffix, v) for k, v in to_log.items()
+                       if k.startswith('precision_at_') or k.startswith('mean_cosine'))
+    return results
+
+
+if __name__ == '__main__':
+
+    # parse parameters
+    params = parser.parse_args()
+
+    # check parameters
+    assert not params.cuda or torch.cuda.is_available()
+    assert params.emb_dtype in EMB_DTYPES
+    assert 0 <= params.dis_dropout < 1
+    assert 0 <= params.dis_input_dropout < 1
+    assert 0 <= params.dis_smooth < 0.5
+    assert params.dis_lambda > 0 and params.dis_steps > 0
+    assert 0 < params.lr_shrink <= 1
+    assert params.n_workers > 0 and params.threads_per_run > 0
+    assert os.path.isfile(params.src_emb)
+    assert os.path.isfile(params.tgt_emb)
+    configs = parse_configs(params)
+
+    # load embeddings / evaluation data once for all the runs
+    logger = initialize_exp(params)
+    logger.info('Sweep over %i configurations: %s' % (len(configs), json.dumps(configs)))
+    SHARED['params'] = params
+    SHARED['configs'] = configs
+    SHARED['seeds'] = [params.seed if params.seed >= 0 else np.random.randint(1 << 31) for _ in configs]
+    SHARED['embeddings'] = load_shared_embeddings(params)
+    SHARED['europarl'] = None if params.quick_test else load_europarl_data(
+        params.src_lang, params.tgt_lang, n_max=(200000 + 2 * 300000)
+    )
+
+    # train the runs in parallel worker processes (forked, so they share the data above)
+    pool = mp.Pool(processes=min(params.n_workers, len(configs)), maxtasksperchild=1)
+    results = pool.map(run_config, range(len(configs)), chunksize=1)
+    pool.close()
+    pool.join()
+
+    # results table
+    logger = create_logger(os.path.join(params.exp_path, 'train.log'), vb=params.verbose)
+    columns = []
+    for res in results:
+        columns += [k for k in res if k not in columns]
+    path = os.path.join(params.exp_path, 'results.tsv')
+    with open(path, 'w') as f:
+        f.write('\t'.join(columns) + '\n')
+        for res in results:
+            f.write('\t'.join(str(res.get(k, '')) for k in columns) + '\n')
+    logger.info('Sweep results written to %s' % path)
+    logger.info('\n' + open(path).read())
@@ -9,7 +9,6 @@ import time
 import tensorflow as tf
 
 import data_loader, losses, model
-from sklearn.neighbors import NearestNeighbors
 
 slim = tf.contrib.slim
 
@@ -226,15 +225,23 @@ class CycleGAN:
             # coord = tf.train.Coordinator()
             # threads = tf.train.start_queue_runners(coord=coord)
 
+            # the test set never changes: load it and index the real
+            # words of both languages once for the whole run
+            test_data = np.load(self._test_dataset_name)
+            index_a = CosineIndex(test_data[:, 0])
+            index_b = CosineIndex(test_data[:, 1])
+
             def do_test():
-                my_data_loader = data_loader.DataLoaderDisk_bi(self._test_dataset_name,BATCH_SIZE,False)
-                max_word = my_data_loader.num
+                max_word = test_data.shape[0]
                 print('Total test sample number',max_word)
-                its = max_word//BATCH_SIZE+1
 
-                reslist= np.zeros([its*BATCH_SIZE,6,model.WORD_EMBED_DIM])
-                for i in range(its):
-                    input_a,input_b=my_data_loader.next_batch()
+                fake_a = np.zeros([max_word, model.WORD_EMBED_DIM], dtype=np.float32)
+                fake_b = np.zeros([max_word, model.WORD_EMBED_DIM], dtype=np.float32)
+                cyc_a = np.zeros([max_word, model.WORD_EMBED_DIM], dtype=np.float32)
+                cyc_b = np.zeros([max_word, model.WORD_EMBED_DIM], dtype=np.float32)
+                for i in range(0, max_word, BATCH_SIZE):
+                    input_a = test_data[i:i + BATCH_SIZE, 0]
+                    input_b = test_data[i:i + BATCH_SIZE, 1]
                     fake_A_temp, fake_B_temp, cyc_A_temp, cyc_B_temp = sess.run([
                         self.fake_word_a,
                         self.fake_word_b,
@@ -245,28 +252,22 @@ class CycleGAN:
                         self.input_b: input_b
                     })
 
-                    reslist[BATCH_SIZE*i:BATCH_SIZE*(i+1),0,:]=input_a
-                    reslist[BATCH_SIZE*i:BATCH_SIZE*(i+1),1,:]=input_b
-                    reslist[BATCH_SIZE*i:BATCH_SIZE*(i+1),2,:]=fake_A_temp
-                    reslist[BATCH_SIZE*i:BATCH_SIZE*(i+1),3,:]=fake_B_temp
-                    reslist[BATCH_SIZE*i:BATCH_SIZE*(i+1),4,:]=cyc_A_temp
-                    reslist[BATCH_SIZE*i:BATCH_SIZE*(i+1),5,:]=cyc_B_temp
-                    
-                reslist=reslist[:max_word,:,:]
+                    fake_a[i:i + BATCH_SIZE] = fake_A_temp
+                    fake_b[i:i + BATCH_SIZE] = fake_B_temp
+                    cyc_a[i:i + BATCH_SIZE] = cyc_A_temp
+                    cyc_b[i:i + BATCH_SIZE] = cyc_B_temp
 
                 print ('Test accruacy')
-                print ('top1',evaluation(reslist[:,2],reslist[:,0],n_neighbors=1))
-                print ('top5',evaluation(reslist[:,2],reslist[:,0],n_neighbors=5))
-                print ('top1',evaluation(reslist[:,3],reslist[:,1],n_neighbors=1))
-                print ('top5',evaluation(reslist[:,3],reslist[:,1],n_neighbors=5))
-                print ('top1',evaluation(reslist[:,4],reslist[:,0],n_neighbors=1))
-                print ('top5',evaluation(reslist[:,4],reslist[:,0],n_neighbors=5))
-                print ('top1',evaluation(reslist[:,5],reslist[:,1],n_neighbors=1))
-                print ('top5',evaluation(reslist[:,5],reslist[:,1],n_neighbors=5))
+                evaluation(index_a, fake_a, 'fake_a')
+                evaluation(index_b, fake_b, 'fake_b')
+                evaluation(index_a, cyc_a, 'cycle_a')
+                evaluation(index_b, cyc_b, 'cycle_b')
 
             if self._do_train:
                 # Load Dataset from the dataset folder
-                my_data_loader=data_loader.DataLoaderDisk_bi(self._train_dataset_name,BATCH_SIZE,True)
+                # batches are shuffled and prefetched by a background thread
+                # while the session runs
+                my_data_loader=data_loader.DataLoaderDisk_bi(self._train_dataset_name,BATCH_SIZE,True,prefetch=8)
                 max_word = my_data_loader.num
                 its = max_word//BATCH_SIZE+1
 
@@ -379,6 +380,8 @@ class CycleGAN:
                     if self._do_test:
                         do_test()
 
+                my_data_loader.close()
+
             if self._do_test:
                 do_test()
             
@@ -386,15 +389,55 @@ class CycleGAN:
             # coord.join(threads)
             writer.add_graph(sess.graph)
 
-def evaluation(predict,real,n_neighbors=1):
-    predict=np.array(predict)
-    real=np.array(real)
-    model=NearestNeighbors(n_neighbors=n_neighbors)
-    model.fit(real)
-    output=model.kneighbors(predict, return_distance=False) 
-    realmap=np.arange(0,predict.shape[0],1)
-    total_acc=0.
-    for i in range(predict.shape[0]):
-        if realmap[i] in output[i]:
-            total_acc+=1.
-    return total_acc/predict.shape[0]
+class CosineIndex(object):
+    """
+    Cosine nearest neighbor index over a fixed set of word vectors.
+
+    The vectors are normalized once; queries are answered in blocks with a
+    single matrix product per block followed by a partial sort.
+    """
+
+    def __init__(self, vectors, block_size=1024):
+        self.vectors = normalized(vectors)
+        self.block_size = block_size
+
+    def search(self, queries, k):
+        """
+        Return the indices of the `k` most similar vectors for each query,
+        sorted by decreasing cosine similarity.
+        """
+        queries = normalized(queries)
+        k = min(k, self.vectors.shape[0])
+        top = np.zeros([queries.shape[0], k], dtype=np.int64)
+        for i in range(0, queries.shape[0], self.block_size):
+            scores = queries[i:i + self.block_size].dot(self.vectors.T)
+            rows = np.arange(scores.shape[0])[:, None]
+            best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            order = np.argsort(-scores[rows, best], axis=1)
+            top[i:i + self.block_size] = best[rows, order]
+        return top
+
+    def precision_at_k(self, queries, ks=(1, 5, 10)):
+        """
+        Precision@k of retrieving, for query i, the indexed vector i.
+        """
+        top = self.search(queries, max(ks))
+        hits = top == np.arange(queries.shape[0])[:, None]
+        return [(k, 100 * hits[:, :k].any(1).mean()) for k in ks]
+
+
+def normalized(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def evaluation(index, predict, name):
+    """
+    Log the precision@1/5/10 of the generated words against the real ones.
+    """
+    results = index.precision_at_k(predict)
+    for k, precision_at_k in results:
+        print("%i source words - %s - Precision at k = %i: %f" % (predict.shape[0], name, k, precision_at_k))
+    return results
@@ -1,60 +1,104 @@
 from __future__ import print_function
 import os
 import os.path as osp
+import threading
 import numpy as np
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+def load_dataset(dataset):
+    """
+    Return `dataset` as an array, memory-mapping it if it is the path of a .npy file.
+    """
+    if isinstance(dataset, str):
+        return np.load(dataset, mmap_mode='r')
+    return dataset
+
 
 class DataLoaderDisk_bi(object):
-    def __init__(self, dataset_name, batch_size, do_shuffle=True):
-        self.dataset = np.load(dataset_name)
+    def __init__(self, dataset_name, batch_size, do_shuffle=True, prefetch=4):
+        # (n, 2, dim) pairs are gathered together so that shuffling keeps them aligned
+        self.dataset = load_dataset(dataset_name)
         self.batch_size=batch_size
-        self.loader_a = DataLoaderDisk_mo(self.dataset[:,0],batch_size,do_shuffle)
-        self.loader_b = DataLoaderDisk_mo(self.dataset[:,1],batch_size,do_shuffle)
-        self.num = min(self.loader_a.num,self.loader_b.num)
+        self.loader = DataLoaderDisk_mo(self.dataset,batch_size,do_shuffle,prefetch)
+        self.num = self.loader.num
     def next_batch(self):
-        return self.loader_a.next_batch(),self.loader_b.next_batch()
+        data = self.loader.next_batch()
+        return data[:,0],data[:,1]
+    def close(self):
+        self.loader.close()
 
 class DataLoaderDisk_mo(object):
 
-    def __init__(self, dataset, batch_size, do_shuffle=True):
+    def __init__(self, dataset, batch_size, do_shuffle=True, prefetch=4):
 
-        self.dataset = dataset 
-        self.num = dataset.shape[0]
+        self.dataset = load_dataset(dataset)
+        self.num = self.dataset.shape[0]
         self.batch_size=batch_size
+        assert self.num >= batch_size
 
         # create self.order which is the order to generate batch
         self.perm = do_shuffle
         self.permutation()
         self._idx = 0
 
+        # batches are gathered into a ring of preallocated buffers: one held by
+        # the caller, `prefetch` waiting in the queue and one being filled
+        self.prefetch = prefetch
+        self._buffers = np.empty((prefetch + 2, batch_size) + self.dataset.shape[1:], dtype=self.dataset.dtype)
+        self._queue = queue.Queue(maxsize=max(prefetch, 1))
+        self._stop = threading.Event()
+        self._thread = None
+        if prefetch > 0:
+            self._thread = threading.Thread(target=self._prefetch_batches)
+            self._thread.daemon = True
+            self._thread.start()
+
     def next_batch(self):
         """
-        Create the next batch
-        Input:
-            batch_size: int; the batch size to generate
+        Return the next batch
         Return:
-            images_batch: np4darray (batch_size, fine_size, fine_size, 3); the image batch
-            seg_labels_batch: np3darray (batch_size, fine_size, fine_size); the seg label batch
-            labels_batch: np1darray (batch_size,); the label batch
+            data: np array (batch_size, ...); the next batch of the permuted dataset.
+            The array is a reused buffer, only valid until the next call.
         """
+        if self._thread is None:
+            self._gather(self._buffers[0])
+            return self._buffers[0]
+        return self._queue.get()
 
-        if self._idx+self.batch_size>=self.num:
+    def _gather(self, out):
+        if self._idx+self.batch_size>self.num:
             self._idx = 0
             self.permutation()
-
-        if self.batch_size==1:
-            data = self.dataset[self._idx]
-            newshape=[1]
-            newshape.extend(data.shape)
-            data = data.reshape(newshape)
-        else:
-            data = self.dataset[self._idx:self._idx+self.batch_size]
+        np.take(self.dataset, self.order[self._idx:self._idx+self.batch_size], axis=0, out=out, mode='clip')
         self._idx += self.batch_size
-        return data
+
+    def _prefetch_batches(self):
+        i = 0
+        while not self._stop.is_set():
+            out = self._buffers[i % len(self._buffers)]
+            self._gather(out)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(out, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            i += 1
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
     def permutation(self):
         # permutation
         if self.perm:
-            self.order = np.random.permutation(self.num) 
+            self.order = np.random.permutation(self.num)
         else:
             self.order = np.arange(self.num)
         return
@@ -13,14 +13,20 @@ import numpy as np
 import torch
 from copy import deepcopy
 
-from src.utils import bool_flag, initialize_exp
+from src.utils import bool_flag, initialize_exp, EMB_DTYPES
+from src.autotune import initialize_autotuner
+from src.profiler import profiler, initialize_profiler
+from src.metrics import MetricsWriter, METRICS_FILE
 from src.models import build_model, build_model_cycle
 from src.trainer import Trainer
 from src.trainer_Cycle import  Trainer_Cycle
+from src.procrustes import refinement_converged
+from src.hogwild import share_trainer, hogwild_epoch
 from src.evaluation import Evaluator
 from src.evaluation import Evaluator_Cycle
 
 VALIDATION_METRIC = 'mean_cosine-csls_knn_10-S2T-10000'
+PROXY_METRIC = 'proxy_mean_cosine'
 
 
 # main
@@ -30,6 +36,7 @@ parser.add_argument("--verbose", type=int, default=2, help="Verbose level (2:deb
 parser.add_argument("--exp_path", type=str, default="", help="Where to store experiment logs and models")
 parser.add_argument("--cuda", type=bool_flag, default=True, help="Run on GPU")
 parser.add_argument("--export", type=bool_flag, default=True, help="Export embeddings after training")
+parser.add_argument("--export_format", type=str, default="txt", help="Export format (txt: text files of the vectors, store: mapped stores referencing the embedding files)")
 # data
 parser.add_argument("--src_lang", type=str, default='en', help="Source language")
 parser.add_argument("--tgt_lang", type=str, default='it', help="Target language")
@@ -52,19 +59,26 @@ parser.add_argument("--dis_lambda", type=float, default=1, help="Discriminator l
 parser.add_argument("--dis_most_frequent", type=int, default=75000, help="Select embeddings of the k most frequent words for discrimination (0 to disable)")
 parser.add_argument("--dis_smooth", type=float, default=0.1, help="Discriminator smooth predictions")
 parser.add_argument("--dis_clip_weights", type=float, default=0, help="Clip discriminator weights (0 to disable)")
+parser.add_argument("--dis_eval_size", type=int, default=0, help="Words per language sampled to log the discriminator accuracy with the training stats (0 to disable)")
 # training adversarial
 parser.add_argument("--adversarial", type=bool_flag, default=True, help="Use adversarial training")
 parser.add_argument("--n_epochs", type=int, default=5, help="Number of epochs")
 parser.add_argument("--epoch_size", type=int, default=1000000, help="Iterations per epoch")
 parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+parser.add_argument("--n_workers", type=int, default=1, help="Hogwild worker processes sharing the model (CPU only)")
 parser.add_argument("--map_optimizer", type=str, default="sgd,lr=0.1", help="Mapping optimizer")
 parser.add_argument("--dis_optimizer", type=str, default="sgd,lr=0.1", help="Discriminator optimizer")
 parser.add_argument("--lr_decay", type=float, default=0.98, help="Learning rate decay (SGD only)")
 parser.add_argument("--min_lr", type=float, default=1e-6, help="Minimum learning rate (SGD only)")
 parser.add_argument("--lr_shrink", type=float, default=0.5, help="Shrink the learning rate if the validation metric decreases (1 to disable)")
+parser.add_argument("--proxy_freq", type=int, default=0, help="Evaluate a cheap mean cosine criterion every N batches, and checkpoint the best mappings (0 to disable)")
+parser.add_argument("--proxy_samples", type=int, default=1000, help="Frequent source words sampled by the cheap criterion")
+parser.add_argument("--proxy_patience", type=int, default=0, help="Stop the adversarial training after N evaluations of the cheap criterion without improvement (0 to disable)")
 # training refinement
 parser.add_argument("--refinement", type=bool_flag, default=False, help="Use iterative Procrustes refinement")
 parser.add_argument("--n_iters", type=int, default=5, help="Number of iterations")
+parser.add_argument("--refine_min_overlap", type=float, default=1, help="Stop the refinement once the dictionary overlap with the previous iteration is above this value")
+parser.add_argument("--refine_max_delta", type=float, default=0, help="and the relative change of the mapping below this one (by default: once the dictionary is unchanged)")
 # dictionary creation parameters (for refinement)
 parser.add_argument("--dico_method", type=str, default='csls_knn_10', help="Method used for dictionary generation (nn/invsm_beta_30/csls_knn_10)")
 parser.add_argument("--dico_build", type=str, default='S2T&T2S', help="S2T,T2S,S2T|T2S,S2T&T2S")
@@ -72,13 +86,24 @@ parser.add_argument("--dico_threshold", type=float, default=0, help="Threshold c
 parser.add_argument("--dico_max_rank", type=int, default=15000, help="Maximum dictionary words rank (0 to disable)")
 parser.add_argument("--dico_min_size", type=int, default=0, help="Minimum generated dictionary size (0 to disable)")
 parser.add_argument("--dico_max_size", type=int, default=0, help="Maximum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_index", type=str, default="", help="Approximate candidates search with a PQ index, e.g. pq,code_size=50,n_lists=1024,nprobe=16,shortlist=100 (empty for exact search)")
+parser.add_argument("--autotune", type=bool_flag, default=True, help="Benchmark the block sizes of the similarity kernels on first use (cached per machine and shape)")
+parser.add_argument("--autotune_memory", type=int, default=1024, help="Memory budget of a block of similarity scores, in MB")
+parser.add_argument("--autotune_cache", type=str, default="", help="Block sizes cache file (default: ~/.cache/unsupervised_word_mapping/block_sizes.json)")
 # reload pre-trained embeddings
 parser.add_argument("--src_emb", type=str, default="", help="Reload source embeddings")
 parser.add_argument("--tgt_emb", type=str, default="", help="Reload target embeddings")
 parser.add_argument("--normalize_embeddings", type=str, default="", help="Normalize embeddings before training")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+parser.add_argument("--restrict_vocab", type=bool_flag, default=False, help="Only load the most frequent words used for training, and the words of the training / evaluation dictionaries (evaluations then search among these words)")
+# profiling
+parser.add_argument("--profile", type=bool_flag, default=False, help="Log a per-epoch breakdown of the training / evaluation time")
+parser.add_argument("--profile_memory", type=bool_flag, default=False, help="Also record the peak memory of each profiled phase")
+parser.add_argument("--profile_trace", type=str, default="", help="Dump a trace of a window of iterations (cprofile:START-END or torch:START-END)")
 # quick test
 parser.add_argument("--quick_test", type=bool_flag, default=False, help="USE quick test")
 parser.add_argument("--use_dico_train", type=bool_flag, default=False, help="USE dico train")
+parser.add_argument("--tags", type=str, default="", help="Comma separated tags of the experiment, to find it in the metrics")
 
 
 # parse parameters
@@ -93,101 +118,91 @@ params2.tgt_lang = deepcopy(params1.src_lang)
 
 # check parameters
 assert not params.cuda or torch.cuda.is_available()
+assert params.export_format in ["txt", "store"]
+assert params.dico_index == "" or params.dico_index.split(",")[0] == "pq"
+assert params.autotune_memory > 0
+assert params.emb_dtype in EMB_DTYPES
 assert 0 <= params.dis_dropout < 1
 assert 0 <= params.dis_input_dropout < 1
 assert 0 <= params.dis_smooth < 0.5
+assert params.dis_eval_size >= 0
 assert params.dis_lambda > 0 and params.dis_steps > 0
 assert 0 < params.lr_shrink <= 1
+assert params.n_workers == 1 or params.n_workers > 1 and not params.cuda
+assert params.proxy_freq >= 0 and params.proxy_samples > 0 and params.proxy_patience >= 0
+assert params.proxy_freq == 0 or params.n_workers == 1
+assert params.proxy_patience == 0 or params.proxy_freq > 0
 assert os.path.isfile(params.src_emb)
 assert os.path.isfile(params.tgt_emb)
 
 # build model / trainer / evaluator
 logger = initialize_exp(params)
+initialize_autotuner(params)
+profile_path = initialize_profiler(params)
 
 src_emb, tgt_emb, mapping1, mapping2, discriminator1, discriminator2= build_model_cycle(params, True, True)
 trainer = Trainer_Cycle(src_emb, tgt_emb, mapping1, mapping2, discriminator1, discriminator2, params)
 
 evaluator1 = Evaluator_Cycle(trainer, params1, True)
 evaluator2 = Evaluator_Cycle(trainer, params2, False)
+profiler.log_epoch('setup', profile_path)
 
 expname=params.exp_path.split('/')[-1]
 figPath='./fig/'+expname
 
-plot_info=OrderedDict({
-    'expname': expname,
-
-    "iter_train":[],
-    'DIS_A_COSTS':[],
-    'DIS_B_COSTS':[],
-    'GAN_A_COSTS': [],
-    'GAN_B_COSTS':[],
-    'CYC_A_COSTS':[],
-    'CYC_B_COSTS':[],
-
-    "epoch_train":[],
-    "precision_at_1-nn_t_train":[],
-    "precision_at_5-nn_t_train":[],
-    "precision_at_10-nn_t_train":[],
-    "precision_at_1-csls_knn_10_t_train":[],
-    "precision_at_5-csls_knn_10_t_train":[],
-    "precision_at_10-csls_knn_10_t_train":[],
-
-    "precision_at_1-nn_f_train":[],
-    "precision_at_5-nn_f_train":[],
-    "precision_at_10-nn_f_train":[],
-    "precision_at_1-csls_knn_10_f_train":[],
-    "precision_at_5-csls_knn_10_f_train":[],
-    "precision_at_10-csls_knn_10_f_train":[],
-
-    "precision_at_1-nn_t_train_best":[],
-    "precision_at_5-nn_t_train_best":[],
-    "precision_at_10-nn_t_train_best":[],
-    "precision_at_1-csls_knn_10_t_train_best":[],
-    "precision_at_5-csls_knn_10_t_train_best":[],
-    "precision_at_10-csls_knn_10_t_train_best":[],
-
-    "precision_at_1-nn_f_train_best":[],
-    "precision_at_5-nn_f_train_best":[],
-    "precision_at_10-nn_f_train_best":[],
-    "precision_at_1-csls_knn_10_f_train_best":[],
-    "precision_at_5-csls_knn_10_f_train_best":[],
-    "precision_at_10-csls_knn_10_f_train_best":[],
-
-    "iter_refine":[],
-    "precision_at_1-nn_t_refine":[],
-    "precision_at_5-nn_t_refine":[],
-    "precision_at_10-nn_t_refine":[],
-    "precision_at_1-csls_knn_10_t_refine":[],
-    "precision_at_5-csls_knn_10_t_refine":[],
-    "precision_at_10-csls_knn_10_t_refine":[],
-
-    "precision_at_1-nn_f_refine":[],
-    "precision_at_5-nn_f_refine":[],
-    "precision_at_10-nn_f_refine":[],
-    "precision_at_1-csls_knn_10_f_refine":[],
-    "precision_at_5-csls_knn_10_f_refine":[],
-    "precision_at_10-csls_knn_10_f_refine":[],
-
-    "precision_at_1-nn_t_refine_best":[],
-    "precision_at_5-nn_t_refine_best":[],
-    "precision_at_10-nn_t_refine_best":[],
-    "precision_at_1-csls_knn_10_t_refine_best":[],
-    "precision_at_5-csls_knn_10_t_refine_best":[],
-    "precision_at_10-csls_knn_10_t_refine_best":[],
-
-    "precision_at_1-nn_f_refine_best":[],
-    "precision_at_5-nn_f_refine_best":[],
-    "precision_at_10-nn_f_refine_best":[],
-    "precision_at_1-csls_knn_10_f_refine_best":[],
-    "precision_at_5-csls_knn_10_f_refine_best":[],
-    "precision_at_10-csls_knn_10_f_refine_best":[],
-
-    })
-
-def update_plot_info(to_log, postfix):
-    for key in to_log:
-        if key+postfix in plot_info:
-            plot_info[key+postfix].append(to_log[key])
+# metrics stream, flushed as the training goes (see src.metrics.MetricsReader)
+metrics = MetricsWriter(os.path.join(params.exp_path, METRICS_FILE),
+                        tags=[tag for tag in params.tags.split(',') if tag], params=params)
+
+def log_metrics(stream, to_log, direction, **kwargs):
+    record = OrderedDict(to_log)
+    record.update(kwargs)
+    record['direction'] = direction
+    metrics.write(stream, record)
+
+def adversarial_step(trainer, stats):
+    """
+    One adversarial training iteration, in both directions.
+    """
+    for _ in range(params.dis_steps):
+        trainer.dis_step(stats, False)
+        trainer.dis_step(stats, True)
+    trainer.mapping_step(stats, False)
+    trainer.mapping_step(stats, True)
+    return 2 * params.batch_size
+
+def log_train_stats(n_epoch, n_iter, stats, samples_per_s):
+    stats_log = [""]
+    costs = OrderedDict({'n_iter': n_iter + params.epoch_size * n_epoch})
+    for cost in stats:
+        if len(stats[cost]) > 0:
+            stats_log.extend(['%s: %.4f' % (cost, np.mean(stats[cost]))])
+            costs[cost] = np.mean(stats[cost])
+    if params.dis_eval_size > 0:
+        for name, evaluator in [('DIS_A_ACCU', evaluator1), ('DIS_B_ACCU', evaluator2)]:
+            dis_log = {}
+            evaluator.eval_dis(dis_log, params.dis_eval_size)
+            stats_log.append('%s: %.4f' % (name, dis_log['dis_accu']))
+            costs[name] = dis_log['dis_accu']
+
+    stats_log.append('%i samples/s' % int(samples_per_s))
+    logger.info(('%06i - ' % n_iter) + ' - '.join(stats_log))
+    metrics.write('train_loss', costs)
+
+def proxy_step(n_epoch, n_iter):
+    """
+    Evaluate the cheap criterion and checkpoint the best mappings. Return
+    True once it did not improve for `proxy_patience` evaluations.
+    """
+    to_log = OrderedDict({'n_iter': n_iter + params.epoch_size * n_epoch})
+    evaluator1.proxy_mean_cosine(to_log, params.proxy_samples)
+    trainer.save_best_proxy(to_log, PROXY_METRIC)
+    log_metrics('proxy', to_log, 't')
+    return params.proxy_patience > 0 and trainer.n_proxy_bad >= params.proxy_patience
+
+# Hogwild training: the workers update the model in shared memory
+if params.n_workers > 1:
+    share_trainer(trainer)
 
 if params.quick_test:
     logger.info('\n\n----> THIS IS DEBUGGING MODE <----\n\n')
@@ -207,6 +222,7 @@ if params.adversarial:
     logger.info('\n\n----> ADVERSARIAL TRAINING <----\n\n')
 
     # training loop
+    early_stop = False
     for n_epoch in range(params.n_epochs):
 
         logger.info('Starting adversarial training epoch %i...' % n_epoch)
@@ -214,38 +230,40 @@ if params.adversarial:
         n_words_proc = 0
         stats = {'DIS_A_COSTS':[],'DIS_B_COSTS':[],'GAN_A_COSTS': [],'GAN_B_COSTS':[],'CYC_A_COSTS':[],'CYC_B_COSTS':[]}
 
-        for n_iter in range(0, params.epoch_size, params.batch_size):
-
-            # discriminator training
-            for _ in range(params.dis_steps):
-                trainer.dis_step(stats,False)
-                trainer.dis_step(stats,True)
-                
-            # mapping training (discriminator fooling)
-            trainer.mapping_step(stats,False)
-            trainer.mapping_step(stats,True)
-            
-            n_words_proc += 2*params.batch_size
-
-            # log stats
-            if n_iter % (params.epoch_size/params.batch_size/20*params.batch_size) == 0:
-                stats_log=[""]
-                for cost in stats:
-                    if len(stats[cost]) > 0:
-                        stats_log.extend(['%s: %.4f' % (cost, np.mean(stats[cost]))])
-                        plot_info[cost].append(np.mean(stats[cost]))
-
-                stats_log.append('%i samples/s' % int(n_words_proc / (time.time() - tic)))
-                logger.info(('%06i - ' % n_iter) + ' - '.join(stats_log))
-                
-                plot_info['iter_train'].append(n_iter+params.epoch_size*n_epoch)
-                #clear
-                for cost in stats:
-                    del stats[cost][:]
-
-                # reset
-                tic = time.time()
-                n_words_proc = 0
+        # Hogwild training with several worker processes
+        if params.n_workers > 1:
+            n_iters = (params.epoch_size + params.batch_size - 1) // params.batch_size
+            samples_per_s = hogwild_epoch(trainer, adversarial_step, n_iters, params.n_workers,
+                                          lambda n, stats, speed: log_train_stats(n_epoch, n * params.batch_size, stats, speed))
+            logger.info('%i samples/s with %i workers' % (int(samples_per_s), params.n_workers))
+
+        else:
+            for n_iter in range(0, params.epoch_size, params.batch_size):
+
+                profiler.step()
+
+                # discriminator / mapping training (discriminator fooling)
+                n_words_proc += adversarial_step(trainer, stats)
+
+                # log stats
+                if n_iter % (params.epoch_size/params.batch_size/20*params.batch_size) == 0:
+                    log_train_stats(n_epoch, n_iter, stats, n_words_proc / (time.time() - tic))
+                    #clear
+                    for cost in stats:
+                        del stats[cost][:]
+
+                    # reset
+                    tic = time.time()
+                    n_words_proc = 0
+
+                # cheap validation / early stopping
+                if params.proxy_freq > 0 and (n_iter // params.batch_size + 1) % params.proxy_freq == 0:
+                    if proxy_step(n_epoch, n_iter):
+                        logger.info('No improvement of "%s" for %i evaluations. Stopping the adversarial training.'
+                                    % (PROXY_METRIC, params.proxy_patience))
+                        trainer.reload_best('best_proxy_mapping')
+                        early_stop = True
+                        break
 
         # embeddings / discriminator evaluation
         to_log1 = OrderedDict({'n_epoch': n_epoch})
@@ -269,11 +287,14 @@ if params.adversarial:
         logger.info("__log__:%s" % json.dumps(to_log1))
         logger.info("__log__:%s" % json.dumps(to_log2))
         trainer.save_best(to_log1, VALIDATION_METRIC)
+        profiler.log_epoch('adversarial epoch %i' % n_epoch, profile_path)
         logger.info('End of epoch %i.\n\n' % n_epoch)
         
-        plot_info['epoch_train'].append(n_epoch)
-        update_plot_info(to_log1, "_t_train")
-        update_plot_info(to_log2, "_f_train")
+        log_metrics('train', to_log1, 't')
+        log_metrics('train', to_log2, 'f')
+        metrics.flush()
+        if early_stop:
+            break
 
         # update the learning rate (stop if too small)
         trainer.update_lr(to_log1, VALIDATION_METRIC)
@@ -305,18 +326,10 @@ if params.adversarial:
     logger.info("__log__:%s" % json.dumps(to_log1))
     logger.info("__log__:%s" % json.dumps(to_log2))
 
-    update_plot_info(to_log1, "_t_train_best")
-    update_plot_info(to_log2, "_f_train_best")
-
-    if params.quick_test:
-        address=os.path.join(params.exp_path, 'plot_info.test')
-        with open(address, 'w') as outfile:  
-            json.dump(plot_info, outfile)
-
-        #test
-        with open(address) as json_file:  
-            data = json.load(json_file)
-            print data
+    log_metrics('train_best', to_log1, 't')
+    log_metrics('train_best', to_log2, 'f')
+    metrics.flush()
+    profiler.log_epoch('best adversarial model', profile_path)
 
 
 """
@@ -335,10 +348,11 @@ if params.refinement:
         # build a dictionary from aligned embeddings
         trainer.build_dictionary(True)
         # apply the Procrustes solution
-        trainer.procrustes(True)
+        stats1 = trainer.procrustes(True)
         # embeddings evaluation
         logger.info('Normal Direction:')
         to_log1 = OrderedDict({'n_iter_no': n_iter})
+        to_log1.update(('refine_%s' % k, v) for k, v in stats1.items())
         evaluator1.word_translation(to_log1)
         evaluator1.dist_mean_cosine(to_log1)
         if not params.quick_test:
@@ -348,10 +362,11 @@ if params.refinement:
         # build a dictionary from aligned embeddings
         trainer.build_dictionary(False)
         # apply the Procrustes solution
-        trainer.procrustes(False)
+        stats2 = trainer.procrustes(False)
         logger.info('Reverse Direction:')
         # embeddings evaluation
         to_log2 = OrderedDict({'n_iter_re': n_iter})
+        to_log2.update(('refine_%s' % k, v) for k, v in stats2.items())
         evaluator2.word_translation(to_log2)
         evaluator2.dist_mean_cosine(to_log2)
         if not params.quick_test:
@@ -362,11 +377,16 @@ if params.refinement:
         logger.info("__log__:%s" % json.dumps(to_log1))
         logger.info("__log__:%s" % json.dumps(to_log2))
         trainer.save_best(to_log1, VALIDATION_METRIC)
+        profiler.log_epoch('refinement iteration %i' % n_iter, profile_path)
         logger.info('End of refinement iteration %i.\n\n' % n_iter)
 
-        plot_info['iter_refine'].append(n_iter)
-        update_plot_info(to_log1, "_t_refine")
-        update_plot_info(to_log2, "_f_refine")
+        log_metrics('refine', to_log1, 't', n_iter=n_iter)
+        log_metrics('refine', to_log2, 'f', n_iter=n_iter)
+        metrics.flush()
+
+        if refinement_converged(stats1, params) and refinement_converged(stats2, params):
+            logger.info('The refinement dictionary / mapping converged. BREAK.')
+            break
 
     logger.info('\n\n----> BEST PROCRUSTES REFINEMENT MODEL <----\n\n')
 
@@ -391,22 +411,15 @@ if params.refinement:
     logger.info("__log__:%s" % json.dumps(to_log1))
     logger.info("__log__:%s" % json.dumps(to_log2))
 
-    update_plot_info(to_log1, "_t_refine_best")
-    update_plot_info(to_log2, "_f_refine_best")
+    log_metrics('refine_best', to_log1, 't')
+    log_metrics('refine_best', to_log2, 'f')
+    profiler.log_epoch('best refinement model', profile_path)
 
 # export embeddings to a text format
 if params.export:
     trainer.reload_best()
     # trainer.export()
 
-    address=os.path.join(params.exp_path, 'plot_info.test')
-    with open(address, 'w') as outfile:  
-        json.dump(plot_info, outfile)
-
-    if params.quick_test:
-        #test
-        with open(address) as json_file:  
-            data = json.load(json_file)
-            print data
+metrics.close()
     
 
@@ -0,0 +1,248 @@
+# Copyright (c) 2017-present, Yuang Yao
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+# python unsupervised_multiseed.py --n_seeds 8 --prune_ratio 0.5 --src_lang en --tgt_lang es --src_emb data/wiki.en.vec --tgt_emb data/wiki.es.vec --refinement True
+
+import os
+import time
+import json
+import argparse
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from src.utils import bool_flag, initialize_exp, EMB_DTYPES
+from src.autotune import initialize_autotuner
+from src.profiler import profiler, initialize_profiler
+from src.models import build_model
+from src.trainer import Trainer
+from src.multiseed import MultiSeedTrainer
+from src.procrustes import refinement_converged
+from src.evaluation import Evaluator
+
+
+VALIDATION_METRIC = 'mean_cosine-csls_knn_10-S2T-10000'
+
+
+# main
+parser = argparse.ArgumentParser(description='Unsupervised training of several seeds at once')
+parser.add_argument("--seed", type=int, default=-1, help="Seed of the batch sampling / of the random seeds")
+parser.add_argument("--n_seeds", type=int, default=8, help="Number of seeds trained together")
+parser.add_argument("--seeds", type=str, default="", help="Comma separated seeds (instead of --n_seeds random ones)")
+parser.add_argument("--prune_ratio", type=float, default=0, help="Fraction of the remaining seeds dropped after each epoch, by validation metric (0 to disable)")
+parser.add_argument("--verbose", type=int, default=2, help="Verbose level (2:debug, 1:info, 0:warning)")
+parser.add_argument("--exp_path", type=str, default="", help="Where to store experiment logs and models")
+parser.add_argument("--cuda", type=bool_flag, default=True, help="Run on GPU")
+parser.add_argument("--export", type=bool_flag, default=True, help="Export embeddings after training")
+parser.add_argument("--export_format", type=str, default="txt", help="Export format (txt: text files of the vectors, store: mapped stores referencing the embedding files)")
+# data
+parser.add_argument("--src_lang", type=str, default='en', help="Source language")
+parser.add_argument("--tgt_lang", type=str, default='es', help="Target language")
+parser.add_argument("--emb_dim", type=int, default=300, help="Embedding dimension")
+parser.add_argument("--max_vocab", type=int, default=200000, help="Maximum vocabulary size")
+# mapping
+parser.add_argument("--map_id_init", type=bool_flag, default=True, help="Initialize the mapping as an identity matrix")
+parser.add_argument("--map_beta", type=float, default=0.001, help="Beta for orthogonalization")
+# discriminator
+parser.add_argument("--dis_layers", type=int, default=2, help="Discriminator layers")
+parser.add_argument("--dis_hid_dim", type=int, default=2048, help="Discriminator hidden layer dimensions")
+parser.add_argument("--dis_dropout", type=float, default=0., help="Discriminator dropout")
+parser.add_argument("--dis_input_dropout", type=float, default=0.1, help="Discriminator input dropout")
+parser.add_argument("--dis_steps", type=int, default=5, help="Discriminator steps")
+parser.add_argument("--dis_lambda", type=float, default=1, help="Discriminator loss feedback coefficient")
+parser.add_argument("--dis_most_frequent", type=int, default=75000, help="Select embeddings of the k most frequent words for discrimination (0 to disable)")
+parser.add_argument("--dis_smooth", type=float, default=0.1, help="Discriminator smooth predictions")
+parser.add_argument("--dis_clip_weights", type=float, default=0, help="Clip discriminator weights (0 to disable)")
+# training adversarial
+parser.add_argument("--n_epochs", type=int, default=5, help="Number of epochs")
+parser.add_argument("--epoch_size", type=int, default=1000000, help="Iterations per epoch")
+parser.add_argument("--batch_size", type=int, default=32, help="Batch size")
+parser.add_argument("--map_optimizer", type=str, default="sgd,lr=0.1", help="Mapping optimizer")
+parser.add_argument("--dis_optimizer", type=str, default="sgd,lr=0.1", help="Discriminator optimizer")
+parser.add_argument("--lr_decay", type=float, default=0.98, help="Learning rate decay (SGD only)")
+parser.add_argument("--min_lr", type=float, default=1e-6, help="Minimum learning rate (SGD only)")
+parser.add_argument("--lr_shrink", type=float, default=0.5, help="Shrink the learning rate if the validation metric decreases (1 to disable)")
+# training refinement
+parser.add_argument("--refinement", type=bool_flag, default=False, help="Use iterative Procrustes refinement")
+parser.add_argument("--n_iters", type=int, default=5, help="Number of iterations")
+parser.add_argument("--refine_min_overlap", type=float, default=1, help="Stop the refinement once the dictionary overlap with the previous iteration is above this value")
+parser.add_argument("--refine_max_delta", type=float, default=0, help="and the relative change of the mapping below this one (by default: once the dictionary is unchanged)")
+# dictionary creation parameters (for refinement)
+parser.add_argument("--dico_method", type=str, default='csls_knn_10', help="Method used for dictionary generation (nn/invsm_beta_30/csls_knn_10)")
+parser.add_argument("--dico_build", type=str, default='S2T&T2S', help="S2T,T2S,S2T|T2S,S2T&T2S")
+parser.add_argument("--dico_threshold", type=float, default=0, help="Threshold confidence for dictionary generation")
+parser.add_argument("--dico_max_rank", type=int, default=15000, help="Maximum dictionary words rank (0 to disable)")
+parser.add_argument("--dico_min_size", type=int, default=0, help="Minimum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_max_size", type=int, default=0, help="Maximum generated dictionary size (0 to disable)")
+parser.add_argument("--dico_index", type=str, default="", help="Approximate candidates search with a PQ index, e.g. pq,code_size=50,n_lists=1024,nprobe=16,shortlist=100 (empty for exact search)")
+parser.add_argument("--autotune", type=bool_flag, default=True, help="Benchmark the block sizes of the similarity kernels on first use (cached per machine and shape)")
+parser.add_argument("--autotune_memory", type=int, default=1024, help="Memory budget of a block of similarity scores, in MB")
+parser.add_argument("--autotune_cache", type=str, default="", help="Block sizes cache file (default: ~/.cache/unsupervised_word_mapping/block_sizes.json)")
+# reload pre-trained embeddings
+parser.add_argument("--src_emb", type=str, default="", help="Reload source embeddings")
+parser.add_argument("--tgt_emb", type=str, default="", help="Reload target embeddings")
+parser.add_argument("--normalize_embeddings", type=str, default="", help="Normalize embeddings before training")
+parser.add_argument("--emb_dtype", type=str, default="float32", help="Precision of the stored embedding tables (float32 / float16 / bfloat16)")
+parser.add_argument("--restrict_vocab", type=bool_flag, default=False, help="Only load the most frequent words used for training, and the words of the training / evaluation dictionaries (evaluations then search among these words)")
+# profiling
+parser.add_argument("--profile", type=bool_flag, default=False, help="Log a per-epoch breakdown of the training / evaluation time")
+parser.add_argument("--profile_memory", type=bool_flag, default=False, help="Also record the peak memory of each profiled phase")
+parser.add_argument("--profile_trace", type=str, default="", help="Dump a trace of a window of iterations (cprofile:START-END or torch:START-END)")
+
+
+
+# parse parameters
+params = parser.parse_args()
+
+# check parameters
+assert not params.cuda or torch.cuda.is_available()
+assert params.export_format in ["txt", "store"]
+assert params.dico_index == "" or params.dico_index.split(",")[0] == "pq"
+assert params.autotune_memory > 0
+assert params.emb_dtype in EMB_DTYPES
+assert 0 <= params.dis_dropout < 1
+assert 0 <= params.dis_input_dropout < 1
+assert 0 <= params.dis_smooth < 0.5
+assert params.dis_lambda > 0 and params.dis_steps > 0
+assert 0 < params.lr_shrink <= 1
+assert 0 <= params.prune_ratio < 1
+assert params.seeds or params.n_seeds > 0
+assert os.path.isfile(params.src_emb)
+assert os.path.isfile(params.tgt_emb)
+
+# build model / trainer / evaluator
+logger = initialize_exp(params)
+initialize_autotuner(params)
+profile_path = initialize_profiler(params)
+src_emb, tgt_emb, mapping, discriminator = build_model(params, True)
+trainer = Trainer(src_emb, tgt_emb, mapping, discriminator, params)
+evaluator = Evaluator(trainer)
+seeds = [int(s) for s in params.seeds.split(',')] if params.seeds else \
+    [int(s) for s in np.random.randint(1 << 31, size=params.n_seeds)]
+assert len(set(seeds)) == len(seeds)
+multi_trainer = MultiSeedTrainer(trainer, seeds)
+logger.info('Training %i seeds: %s' % (len(seeds), ', '.join(str(s) for s in seeds)))
+profiler.log_epoch('setup', profile_path)
+
+
+"""
+Learning loop for Adversarial Training (all the seeds at once)
+"""
+logger.info('----> ADVERSARIAL TRAINING <----\n\n')
+best_metrics = OrderedDict((seed, -1e12) for seed in seeds)
+
+# training loop
+for n_epoch in range(params.n_epochs):
+
+    logger.info('Starting adversarial training epoch %i (%i seeds)...' % (n_epoch, multi_trainer.n_seeds))
+    tic = time.time()
+    n_words_proc = 0
+    stats = {'DIS_COSTS': []}
+
+    for n_iter in range(0, params.epoch_size, params.batch_size):
+
+        profiler.step()
+
+        # discriminator training
+        for _ in range(params.dis_steps):
+            multi_trainer.dis_step(stats)
+
+        # mapping training (discriminator fooling)
+        n_words_proc += multi_trainer.mapping_step(stats)
+
+        # log stats
+        if n_iter % 500 == 0:
+            stats_str = [('DIS_COSTS', 'Discriminator loss')]
+            stats_log = ['%s: %.4f' % (v, np.mean(stats[k]))
+                         for k, v in stats_str if len(stats[k]) > 0]
+            stats_log.append('%i samples/s' % int(n_words_proc / (time.time() - tic)))
+            logger.info(('%06i - ' % n_iter) + ' - '.join(stats_log))
+
+            # reset
+            tic = time.time()
+            n_words_proc = 0
+            for k, _ in stats_str:
+                del stats[k][:]
+
+    # validation criterion of every seed
+    to_logs = [OrderedDict([('n_epoch', n_epoch), ('seed', seed)]) for seed in multi_trainer.seeds]
+    multi_trainer.dist_mean_cosine(to_logs)
+
+    # JSON log / save best models / end of epoch
+    for to_log in to_logs:
+        logger.info("__log__:%s" % json.dumps(to_log))
+        best_metrics[to_log['seed']] = max(best_metrics[to_log['seed']], to_log[VALIDATION_METRIC])
+    multi_trainer.save_best(to_logs, VALIDATION_METRIC)
+    profiler.log_epoch('adversarial epoch %i' % n_epoch, profile_path)
+    logger.info('End of epoch %i.\n\n' % n_epoch)
+
+    # update the learning rates (stop if too small)
+    multi_trainer.update_lr(to_logs, VALIDATION_METRIC)
+    if multi_trainer.map_lr.max() < params.min_lr:
+        logger.info('Learning rate < 1e-6. BREAK.')
+        break
+
+    # stop training the worst seeds
+    if params.prune_ratio > 0 and n_epoch < params.n_epochs - 1:
+        multi_trainer.prune(max(1, int(round(multi_trainer.n_seeds * (1 - params.prune_ratio)))))
+
+# best validation metric of every seed
+path = os.path.join(params.exp_path, 'seeds.tsv')
+with open(path, 'w') as f:
+    f.write('seed\t%s\n' % VALIDATION_METRIC)
+    for seed, metric in best_metrics.items():
+        f.write('%i\t%.5f\n' % (seed, metric))
+logger.info('Validation metric of every seed written to %s' % path)
+
+# evaluate the best seed
+best_seed = multi_trainer.save_winner()
+trainer.reload_best()
+to_log = OrderedDict({'best_seed': best_seed})
+evaluator.all_eval(to_log)
+evaluator.eval_dis(to_log)
+logger.info("__log__:%s" % json.dumps(to_log))
+profiler.log_epoch('best seed', profile_path)
+
+
+"""
+Learning loop for Procrustes Iterative Refinement (of the best seed)
+"""
+if params.refinement:
+    # Get the best mapping according to VALIDATION_METRIC
+    logger.info('----> ITERATIVE PROCRUSTES REFINEMENT <----\n\n')
+    trainer.reload_best()
+
+    # training loop
+    for n_iter in range(params.n_iters):
+
+        logger.info('Starting refinement iteration %i...' % n_iter)
+
+        # build a dictionary from aligned embeddings
+        trainer.build_dictionary()
+
+        # apply the Procrustes solution
+        stats = trainer.procrustes()
+
+        # embeddings evaluation
+        to_log = OrderedDict({'n_iter': n_iter})
+        to_log.update(('refine_%s' % k, v) for k, v in stats.items())
+        evaluator.all_eval(to_log)
+
+        # JSON log / save best model / end of epoch
+        logger.info("__log__:%s" % json.dumps(to_log))
+        trainer.save_best(to_log, VALIDATION_METRIC)
+        profiler.log_epoch('refinement iteration %i' % n_iter, profile_path)
+        logger.info('End of refinement iteration %i.\n\n' % n_iter)
+
+        if refinement_converged(stats, params):
+            logger.info('The refinement dictionary / mapping converged. BREAK.')
+            break
+
+
+# export embeddings to a text format
+if params.export:
+    trainer.reload_best()
+    trainer.export()